@@ -17,7 +17,7 @@
 
 import logging
 import time
-from typing import List, Optional
+from typing import Iterable, Iterator, List, Optional
 import usb.core
 from PIL.Image import Image
 
@@ -88,7 +88,35 @@ class Printer(object):
         raise ValueError("Unable to read PTouch printer status: timeout")
 
     def print_image(self, image: Image, cut_tape=True):
+        self.print_image_strips((image,), cut_tape)
+
+    def print_image_strips(self, strips: Iterable[Image], cut_tape=True):
+        """
+        Prints label supplied as a sequence of images (strips) following each other along the tape. Each strip is sent
+        to the printer as soon as it is available so the whole label never has to be in memory.
+        """
+        self.send_raster(self.encode_image_strips(strips), cut_tape)
+
+    def encode_image_strips(self, strips: Iterable[Image]) -> Iterator[bytes]:
+        """
+        Converts label supplied as a sequence of strips into raster line frames. Device is not accessed, so the next
+        label could be encoded while the previous one is being printed.
+        """
         buffer_size = int(self.info.max_px_buffer / 8)
+        for image in strips:
+            offset = int(self.info.max_px_buffer / 2) - int(image.height / 2)
+            for x in range(image.width):
+                raster_line = [0] * buffer_size
+                for y in range(image.height):
+                    pixel_is_set = image.getpixel((x, image.height - 1 - y)) == 0
+                    if pixel_is_set:
+                        self.__rasterline_set_pixel(raster_line, offset + y)
+                yield self.__raster_frame(bytes(raster_line))
+
+    def send_raster(self, frames: Iterable[bytes], cut_tape=True):
+        """
+        Sends raster line frames produced by encode_image_strips to the printer
+        """
         # Enable pack bits
         if self.info.packbits:
             self._pt_send(const.CMD_ENABLE_PACKBITS)
@@ -97,14 +125,8 @@ class Printer(object):
             self._pt_send(const.CMD_RASTER_START_P700)
         else:
             self._pt_send(const.CMD_RASTER_START)
-        offset = int(self.info.max_px_buffer / 2) - int(image.height / 2)
-        for x in range(image.width):
-            raster_line = [0] * buffer_size
-            for y in range(image.height):
-                pixel_is_set = image.getpixel((x, image.height - 1 - y)) == 0
-                if pixel_is_set:
-                    self.__rasterline_set_pixel(raster_line, offset + y)
-            self.__send_raster(bytes(raster_line))
+        for frame in frames:
+            self._pt_send(frame)
         self._pt_send(const.CMD_EJECT if cut_tape else const.CMD_ADVANCE)
 
     def __rasterline_set_pixel(self, rasterline: List[int], pixel_offset: int) -> None:
@@ -113,10 +135,10 @@ class Printer(object):
             return
         rasterline[(size - 1) - int(pixel_offset / 8)] |= 1 << (pixel_offset % 8)
 
-    def __send_raster(self, data_frame: bytes) -> None:
+    @staticmethod
+    def __raster_frame(data_frame: bytes) -> bytes:
         preamble = [0x47, len(data_frame) + 1, 0x00, len(data_frame) - 1]
-        buffer = bytes(preamble) + data_frame
-        self._pt_send(buffer)
+        return bytes(preamble) + data_frame
 
     def __str__(self) -> str:
         return "{} {} (s/n: {}) [USB dev {} / Bus {}]".format(
@@ -18,11 +18,15 @@
 import abc
 import argparse
 import copy
+import itertools
 import logging
+import os
+import signal
 import sys
+import time
 from enum import Enum
 from pathlib import Path
-from typing import List, Dict, Any, Optional, Tuple
+from typing import TYPE_CHECKING, List, Dict, Any, Iterable, Iterator, NamedTuple, Optional, Tuple
 
 from cli_rack import CLI, ansi
 from cli_rack.modular import CliAppManager, CliExtension, GlobalArgsExtension
@@ -30,14 +34,48 @@ from cli_rack.utils import none_throws
 
 from tapen import config, const
 from tapen.__version__ import __version__ as VERSION
-from tapen.common.domain import PrintJob
+from tapen.common.dataset import Dataset, DatasetError, DatasetFormat, parse_column_map, with_last_flag
+from tapen.common.domain import PrintJob, Template
+from tapen.common.pipeline import Pipeline
 from tapen.library import TemplateLibrary, STANDARD_LIB_NAME
 from tapen.printer import get_print_factory, PrinterFactory, TapenPrinter
 from tapen.printer.common import PrintingMode, TapeInfo
-from tapen.renderer import get_default_renderer, Renderer
+from tapen.renderer import get_default_renderer, get_bitmap_cache, get_renderer_for_template
+from tapen.validate import RowError
+from tapen.renderer.options import DitherMode, ExportFormat, DEFAULT_SHEET_COLUMNS, DEFAULT_THRESHOLD
+from tapen.common.profiler import Profiler, profile_label, profile_span
+from tapen.common.watch import create_watcher
+
+# Rendering modules depend on WeasyPrint, poppler and PIL. They are imported by commands which render labels,
+# so commands like import-lib or --help start fast
+if TYPE_CHECKING:
+    from tapen.renderer.common import Renderer
 
 LOGGER = logging.getLogger("cli")
 
+# Print arguments which are sent to the daemon
+PRINT_JOB_ARGS = (
+    "template",
+    "data",
+    "mode",
+    "copies",
+    "force_tape_detection",
+    "skip_printing",
+    "tiled",
+    "image",
+    "dither",
+    "threshold",
+    "input",
+    "input_format",
+    "map",
+)
+
+# Validation summary is reported for datasets of at least this size
+VALIDATION_REPORT_MIN_ROWS = 1000
+MAX_REPORTED_VALIDATION_ERRORS = 20
+# Streamed datasets are validated by chunks of this size
+VALIDATION_CHUNK_SIZE = 1000
+
 
 class EnumAction(argparse.Action):
     """
@@ -89,14 +127,21 @@ class TapenAppManager(CliAppManager):
 
 
 class BaseCliExtension(CliExtension, metaclass=abc.ABCMeta):
+    DEFAULT_TEMPLATE_NAME = "std:default"
+
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
         self.__template_library: TemplateLibrary | None = None
         self.__config: dict[str, Any] | None = None
         self.__config_location: str | None = None
-        self.__renderer: Renderer | None = None
+        self.__renderer: Optional["Renderer"] = None
         self.__printer_factory: PrinterFactory | None = None
         self.__libs_fetched = False
+        self.__debug = False
+        self.profiler: Optional[Profiler] = None
+        # Long running processes keep discovered printer instead of looking for it for every job
+        self.keep_printer = False
+        self.__printer: Optional[TapenPrinter] = None
 
     @classmethod
     def load_config(cls, args: argparse.Namespace) -> Tuple[str, Dict[str, Any]]:
@@ -118,9 +163,9 @@ class BaseCliExtension(CliExtension, metaclass=abc.ABCMeta):
 
     def init(self, args: argparse.Namespace):
         self.__config_location, self.__config = self.load_config(args)
-        self.__renderer = get_default_renderer()
-        if args.debug:
-            self.__renderer.persist_rendered_image_as_file = True
+        self.__debug = args.debug
+        if getattr(args, "profile", None) is not None:
+            self.profiler = Profiler(trace_memory=getattr(args, "profile_memory", False))
         self.__printer_factory = get_print_factory()
         self.__template_library = TemplateLibrary(
             self.config.get(const.CONF_LIBRARIES), always_reload_local_libs=args.debug  # type: ignore
@@ -133,22 +178,160 @@ class BaseCliExtension(CliExtension, metaclass=abc.ABCMeta):
         ), "Class is not initialized. Forgot self.init()?"
         if not self.__libs_fetched:
             self.__template_library.fetch_libraries()
+            self.__libs_fetched = True
         return self.__template_library
 
+    def refresh_template_library(self):
+        """
+        Libraries will be checked for updates on the next access. It is cheap for libraries which haven't changed.
+        """
+        self.__libs_fetched = False
+
+    def __setup_renderer(self, renderer: "Renderer") -> "Renderer":
+        renderer.profiler = self.profiler
+        if self.__debug:
+            renderer.persist_rendered_image_as_file = True
+        bitmap_cache_size = self.config[const.CONF_CACHE][const.CONF_BITMAP_CACHE_SIZE]
+        # In debug mode every label is re-rendered so that intermediate images are always persisted
+        if bitmap_cache_size > 0 and not self.__debug:
+            renderer.bitmap_cache = get_bitmap_cache(bitmap_cache_size)
+        render_timeout = self.config[const.CONF_RENDER][const.CONF_RENDER_TIMEOUT]
+        if render_timeout > 0:
+            renderer.render_timeout = render_timeout
+        return renderer
+
     @property
-    def renderer(self) -> Renderer:
+    def renderer(self) -> "Renderer":
         if self.__renderer is None:
-            self.__renderer = get_default_renderer()
+            self.__renderer = self.__setup_renderer(get_default_renderer())
         return self.__renderer
 
+    def get_renderer_for_template(self, template: Template) -> "Renderer":
+        return self.__setup_renderer(get_renderer_for_template(template))
+
+    def split_template_and_data(self, template_name: str, data: List[str]) -> Tuple[str, List[str]]:
+        """
+        Template name could be omitted in command line, in this case the first argument is data for default template
+        """
+        if ":" not in template_name:
+            return self.DEFAULT_TEMPLATE_NAME, [template_name] + data
+        return template_name, data
+
     def get_printer(self) -> Optional[TapenPrinter]:
         assert self.__printer_factory is not None, "Class is not initialized. Forgot self.init()?"
-        return self.__printer_factory.get_first_printer()
+        if self.keep_printer and self.__printer is not None:
+            return self.__printer
+        printer = self.__printer_factory.get_first_printer()
+        if printer is not None:
+            printer.profiler = self.profiler
+        if self.keep_printer:
+            self.__printer = printer
+        return printer
+
+    def release_printer(self):
+        self.__printer = None
+
+    def validate_label_params(self, template: Template, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Validates params of all labels at once, before anything is rendered. Terminates listing invalid rows if any.
+        """
+        with self.profile_span("params-validation"):
+            result = template.params_validator.validate(rows)
+        self.__report_validation(len(rows), result.elapsed_sec, result.errors, len(result.errors))
+        return result.rows
+
+    def validate_dataset(self, template: Template, rows: Iterable[Dict[str, Any]]) -> int:
+        """
+        Validates params of all labels in dataset without keeping it in memory. Only the first errors are retained.
+        Terminates listing invalid rows if any, otherwise returns number of rows.
+        """
+        row_count = error_count = 0
+        elapsed_sec = 0.0
+        errors: List[RowError] = []
+        validator = template.params_validator
+        iterator = iter(rows)
+        with self.profile_span("params-validation"):
+            while True:
+                chunk = list(itertools.islice(iterator, VALIDATION_CHUNK_SIZE))
+                if len(chunk) == 0:
+                    break
+                result = validator.validate(chunk, first_row_num=row_count + 1)
+                row_count += len(chunk)
+                elapsed_sec += result.elapsed_sec
+                error_count += len(result.errors)
+                errors.extend(result.errors[: MAX_REPORTED_VALIDATION_ERRORS - len(errors)])
+        self.__report_validation(row_count, elapsed_sec, errors, error_count)
+        return row_count
+
+    def iter_valid_label_params(self, template: Template, rows: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+        """
+        Validates params of labels by chunks while they are consumed, so that dataset is never held in memory.
+        Terminates on the first chunk containing invalid rows.
+        """
+        validator = template.params_validator
+        iterator = iter(rows)
+        row_num = 1
+        while True:
+            chunk = list(itertools.islice(iterator, VALIDATION_CHUNK_SIZE))
+            if len(chunk) == 0:
+                return
+            with self.profile_span("params-validation"):
+                result = validator.validate(chunk, first_row_num=row_num)
+            if not result.is_valid:
+                self.__report_validation(len(chunk), result.elapsed_sec, result.errors, len(result.errors))
+            row_num += len(chunk)
+            yield from result.rows
+
+    def __report_validation(self, row_count: int, elapsed_sec: float, errors: List[RowError], error_count: int):
+        rows_per_sec = row_count / elapsed_sec if elapsed_sec > 0 else 0.0
+        summary = "Validated {} label(s) in {:.0f}ms ({:.0f} labels/s)".format(
+            row_count, elapsed_sec * 1000, rows_per_sec
+        )
+        if row_count >= VALIDATION_REPORT_MIN_ROWS:
+            CLI.print_info(summary)
+        else:
+            LOGGER.debug(summary)
+        if error_count > 0:
+            CLI.print_error("Invalid label data, {} error(s) found:".format(error_count))
+            for x in errors[:MAX_REPORTED_VALIDATION_ERRORS]:
+                CLI.print_error("\t" + str(x))
+            if error_count > MAX_REPORTED_VALIDATION_ERRORS:
+                CLI.print_error("\t... and {} more".format(error_count - MAX_REPORTED_VALIDATION_ERRORS))
+            exit(3)
+
+    def profile_span(self, name: str, **kwargs):
+        return profile_span(self.profiler, name, "cli", **kwargs)
+
+    def profile_label(self, label_num: int, **kwargs):
+        return profile_label(self.profiler, label_num, **kwargs)
+
+    def finish_profiling(self, args: argparse.Namespace):
+        if self.profiler is None:
+            return
+        self.profiler.stop()
+        self.profiler.write_chrome_trace(args.profile)
+        CLI.print_info("\n" + self.profiler.format_summary())
+        CLI.print_info("\nTrace saved at {} (open it with chrome://tracing or ui.perfetto.dev)".format(args.profile))
 
     def get_cached_tape_info(self, printer_id: Optional[str] = None) -> Optional[TapeInfo]:
         assert self.__printer_factory is not None, "Class is not initialized. Forgot self.init()?"
         return self.__printer_factory.get_cached_tape_info(printer_id)
 
+    def resolve_tape_info(self) -> TapeInfo:
+        """
+        Returns cached tape info or asks connected printer. For commands which do not need printer otherwise.
+        """
+        tape_info = self.get_cached_tape_info()
+        if tape_info is None:
+            printer = self.get_printer()
+            if printer is None:
+                CLI.print_error("Tape information is not available in cache and printer is not connected.")
+                exit(2)
+            printer.init()
+            tape_info = printer.get_status().tape_info
+        CLI.print_info("Assuming tape {}".format(tape_info))
+        return none_throws(tape_info)
+
 
 class ImportLibExtension(BaseCliExtension):
     COMMAND_NAME = "import-lib"
@@ -175,10 +358,110 @@ class ImportLibExtension(BaseCliExtension):
         CLI.print_info("Library {} has been added to config file".format(args.name))
 
 
+class _PrintTask(NamedTuple):
+    label_num: int
+    # Label params, then print job or rendered bitmap, then encoded label as task passes through the stages
+    data: Any
+    is_last: bool
+
+
+def _should_cut(args: argparse.Namespace, is_last_label: bool) -> bool:
+    if args.mode == PrintingMode.HALF_CUT:
+        return is_last_label  # Cut the last label
+    return True
+
+
+def _resolve_config_location(args: argparse.Namespace) -> Optional[str]:
+    # Client and daemon could be started from different directories, so relative config paths are not comparable
+    return os.path.realpath(args.config) if args.config is not None else None
+
+
+class _PrintStages(object):
+    """
+    Stages of the print pipeline: labels are rendered, encoded into printer specific data and sent to the printer
+    """
+
+    def __init__(
+        self,
+        extension: BaseCliExtension,
+        args: argparse.Namespace,
+        template: Template,
+        renderer: "Renderer",
+        printer: Optional[TapenPrinter],
+        tape_info: TapeInfo,
+    ) -> None:
+        self.extension = extension
+        self.args = args
+        self.template = template
+        self.renderer = renderer
+        self.printer = printer
+        self.tape_info = tape_info
+
+    def render(self, tasks: Iterator[_PrintTask]) -> Iterator[_PrintTask]:
+        # Rendered label is held back until the next one is rendered, so that the last label is known even if the
+        # labels following it failed to render
+        previous: Optional[_PrintTask] = None
+        try:
+            for task in tasks:
+                rendered = self.__render_label(task)
+                if rendered is None:
+                    continue
+                if previous is not None:
+                    yield previous
+                previous = rendered
+        except Exception:
+            # Labels preceding the failed one are still printed
+            if previous is not None:
+                yield previous
+            raise
+        if previous is not None:
+            yield previous._replace(is_last=True)
+
+    def __render_label(self, task: _PrintTask) -> Optional[_PrintTask]:
+        from tapen.renderer.common import RenderTimeoutError
+
+        with self.extension.profile_label(task.label_num):
+            print_job = PrintJob(self.template, task.data)
+            if self.args.tiled:
+                # Strips are rendered while label is being sent, so that it is never kept in memory
+                return task._replace(data=print_job)
+            try:
+                return task._replace(data=self.renderer.render_bitmap(print_job, self.tape_info))
+            except RenderTimeoutError as e:
+                # Labels queued behind the slow one are still printed
+                CLI.print_error(e)
+                return None
+
+    def encode(self, tasks: Iterator[_PrintTask]) -> Iterator[_PrintTask]:
+        for task in tasks:
+            with self.extension.profile_label(task.label_num):
+                if self.args.skip_printing:
+                    if self.args.tiled:
+                        for _ in self.renderer.render_bitmap_strips(task.data, self.tape_info):
+                            pass
+                    CLI.print_warn("Printing skipped as per user request.")
+                    continue
+                if not self.args.tiled:
+                    task = task._replace(data=none_throws(self.printer).encode_image(task.data))
+            yield task
+
+    def send(self, tasks: Iterator[_PrintTask]) -> Iterator[_PrintTask]:
+        for task in tasks:
+            with self.extension.profile_label(task.label_num):
+                for copy_num in range(self.args.copies):
+                    cut_tape = _should_cut(self.args, task.is_last and copy_num == self.args.copies - 1)
+                    if self.args.tiled:
+                        # Strips are not retained, so every copy is rendered again
+                        strips = self.renderer.render_bitmap_strips(task.data, self.tape_info)
+                        none_throws(self.printer).print_image_strips(strips, cut_tape)
+                    else:
+                        none_throws(self.printer).send_encoded(task.data, cut_tape)
+            yield task
+
+
 class PrintExtension(BaseCliExtension):
     COMMAND_NAME = "print"
     COMMAND_DESCRIPTION = "Renders and prints given data"
-    DEFAULT_TEMPLATE_NAME = "std:default"
 
     @classmethod
     def setup_parser(cls, parser: argparse.ArgumentParser):
@@ -213,23 +496,84 @@ class PrintExtension(BaseCliExtension):
             default=False,
             help="Renders data and skips printing on the real device",
         )
+        parser.add_argument(
+            "-t",
+            "--tiled",
+            action="store_true",
+            default=False,
+            help="Renders and sends labels to the printer strip by strip. Use it for very long labels (banners)",
+        )
+        parser.add_argument(
+            "--profile",
+            action="store",
+            type=Path,
+            default=None,
+            metavar="TRACE_FILE",
+            help="Collects timings of every stage and saves them as Chrome trace",
+        )
+        parser.add_argument(
+            "--profile-memory",
+            action="store_true",
+            default=False,
+            help="Also records memory allocated by every stage (slows down profiled run, allocations of concurrent "
+            "stages are mixed up)",
+        )
+        parser.add_argument(
+            "-i",
+            "--image",
+            action="store_true",
+            default=False,
+            help="Prints image files given as data as is, without template",
+        )
+        parser.add_argument(
+            "--dither",
+            action=EnumAction,
+            type=DitherMode,  # type: ignore
+            default=DitherMode.FLOYD_STEINBERG,
+            help="Method of converting images to black and white (image mode only)",
+        )
+        parser.add_argument(
+            "--threshold",
+            action="store",
+            type=int,
+            default=DEFAULT_THRESHOLD,
+            help="Brightness (0-255) below which pixel is printed when dither is set to threshold",
+        )
+        parser.add_argument(
+            "--no-daemon",
+            action="store_true",
+            default=False,
+            help="Executes job in this process even if tapen daemon (tapen serve) is running",
+        )
+        parser.add_argument(
+            "--input",
+            action="store",
+            type=str,
+            default=None,
+            metavar="FILE",
+            help="Reads label params from CSV/TSV file with header or JSON lines file, use - for stdin",
+        )
+        parser.add_argument(
+            "--input-format",
+            action=EnumAction,
+            type=DatasetFormat,  # type: ignore
+            default=None,
+            help="Format of the input. Derived from file extension by default, csv for stdin",
+        )
+        parser.add_argument(
+            "-M",
+            "--map",
+            action="append",
+            default=[],
+            metavar="COLUMN=PARAM",
+            help="Passes input column into template param with another name. Could be given multiple times",
+        )
         parser.add_argument("template", action="store", type=str, help="Template to use")
         parser.add_argument(
             "data", nargs="*", action="store", type=str, help="Data to be printed (will be passed into template)"
         )
 
-    def __is_template_name(self, name: str) -> bool:
-        return ":" in name
-
-    def handle(self, args: argparse.Namespace):
-        self.init(args)
-        template_name = args.template
-        data = args.data
-        if not self.__is_template_name(template_name):
-            data = [template_name] + data
-            template_name = self.DEFAULT_TEMPLATE_NAME
-        template = self.template_library.load_template(template_name)
-        # Load printer data
+    def _init_printer(self, args: argparse.Namespace) -> Tuple[Optional[TapenPrinter], TapeInfo]:
         printer = self.get_printer()
         if printer is None and not args.skip_printing:
             CLI.print_error("Printer is not connected.")
@@ -250,23 +594,342 @@ class PrintExtension(BaseCliExtension):
                     exit(2)
         else:
             CLI.print_info("Assuming tape {}".format(tape_info))
-        label_num = 0
-        if len(data) == 0:
-            data = [None]
-        total_labels = len(data) * args.copies
-        for i, x in enumerate(data):
-            print_job = PrintJob(template, dict(default=x))
-            bitmap = self.renderer.render_bitmap(print_job, none_throws(tape_info))
-            if not args.skip_printing:
-                for _ in range(args.copies):
-                    label_num += 1
-                    if args.mode == PrintingMode.HALF_CUT:
-                        cut_tape = label_num == total_labels  # Cut the last label
-                    else:
-                        cut_tape = True
-                    none_throws(printer).print_image(bitmap, cut_tape)
-            else:
+        return printer, none_throws(tape_info)
+
+    def __print_images(self, args: argparse.Namespace, files: List[str]):
+        from tapen.renderer.image import image_to_bitmap
+
+        files = [x for x in files if x]
+        if len(files) == 0:
+            CLI.print_error("No image files given")
+            exit(3)
+        printer, tape_info = self._init_printer(args)
+        for file, is_last_file in with_last_flag(files):
+            bitmap = image_to_bitmap(file, tape_info, args.dither, args.threshold)
+            if args.skip_printing:
                 CLI.print_warn("Printing skipped as per user request.")
+                continue
+            for copy_num in range(args.copies):
+                cut_tape = _should_cut(args, is_last_file and copy_num == args.copies - 1)
+                none_throws(printer).print_image(bitmap, cut_tape)
+
+    def handle(self, args: argparse.Namespace):
+        # Stdin could be read only by this process
+        if not args.no_daemon and args.profile is None and args.input != "-":
+            exit_code = self.__submit_to_daemon(args)
+            if exit_code is not None:
+                if exit_code != 0:
+                    exit(exit_code)
+                return
+        self.init(args)
+        self.run(args)
+
+    def run(self, args: argparse.Namespace):
+        """
+        Executes print job in the current process. Extension must be initialized.
+        """
+        try:
+            self.__handle(args)
+        finally:
+            self.finish_profiling(args)
+
+    @classmethod
+    def __submit_to_daemon(cls, args: argparse.Namespace) -> Optional[int]:
+        from tapen.daemon import submit_job
+
+        job = {x: getattr(args, x) for x in PRINT_JOB_ARGS}
+        job.update(mode=args.mode.value, dither=args.dither.value)
+        if args.image:
+            # Daemon could be started from another directory
+            job.update(template=os.path.abspath(args.template), data=[os.path.abspath(x) for x in args.data])
+        if args.input is not None:
+            job.update(input=os.path.abspath(args.input))
+        if args.input_format is not None:
+            job.update(input_format=args.input_format.value)
+        return submit_job(
+            dict(command=cls.COMMAND_NAME, config=_resolve_config_location(args), args=job), CLI.ui_logger
+        )
+
+    @classmethod
+    def args_from_job(cls, job: Dict[str, Any]) -> argparse.Namespace:
+        args = argparse.Namespace(**{x: job[x] for x in PRINT_JOB_ARGS})
+        args.mode = PrintingMode(job["mode"])
+        args.dither = DitherMode(job["dither"])
+        if args.input_format is not None:
+            args.input_format = DatasetFormat(args.input_format)
+        args.profile = None
+        args.no_daemon = True
+        return args
+
+    @staticmethod
+    def __open_dataset(args: argparse.Namespace) -> Dataset:
+        path = None if args.input == "-" else Path(args.input)
+        if path is not None and not path.is_file():
+            CLI.print_error("Input file {} doesn't exist".format(path))
+            exit(3)
+        try:
+            column_map = parse_column_map(args.map)
+        except DatasetError as e:
+            CLI.print_error(str(e))
+            exit(3)
+        dataset = Dataset(path, args.input_format or DatasetFormat.from_path(path), column_map)
+        if path is None:
+            dataset.buffer_stdin()
+        return dataset
+
+    def __get_label_params(
+        self, args: argparse.Namespace, template: Template, data: List[str]
+    ) -> Iterable[Dict[str, Any]]:
+        if args.input is None:
+            if len(data) > 0:
+                return self.validate_label_params(template, [dict(default=x) for x in data])
+            return [dict(default=None)]
+        if len(data) > 0:
+            CLI.print_error("Label data could be given either as arguments or with --input, not both")
+            exit(3)
+        dataset = self.__open_dataset(args)
+        # Dataset is read twice, so that no label is printed if any row is invalid
+        self.validate_dataset(template, dataset)
+        return self.iter_valid_label_params(template, dataset)
+
+    def __handle(self, args: argparse.Namespace):
+        if args.image:
+            # There is no template in image mode, every argument is an image file even if it contains ":"
+            self.__print_images(args, [args.template] + args.data)
+            return
+        template_name, data = self.split_template_and_data(args.template, args.data)
+        with self.profile_span("template-load"):
+            template = self.template_library.load_template(template_name)
+        renderer = self.get_renderer_for_template(template)
+        cached_tape_info = self.get_cached_tape_info()
+        if cached_tape_info is not None and not args.force_tape_detection:
+            # Prepare renderer while printer is being discovered and initialized
+            renderer.start_warm_up(cached_tape_info, [template])
+        label_params = self.__get_label_params(args, template, data)
+        # Load printer data
+        printer, tape_info = self._init_printer(args)
+        # Next labels are rendered and encoded while the current one is being printed
+        stages = _PrintStages(self, args, template, renderer, printer, tape_info)
+        pipeline = Pipeline([("render", stages.render), ("encode", stages.encode), ("send", stages.send)], name="print")
+        labels = (_PrintTask(i + 1, params, False) for i, params in enumerate(label_params))
+        # Timed renders must not fork this process once pipeline threads are started
+        with renderer.render_worker():
+            for _ in pipeline.run(labels):
+                pass
+
+
+class ExportExtension(BaseCliExtension):
+    COMMAND_NAME = "export"
+    COMMAND_DESCRIPTION = "Renders given data and saves all labels into a single file (pdf, png sheet or zip archive)"
+
+    @classmethod
+    def setup_parser(cls, parser: argparse.ArgumentParser):
+        parser.add_argument("-o", "--output", action="store", type=Path, required=True, help="Output file")
+        parser.add_argument(
+            "-F",
+            "--format",
+            action=EnumAction,
+            type=ExportFormat,  # type: ignore
+            default=None,
+            help="Output format. By default it is derived from the output file extension (.pdf, .png, .zip)",
+        )
+        parser.add_argument(
+            "-j",
+            "--jobs",
+            action="store",
+            type=int,
+            default=1,
+            help="Number of processes rendering labels in parallel",
+        )
+        parser.add_argument(
+            "--columns",
+            action="store",
+            type=int,
+            default=DEFAULT_SHEET_COLUMNS,
+            help="Number of labels in a row of png sheet",
+        )
+        parser.add_argument("template", action="store", type=str, help="Template to use")
+        parser.add_argument(
+            "data", nargs="*", action="store", type=str, help="Data to be rendered (will be passed into template)"
+        )
+
+    def handle(self, args: argparse.Namespace):
+        from tapen.renderer.export import create_export_writer, export_bitmaps, render_bitmaps
+
+        self.init(args)
+        export_format = args.format or ExportFormat.from_path(args.output)
+        template_name, data = self.split_template_and_data(args.template, args.data)
+        template = self.template_library.load_template(template_name)
+        if len(data) > 0:
+            label_params = self.validate_label_params(template, [dict(default=x) for x in data])
+        else:
+            label_params = [dict(default=None)]
+        tape_info = self.resolve_tape_info()
+        renderer = self.get_renderer_for_template(template)
+        print_jobs = (PrintJob(template, x) for x in label_params)
+        kwargs = dict(columns=args.columns) if export_format == ExportFormat.SHEET else {}
+        writer = create_export_writer(args.output, export_format, **kwargs)
+        count = export_bitmaps(render_bitmaps(renderer, print_jobs, tape_info, args.jobs), writer)
+        CLI.print_info("Exported {} label(s) into {}".format(count, args.output))
+
+
+class PreviewExtension(BaseCliExtension):
+    COMMAND_NAME = "preview"
+    COMMAND_DESCRIPTION = "Renders label into png file. In watch mode label is re-rendered on every template change"
+
+    @classmethod
+    def setup_parser(cls, parser: argparse.ArgumentParser):
+        parser.add_argument(
+            "-o",
+            "--output",
+            action="store",
+            type=Path,
+            default=None,
+            help="Output png file. Defaults to preview.png in cache directory",
+        )
+        parser.add_argument(
+            "-w",
+            "--watch",
+            action="store_true",
+            default=False,
+            help="Keeps running and re-renders preview whenever template files are changed",
+        )
+        parser.add_argument(
+            "template", action="store", type=str, help="Template to use (either lib:name or path to template dir)"
+        )
+        parser.add_argument(
+            "data", nargs="*", action="store", type=str, help="Data to be rendered (will be passed into template)"
+        )
+
+    def __resolve_template_dir(self, template_name: str) -> Optional[Path]:
+        path = Path(template_name)
+        if path.is_dir():
+            return path
+        if ":" in template_name:
+            return self.template_library.get_template_source_dir(template_name)
+        return None
+
+    def __render_preview(self, template: Template, data: List[str], tape_info: TapeInfo, output: Path):
+        from tapen.renderer.export import ContactSheetWriter, export_bitmaps
+
+        start_time = time.perf_counter()
+        renderer = self.get_renderer_for_template(template)
+        values: List[Optional[str]] = list(data) if len(data) > 0 else [None]
+        bitmaps = [renderer.render_bitmap(PrintJob(template, dict(default=x)), tape_info) for x in values]
+        # Written via temp file so image viewer never picks up partially written image
+        tmp_output = output.with_name("." + output.name + ".tmp")
+        if len(bitmaps) == 1:
+            bitmaps[0].save(tmp_output, format="png")
+        else:
+            export_bitmaps(bitmaps, ContactSheetWriter(tmp_output, columns=1))
+        os.replace(tmp_output, output)
+        CLI.print_info("Preview saved at {} ({:.0f}ms)".format(output, (time.perf_counter() - start_time) * 1000))
+
+    def __watch(self, template_dir: Path, template_name: str, data: List[str], tape_info: TapeInfo, output: Path):
+        CLI.print_info("Watching {} for changes. Press Ctrl+C to stop".format(template_dir))
+        with create_watcher(template_dir) as watcher:
+            while True:
+                changes = watcher.wait_for_changes()
+                LOGGER.debug("Changed files: {}".format(", ".join(map(str, changes))))
+                try:
+                    template = self.template_library.load_template_from_dir(template_dir, template_name)
+                    self.__render_preview(template, data, tape_info, output)
+                except Exception as e:
+                    CLI.print_error(e)
+
+    def handle(self, args: argparse.Namespace):
+        self.init(args)
+        output = args.output or Path(config.app_dirs.user_cache_dir) / "preview.png"
+        template_dir = self.__resolve_template_dir(args.template)
+        if template_dir is not None:
+            template_name = args.template if ":" in args.template else template_dir.name
+            data = args.data
+            template = self.template_library.load_template_from_dir(template_dir, template_name)
+        else:
+            template_name, data = self.split_template_and_data(args.template, args.data)
+            template = self.template_library.load_template(template_name)
+        tape_info = self.resolve_tape_info()
+        try:
+            self.__render_preview(template, data, tape_info, output)
+        except Exception as e:
+            if not args.watch:
+                raise
+            CLI.print_error(e)
+        if args.watch:
+            if template_dir is None:
+                CLI.fail("Watch mode is available for templates from local libraries only", 3)
+            try:
+                self.__watch(none_throws(template_dir), template_name, data, tape_info, output)
+            except KeyboardInterrupt:
+                pass
+
+
+class ServeExtension(BaseCliExtension):
+    COMMAND_NAME = "serve"
+    COMMAND_DESCRIPTION = (
+        "Runs daemon which keeps libraries, renderers and printer ready. Print jobs are forwarded to it automatically"
+    )
+
+    @classmethod
+    def setup_parser(cls, parser: argparse.ArgumentParser):
+        from tapen.daemon import DEFAULT_SOCKET_PATH
+
+        parser.add_argument(
+            "--socket", action="store", type=Path, default=DEFAULT_SOCKET_PATH, help="Unix socket to listen on"
+        )
+
+    def handle(self, args: argparse.Namespace):
+        from tapen.daemon import DaemonServer
+
+        print_ext = PrintExtension()
+        print_ext.init(args)
+        print_ext.keep_printer = True
+        self.__warm_up(print_ext)
+
+        def handle_job(request: Dict[str, Any]) -> int:
+            print_ext.refresh_template_library()
+            try:
+                print_ext.run(PrintExtension.args_from_job(request["args"]))
+            except Exception:
+                # Printer might have been disconnected, it will be discovered again for the next job
+                print_ext.release_printer()
+                raise
+            return 0
+
+        config_location = _resolve_config_location(args)
+
+        def accepts(request: Dict[str, Any]) -> bool:
+            return request.get("command") == PrintExtension.COMMAND_NAME and request.get("config") == config_location
+
+        server = DaemonServer(args.socket, handle_job, CLI.ui_logger, accepts)
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        CLI.print_info("Listening on {}. Press Ctrl+C to stop".format(args.socket))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+    @classmethod
+    def __warm_up(cls, print_ext: "PrintExtension"):
+        tape_info = print_ext.get_cached_tape_info()
+        if tape_info is None:
+            CLI.print_warn("Tape information is not available in cache, renderers are not warmed up")
+            return
+        renderers: Dict[int, Tuple["Renderer", List[Template]]] = {}
+        for locator in print_ext.template_library.list_templates():
+            try:
+                template = print_ext.template_library.load_template(locator)
+            except Exception as e:
+                LOGGER.warning("Unable to load template {}: {}".format(locator, e))
+                continue
+            renderer = print_ext.get_renderer_for_template(template)
+            renderers.setdefault(id(renderer), (renderer, []))[1].append(template)
+        for renderer, templates in renderers.values():
+            renderer.start_warm_up(tape_info, templates)
+        printer = print_ext.get_printer()
+        CLI.print_info("Printer: {}".format(printer if printer is not None else "not connected"))
 
 
 class TppExtension(GlobalArgsExtension):
@@ -297,6 +960,9 @@ def main(argv: List[str]):
     app_manager.register_global_args_extension()
     app_manager.register_extension(ImportLibExtension)
     app_manager.register_extension(PrintExtension)
+    app_manager.register_extension(ExportExtension)
+    app_manager.register_extension(PreviewExtension)
+    app_manager.register_extension(ServeExtension)
     app_manager.setup()
     try:
         # Parse arguments
@@ -0,0 +1,74 @@
+#
+# Tapen - software for managing label printers
+# Copyright (C) 2022 Dmitry Berezovsky
+#
+# Tapen is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tapen is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.#
+
+import threading
+from collections import OrderedDict
+from typing import Callable, Generic, Hashable, Optional, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+    """
+    Thread safe in-memory cache which keeps at most max_size entries evicting the least recently used ones
+    """
+
+    def __init__(self, max_size: int = 128) -> None:
+        super().__init__()
+        self.max_size = max_size
+        self.__data: "OrderedDict[K, V]" = OrderedDict()
+        self.__lock = threading.RLock()
+
+    def get(self, key: K, default: Optional[V] = None) -> Optional[V]:
+        with self.__lock:
+            if key not in self.__data:
+                return default
+            self.__data.move_to_end(key)
+            return self.__data[key]
+
+    def put(self, key: K, value: V) -> V:
+        with self.__lock:
+            self.__data[key] = value
+            self.__data.move_to_end(key)
+            while len(self.__data) > self.max_size:
+                self.__data.popitem(last=False)
+            return value
+
+    def get_or_create(self, key: K, factory: Callable[[], V]) -> V:
+        with self.__lock:
+            if key in self.__data:
+                self.__data.move_to_end(key)
+                return self.__data[key]
+        # Factory is invoked outside of the lock so the slow path doesn't block readers
+        return self.put(key, factory())
+
+    def invalidate(self, key: K):
+        with self.__lock:
+            self.__data.pop(key, None)
+
+    def clear(self):
+        with self.__lock:
+            self.__data.clear()
+
+    def __contains__(self, key: object) -> bool:
+        with self.__lock:
+            return key in self.__data
+
+    def __len__(self) -> int:
+        with self.__lock:
+            return len(self.__data)
@@ -0,0 +1,147 @@
+#
+# Tapen - software for managing label printers
+# Copyright (C) 2022 Dmitry Berezovsky
+#
+# Tapen is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tapen is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.#
+
+
+import csv
+import json
+import shutil
+import sys
+import tempfile
+from enum import Enum
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, Optional, TextIO, Tuple, TypeVar
+
+T = TypeVar("T")
+
+
+class DatasetFormat(Enum):
+    CSV = "csv"
+    TSV = "tsv"
+    JSONL = "jsonl"
+
+    @classmethod
+    def from_path(cls, path: Optional[Path]) -> "DatasetFormat":
+        if path is None:
+            return cls.CSV
+        suffix = path.suffix.lower()
+        if suffix in (".tsv", ".tab"):
+            return cls.TSV
+        if suffix in (".jsonl", ".ndjson"):
+            return cls.JSONL
+        return cls.CSV
+
+
+class DatasetError(ValueError):
+    pass
+
+
+class Dataset(object):
+    """
+    Label params read from CSV/TSV (with header) or JSON lines file. Rows are parsed lazily while iterating, so the
+    file is never loaded into memory. Columns are passed to template as params with the same name unless remapped
+    with column_map. Path None means stdin, it could be iterated only once unless buffered with buffer_stdin().
+    """
+
+    def __init__(
+        self, path: Optional[Path], data_format: DatasetFormat, column_map: Optional[Dict[str, str]] = None
+    ) -> None:
+        self.path = path
+        self.data_format = data_format
+        self.column_map = column_map or {}
+        self.__buffer: Optional[TextIO] = None
+
+    @property
+    def name(self) -> str:
+        return str(self.path) if self.path is not None else "<stdin>"
+
+    def buffer_stdin(self):
+        """
+        Copies stdin into anonymous temporary file, so that dataset could be iterated multiple times
+        """
+        buffer = tempfile.TemporaryFile("w+", encoding="utf-8", newline="")
+        shutil.copyfileobj(sys.stdin, buffer)
+        self.__buffer = buffer
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        if self.__buffer is not None:
+            self.__buffer.seek(0)
+            yield from self.__read(self.__buffer)
+            return
+        if self.path is None:
+            yield from self.__read(sys.stdin)
+            return
+        with open(self.path, "r", encoding="utf-8", newline="") as f:
+            yield from self.__read(f)
+
+    def __read(self, stream: TextIO) -> Iterator[Dict[str, Any]]:
+        rows = self.__read_jsonl(stream) if self.data_format == DatasetFormat.JSONL else self.__read_csv(stream)
+        if len(self.column_map) == 0:
+            yield from rows
+            return
+        for row in rows:
+            yield {self.column_map.get(k, k): v for k, v in row.items()}
+
+    def __read_csv(self, stream: TextIO) -> Iterator[Dict[str, Any]]:
+        delimiter = "\t" if self.data_format == DatasetFormat.TSV else ","
+        reader = csv.DictReader(stream, delimiter=delimiter)
+        for row in reader:
+            if None in row:
+                raise DatasetError(
+                    "{}, line {}: row has more fields than the header".format(self.name, reader.line_num)
+                )
+            # Fields missing in short rows are treated as not provided, so param defaults apply
+            yield {k: v for k, v in row.items() if v is not None}
+
+    def __read_jsonl(self, stream: TextIO) -> Iterator[Dict[str, Any]]:
+        for line_num, line in enumerate(stream, 1):
+            if len(line.strip()) == 0:
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                raise DatasetError("{}, line {}: {}".format(self.name, line_num, e)) from e
+            if not isinstance(row, dict):
+                raise DatasetError("{}, line {}: JSON object expected".format(self.name, line_num))
+            yield row
+
+
+def parse_column_map(mappings: Iterable[str]) -> Dict[str, str]:
+    """
+    Parses column mappings given in form COLUMN=PARAM
+    """
+    result = {}
+    for x in mappings:
+        column, sep, param = x.partition("=")
+        if not sep or not column or not param:
+            raise DatasetError('Invalid column mapping "{}". Expected COLUMN=PARAM'.format(x))
+        result[column] = param
+    return result
+
+
+def with_last_flag(items: Iterable[T]) -> Iterator[Tuple[T, bool]]:
+    """
+    Yields items along with the flag set for the last one. Works for streams of unknown length.
+    """
+    iterator = iter(items)
+    try:
+        current = next(iterator)
+    except StopIteration:
+        return
+    for x in iterator:
+        yield current, False
+        current = x
+    yield current, True
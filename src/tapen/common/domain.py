@@ -15,16 +15,65 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.#
 
+import hashlib
+import os
 from typing import Any, Dict, Optional
 
-from tapen import const
+from tapen import const, validate
 
 
 class Template:
-    def __init__(self, name: str, _dict: Dict[str, Any]) -> None:
+    def __init__(self, name: str, _dict: Dict[str, Any], path: Optional[str] = None) -> None:
         super().__init__()
         self.raw = _dict
         self.name = name
+        # Template directory. Used to resolve assets referenced by the template
+        self.path = path
+        self.__params_validator: Optional[validate.BulkParamsValidator] = None
+        self.__assets_stamp: Optional[str] = None
+
+    @property
+    def params(self) -> Dict[str, Dict[str, Any]]:
+        return self.raw.get(const.MF_PARAMS, None) or {}
+
+    @property
+    def params_validator(self) -> validate.BulkParamsValidator:
+        """
+        Validator for the whole dataset of label params. It is built once per template.
+        """
+        if self.__params_validator is None:
+            self.__params_validator = validate.BulkParamsValidator(validate.bind_validators(self.params))
+        return self.__params_validator
+
+    @property
+    def assets_stamp(self) -> str:
+        """
+        Digest of names, sizes and modification times of the files in template directory. It is computed once per
+        loaded template, so assets modified in place are taken into account once template is loaded again.
+        """
+        if self.__assets_stamp is None:
+            digest = hashlib.sha1()
+            if self.path is not None:
+                for root, dirs, files in os.walk(self.path):
+                    dirs.sort()
+                    for name in sorted(files):
+                        file_path = os.path.join(root, name)
+                        try:
+                            stat = os.stat(file_path)
+                        except OSError:
+                            continue
+                        entry = "{}:{}:{}\n".format(
+                            os.path.relpath(file_path, self.path), stat.st_size, stat.st_mtime_ns
+                        )
+                        digest.update(entry.encode("utf-8"))
+            self.__assets_stamp = digest.hexdigest()
+        return self.__assets_stamp
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Compiled validators might be closures which can't be pickled, they are rebuilt on demand
+        state["_Template__params_validator"] = None
+        return state
 
     @property
     def layout_template(self) -> str:
@@ -34,6 +83,22 @@ class Template:
     def layout_css(self) -> Optional[str]:
         return self.raw[const.MF_LAYOUT].get(const.MF_CSS, None)
 
+    @property
+    def renderer(self) -> str:
+        return self.raw[const.MF_LAYOUT].get(const.MF_RENDERER, const.RENDERER_WEASYPRINT)
+
+    @property
+    def slots(self) -> Dict[str, str]:
+        return self.raw[const.MF_LAYOUT].get(const.MF_SLOTS, None) or {}
+
+    @property
+    def fit_width_mm(self) -> Optional[float]:
+        return self.raw[const.MF_LAYOUT].get(const.MF_FIT_WIDTH, None)
+
+    @property
+    def font(self) -> Optional[str]:
+        return self.raw[const.MF_LAYOUT].get(const.MF_FONT, None)
+
 
 class PrintJob(object):
     def __init__(self, template: Template, params: Dict[str, Any], cut_tape=True) -> None:
@@ -0,0 +1,114 @@
+#
+# Tapen - software for managing label printers
+# Copyright (C) 2022 Dmitry Berezovsky
+#
+# Tapen is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tapen is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.#
+
+
+import queue
+import threading
+from typing import Any, Callable, Iterable, Iterator, List, Sequence, Tuple
+
+DEFAULT_QUEUE_SIZE = 2
+# How often threads blocked on a queue check whether pipeline was cancelled
+POLL_INTERVAL_SEC = 0.1
+
+# Stage transforms stream of items, so that it could drop items or hold them back until the next one is processed
+Stage = Tuple[str, Callable[[Iterator[Any]], Iterable[Any]]]
+
+_END = object()
+
+
+class _Failure(object):
+    def __init__(self, error: BaseException) -> None:
+        self.error = error
+
+
+class Pipeline(object):
+    """
+    Runs a sequence of stages concurrently, every stage in its own thread, connected with bounded queues. A stage
+    blocks once the next one falls behind, so the slowest stage throttles the others and throughput is limited by it
+    rather than by the sum of all stages. At most queue_size items are buffered between two stages whatever the number
+    of items is.
+    Every stage is a generator consuming items produced by the previous one, e.g. (fn(x) for x in items). Items are
+    processed in order. The first error stops the pipeline once the items which precede it are processed and is
+    re-raised by run().
+    """
+
+    def __init__(self, stages: Sequence[Stage], queue_size=DEFAULT_QUEUE_SIZE, name="pipeline") -> None:
+        if len(stages) == 0:
+            raise ValueError("Pipeline must have at least one stage")
+        self.stages = list(stages)
+        self.queue_size = queue_size
+        self.name = name
+
+    def run(self, items: Iterable[Any]) -> Iterator[Any]:
+        """
+        Passes items through the stages and yields results of the last one. The last stage is executed in the calling
+        thread, so it could use resources bound to it (e.g. device handle).
+        """
+        cancelled = threading.Event()
+        queues: List[queue.Queue] = [queue.Queue(maxsize=self.queue_size) for _ in self.stages[:-1]]
+        inputs = [iter(items)] + [self.__drain(x, cancelled) for x in queues]
+        threads = [
+            threading.Thread(
+                target=self.__run_stage,
+                args=(stage, inputs[i], queues[i], cancelled),
+                name="{}-{}".format(self.name, stage[0]),
+                daemon=True,
+            )
+            for i, stage in enumerate(self.stages[:-1])
+        ]
+        for x in threads:
+            x.start()
+        try:
+            yield from self.stages[-1][1](inputs[-1])
+        finally:
+            cancelled.set()
+            for x in threads:
+                x.join()
+
+    @classmethod
+    def __run_stage(cls, stage: Stage, source: Iterator[Any], output: queue.Queue, cancelled: threading.Event):
+        try:
+            for item in stage[1](source):
+                if not cls.__put(output, item, cancelled):
+                    return
+            cls.__put(output, _END, cancelled)
+        except BaseException as e:
+            # Also covers SystemExit, so that exit() called by the stage terminates the caller
+            cls.__put(output, _Failure(e), cancelled)
+
+    @staticmethod
+    def __put(output: queue.Queue, item: Any, cancelled: threading.Event) -> bool:
+        while not cancelled.is_set():
+            try:
+                output.put(item, timeout=POLL_INTERVAL_SEC)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    @staticmethod
+    def __drain(source: queue.Queue, cancelled: threading.Event) -> Iterator[Any]:
+        while not cancelled.is_set():
+            try:
+                item = source.get(timeout=POLL_INTERVAL_SEC)
+            except queue.Empty:
+                continue
+            if item is _END:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
@@ -0,0 +1,193 @@
+#
+# Tapen - software for managing label printers
+# Copyright (C) 2022 Dmitry Berezovsky
+#
+# Tapen is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tapen is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.#
+
+import contextlib
+import json
+import os
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional
+
+
+class ProfileRecord(NamedTuple):
+    name: str
+    category: str
+    start_ns: int
+    wall_ns: int
+    cpu_ns: int
+    allocated_bytes: int
+    thread_id: int
+    label: Optional[int]
+    args: Dict[str, Any]
+
+
+class StageSummary(NamedTuple):
+    name: str
+    calls: int
+    wall_total_ms: float
+    wall_max_ms: float
+    cpu_total_ms: float
+    allocated_kb: float
+
+
+class Profiler(object):
+    """
+    Records wall time, CPU time (of the current thread) and optionally net allocated memory of the named spans. Spans
+    could be nested. Result is available as Chrome trace (chrome://tracing, Perfetto) and as a summary table.
+    Memory tracing is off by default: tracemalloc slows down every allocation, which inflates wall times, and it
+    counts allocations of the whole process, so spans running concurrently (e.g. print pipeline stages) are attributed
+    each other's allocations.
+    """
+
+    def __init__(self, trace_memory=False) -> None:
+        self.records: List[ProfileRecord] = []
+        self.trace_memory = trace_memory
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+        self.__origin_ns = time.perf_counter_ns()
+        self.__started_tracemalloc = False
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.__started_tracemalloc = True
+
+    @property
+    def current_label(self) -> Optional[int]:
+        return getattr(self.__local, "label", None)
+
+    @current_label.setter
+    def current_label(self, label_num: Optional[int]):
+        self.__local.label = label_num
+
+    def stop(self):
+        if self.__started_tracemalloc:
+            tracemalloc.stop()
+            self.__started_tracemalloc = False
+
+    def __allocated(self) -> int:
+        return tracemalloc.get_traced_memory()[0] if self.trace_memory and tracemalloc.is_tracing() else 0
+
+    @contextlib.contextmanager
+    def span(self, name: str, category="tapen", **kwargs) -> Iterator[None]:
+        start_ns, start_cpu_ns, start_allocated = time.perf_counter_ns(), time.thread_time_ns(), self.__allocated()
+        try:
+            yield
+        finally:
+            record = ProfileRecord(
+                name=name,
+                category=category,
+                start_ns=start_ns - self.__origin_ns,
+                wall_ns=time.perf_counter_ns() - start_ns,
+                cpu_ns=time.thread_time_ns() - start_cpu_ns,
+                allocated_bytes=self.__allocated() - start_allocated,
+                thread_id=threading.get_ident(),
+                label=self.current_label,
+                args=kwargs,
+            )
+            with self.__lock:
+                self.records.append(record)
+
+    @contextlib.contextmanager
+    def label(self, label_num: int, **kwargs) -> Iterator[None]:
+        """
+        Span covering all the work related to a single label, nested spans are attributed to this label
+        """
+        previous_label = self.current_label
+        self.current_label = label_num
+        try:
+            with self.span("label", "label", **kwargs):
+                yield
+        finally:
+            self.current_label = previous_label
+
+    def to_chrome_trace(self) -> Dict[str, Any]:
+        events: List[Dict[str, Any]] = []
+        pid = os.getpid()
+        for x in self.records:
+            args = dict(x.args, cpu_ms=round(x.cpu_ns / 1e6, 3))
+            if self.trace_memory:
+                args["allocated_kb"] = round(x.allocated_bytes / 1024, 1)
+            if x.label is not None:
+                args["label"] = x.label
+            events.append(
+                dict(
+                    name=x.name,
+                    cat=x.category,
+                    ph="X",
+                    ts=x.start_ns / 1000,
+                    dur=x.wall_ns / 1000,
+                    pid=pid,
+                    tid=x.thread_id,
+                    args=args,
+                )
+            )
+        events.sort(key=lambda e: e["ts"])
+        return dict(traceEvents=events, displayTimeUnit="ms")
+
+    def write_chrome_trace(self, path: Path):
+        with open(path, "w") as f:
+            json.dump(self.to_chrome_trace(), f)
+
+    def summary(self) -> List[StageSummary]:
+        groups: Dict[str, List[ProfileRecord]] = {}
+        for x in self.records:
+            groups.setdefault(x.name, []).append(x)
+        result = [
+            StageSummary(
+                name=name,
+                calls=len(records),
+                wall_total_ms=sum(x.wall_ns for x in records) / 1e6,
+                wall_max_ms=max(x.wall_ns for x in records) / 1e6,
+                cpu_total_ms=sum(x.cpu_ns for x in records) / 1e6,
+                allocated_kb=sum(x.allocated_bytes for x in records) / 1024,
+            )
+            for name, records in groups.items()
+        ]
+        result.sort(key=lambda x: x.wall_total_ms, reverse=True)
+        return result
+
+    def format_summary(self) -> str:
+        header = "{:<24} {:>7} {:>12} {:>12} {:>12} {:>12}".format(
+            "Stage", "Count", "Wall ms", "Mean ms", "Max ms", "CPU ms"
+        )
+        if self.trace_memory:
+            header += " {:>12}".format("Alloc KB")
+        lines = [header, "-" * len(header)]
+        for x in self.summary():
+            line = "{:<24} {:>7} {:>12.1f} {:>12.2f} {:>12.1f} {:>12.1f}".format(
+                x.name, x.calls, x.wall_total_ms, x.wall_total_ms / x.calls, x.wall_max_ms, x.cpu_total_ms
+            )
+            if self.trace_memory:
+                line += " {:>12.1f}".format(x.allocated_kb)
+            lines.append(line)
+        return "\n".join(lines)
+
+
+def profile_span(profiler: Optional[Profiler], name: str, category="tapen", **kwargs):
+    """
+    Returns profiler span or no-op context manager when profiling is disabled
+    """
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.span(name, category, **kwargs)
+
+
+def profile_label(profiler: Optional[Profiler], label_num: int, **kwargs):
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.label(label_num, **kwargs)
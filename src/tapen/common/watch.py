@@ -0,0 +1,177 @@
+#
+# Tapen - software for managing label printers
+# Copyright (C) 2022 Dmitry Berezovsky
+#
+# Tapen is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tapen is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.#
+
+import abc
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import time
+from pathlib import Path
+from typing import Dict, Optional, Set, Tuple
+
+LOGGER = logging.getLogger("watch")
+
+# Time to wait for the related events after the first one (editors tend to write file in several steps)
+DEFAULT_DEBOUNCE_SEC = 0.05
+DEFAULT_POLL_INTERVAL_SEC = 0.25
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+INOTIFY_EVENT_HEADER = struct.Struct("iIII")
+
+
+class DirectoryWatcher(abc.ABC):
+    """
+    Watches directory tree for file changes
+    """
+
+    def __init__(self, root: Path, debounce_sec=DEFAULT_DEBOUNCE_SEC) -> None:
+        self.root = root
+        self.debounce_sec = debounce_sec
+
+    @abc.abstractmethod
+    def _poll(self, timeout: Optional[float]) -> Set[Path]:
+        pass
+
+    def wait_for_changes(self, timeout: Optional[float] = None) -> Set[Path]:
+        """
+        Blocks until at least one file is changed (or timeout expires) and returns paths of the changed files
+        """
+        changes = self._poll(timeout)
+        if len(changes) > 0 and self.debounce_sec > 0:
+            while True:
+                more_changes = self._poll(self.debounce_sec)
+                if len(more_changes) == 0:
+                    break
+                changes |= more_changes
+        return changes
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class InotifyWatcher(DirectoryWatcher):
+    """
+    Linux only watcher which gets notified by kernel. Subdirectories created after start are watched as well.
+    """
+
+    def __init__(self, root: Path, debounce_sec=DEFAULT_DEBOUNCE_SEC) -> None:
+        super().__init__(root, debounce_sec)
+        self.__libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.__fd = self.__libc.inotify_init1(os.O_CLOEXEC)
+        if self.__fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.__watches: Dict[int, Path] = {}
+        for dir_path, _, _ in os.walk(root):
+            self.__add_watch(Path(dir_path))
+
+    def __add_watch(self, path: Path):
+        wd = self.__libc.inotify_add_watch(self.__fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            LOGGER.warning("Unable to watch {}: {}".format(path, os.strerror(ctypes.get_errno())))
+            return
+        self.__watches[wd] = path
+
+    def _poll(self, timeout: Optional[float]) -> Set[Path]:
+        readable, _, _ = select.select([self.__fd], [], [], timeout)
+        if len(readable) == 0:
+            return set()
+        buffer = os.read(self.__fd, 64 * 1024)
+        changes: Set[Path] = set()
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, name_len = INOTIFY_EVENT_HEADER.unpack_from(buffer, offset)
+            offset += INOTIFY_EVENT_HEADER.size
+            name = buffer[offset : offset + name_len].rstrip(b"\0")
+            offset += name_len
+            if wd not in self.__watches:
+                continue
+            path = self.__watches[wd] / os.fsdecode(name)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self.__add_watch(path)
+            changes.add(path)
+        return changes
+
+    def close(self):
+        if self.__fd >= 0:
+            os.close(self.__fd)
+            self.__fd = -1
+
+
+class PollingWatcher(DirectoryWatcher):
+    """
+    Portable watcher comparing modification times of all files in the tree
+    """
+
+    def __init__(
+        self, root: Path, debounce_sec=DEFAULT_DEBOUNCE_SEC, poll_interval_sec=DEFAULT_POLL_INTERVAL_SEC
+    ) -> None:
+        super().__init__(root, debounce_sec)
+        self.poll_interval_sec = poll_interval_sec
+        self.__snapshot = self.__take_snapshot()
+
+    def __take_snapshot(self) -> Dict[Path, Tuple[int, int]]:
+        result = {}
+        for dir_path, _, files in os.walk(self.root):
+            for file in files:
+                path = Path(dir_path) / file
+                try:
+                    stat = path.stat()
+                except OSError:
+                    continue
+                result[path] = (stat.st_mtime_ns, stat.st_size)
+        return result
+
+    def _poll(self, timeout: Optional[float]) -> Set[Path]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            snapshot = self.__take_snapshot()
+            changes = {x for x in snapshot.keys() | self.__snapshot.keys() if snapshot.get(x) != self.__snapshot.get(x)}
+            self.__snapshot = snapshot
+            if len(changes) > 0:
+                return changes
+            if deadline is not None and time.monotonic() >= deadline:
+                return set()
+            sleep_time = self.poll_interval_sec
+            if deadline is not None:
+                sleep_time = min(sleep_time, max(0.0, deadline - time.monotonic()))
+            time.sleep(sleep_time)
+
+
+def create_watcher(root: Path, debounce_sec=DEFAULT_DEBOUNCE_SEC) -> DirectoryWatcher:
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(root, debounce_sec)
+        except (OSError, AttributeError) as e:
+            LOGGER.debug("inotify is not available ({}), falling back to polling".format(e))
+    return PollingWatcher(root, debounce_sec)
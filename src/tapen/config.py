@@ -40,7 +40,29 @@ LIBRARIES_SCHEMA = crv.Schema(
     )
 )
 
-CONFIG_SCHEMA = crv.Schema({crv.Required(const.CONF_LIBRARIES, default=[]): LIBRARIES_SCHEMA})
+DEFAULT_BITMAP_CACHE_SIZE_MB = 64
+
+CACHE_SCHEMA = crv.Schema(
+    {
+        # Set to 0 to disable rendered bitmaps caching
+        crv.Optional(const.CONF_BITMAP_CACHE_SIZE, default=DEFAULT_BITMAP_CACHE_SIZE_MB): crv.positive_int,
+    }
+)
+
+RENDER_SCHEMA = crv.Schema(
+    {
+        # Max time given to render a single label. Set to 0 to disable the limit
+        crv.Optional(const.CONF_RENDER_TIMEOUT, default=0): crv.positive_float,
+    }
+)
+
+CONFIG_SCHEMA = crv.Schema(
+    {
+        crv.Required(const.CONF_LIBRARIES, default=[]): LIBRARIES_SCHEMA,
+        crv.Optional(const.CONF_CACHE, default={}): CACHE_SCHEMA,
+        crv.Optional(const.CONF_RENDER, default={}): RENDER_SCHEMA,
+    }
+)
 
 DEFAULT_CONFIG: Dict[str, Any] = {}
 DEFAULT_CONFIG_FILE_NAME = "conf.yaml"
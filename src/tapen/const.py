@@ -18,6 +18,10 @@
 CONF_NAME = "name"
 CONF_URL = "url"
 CONF_LIBRARIES = "libraries"
+CONF_CACHE = "cache"
+CONF_BITMAP_CACHE_SIZE = "bitmap_cache_size_mb"
+CONF_RENDER = "render"
+CONF_RENDER_TIMEOUT = "timeout_sec"
 
 C_DEFAULT = "default"
 C_REQUIRED = "required"
@@ -36,3 +40,10 @@ MF_PARAMS = "params"
 MF_LAYOUT = "layout"
 MF_TEMPLATE = "template"
 MF_CSS = "css"
+MF_RENDERER = "renderer"
+MF_FONT = "font"
+MF_SLOTS = "slots"
+MF_FIT_WIDTH = "fit_width"
+
+RENDERER_WEASYPRINT = "weasyprint"
+RENDERER_TEXT = "text"
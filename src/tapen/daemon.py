@@ -0,0 +1,191 @@
+#
+# Tapen - software for managing label printers
+# Copyright (C) 2022 Dmitry Berezovsky
+#
+# Tapen is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tapen is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.#
+
+
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional
+
+from tapen import config
+
+LOGGER = logging.getLogger("daemon")
+
+PROTOCOL_VERSION = 1
+DEFAULT_SOCKET_PATH = Path(os.environ.get("XDG_RUNTIME_DIR") or config.app_dirs.user_cache_dir) / "tapen.sock"
+CONNECT_TIMEOUT_SEC = 0.5
+
+MSG_LOG = "log"
+MSG_EXIT = "exit"
+MSG_UNSUPPORTED = "unsupported"
+
+# Handles request, returns exit code
+RequestHandler = Callable[[Dict[str, Any]], int]
+
+
+class _ForwardingLogHandler(logging.Handler):
+    """
+    Sends log records to the client as they appear
+    """
+
+    def __init__(self, send: Callable[[Dict[str, Any]], None]) -> None:
+        super().__init__()
+        self.send = send
+
+    def emit(self, record: logging.LogRecord):
+        if record.exc_info is not None and isinstance(record.msg, Exception):
+            message = str(record.msg)
+        else:
+            message = record.getMessage()
+        try:
+            self.send(dict(type=MSG_LOG, level=record.levelno, message=message))
+        except OSError:
+            pass  # Client has gone, job is still completed
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    server: "DaemonServer"
+
+    def send(self, message: Dict[str, Any]):
+        self.wfile.write((json.dumps(message) + "\n").encode("utf-8"))
+        self.wfile.flush()
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            request = json.loads(line)
+        except ValueError:
+            LOGGER.warning("Malformed request received")
+            return
+        if request.get("version") != PROTOCOL_VERSION or not self.server.accepts(request):
+            self.send(dict(type=MSG_UNSUPPORTED))
+            return
+        self.send(dict(type=MSG_EXIT, code=self.server.process(request, self.send)))
+
+
+class DaemonServer(socketserver.UnixStreamServer):
+    """
+    Accepts jobs over local unix socket. Requests are newline delimited json objects, the response is a stream of
+    log messages followed by the exit code. Jobs are executed one at a time, output sent through ui_logger during
+    the job is forwarded to the client.
+    """
+
+    def __init__(
+        self,
+        socket_path: Path,
+        handler: RequestHandler,
+        ui_logger: logging.Logger,
+        accepts: Optional[Callable[[Dict[str, Any]], bool]] = None,
+    ) -> None:
+        self.socket_path = socket_path
+        self.handler = handler
+        self.ui_logger = ui_logger
+        self.__accepts = accepts
+        self.__lock = threading.Lock()
+        if socket_path.exists():
+            if is_daemon_running(socket_path):
+                raise RuntimeError("Daemon is already running at {}".format(socket_path))
+            socket_path.unlink()  # Stale socket left by crashed daemon
+        socket_path.parent.mkdir(parents=True, exist_ok=True)
+        super().__init__(str(socket_path), _RequestHandler)
+
+    def server_bind(self):
+        # Socket permissions are derived from umask at bind time, so other users can't connect even for a moment
+        old_umask = os.umask(0o177)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(old_umask)
+
+    def accepts(self, request: Dict[str, Any]) -> bool:
+        return self.__accepts is None or self.__accepts(request)
+
+    def process(self, request: Dict[str, Any], send: Callable[[Dict[str, Any]], None]) -> int:
+        with self.__lock:
+            log_handler = _ForwardingLogHandler(send)
+            self.ui_logger.addHandler(log_handler)
+            try:
+                return self.handler(request)
+            except SystemExit as e:
+                return e.code if isinstance(e.code, int) else 1
+            except Exception as e:
+                LOGGER.exception("Job failed")
+                self.ui_logger.error(e, exc_info=True)
+                return 1
+            finally:
+                self.ui_logger.removeHandler(log_handler)
+
+    def server_close(self):
+        super().server_close()
+        try:
+            self.socket_path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def is_daemon_running(socket_path: Path = DEFAULT_SOCKET_PATH) -> bool:
+    if not socket_path.exists():
+        return False
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.settimeout(CONNECT_TIMEOUT_SEC)
+            s.connect(str(socket_path))
+        return True
+    except OSError:
+        return False
+
+
+def submit_job(
+    request: Dict[str, Any], ui_logger: logging.Logger, socket_path: Path = DEFAULT_SOCKET_PATH
+) -> Optional[int]:
+    """
+    Sends job to the daemon and replays its output through ui_logger. Returns exit code or None if daemon is not
+    running or can't execute the job, in this case the job should be executed in process.
+    """
+    if not socket_path.exists():
+        return None
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.settimeout(CONNECT_TIMEOUT_SEC)
+        try:
+            s.connect(str(socket_path))
+        except OSError as e:
+            LOGGER.debug("Daemon is not available: {}".format(e))
+            return None
+        # Rendering and printing might take a while
+        s.settimeout(None)
+        request = dict(request, version=PROTOCOL_VERSION)
+        s.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        with s.makefile("rb") as f:
+            for line in f:
+                message = json.loads(line)
+                if message["type"] == MSG_LOG:
+                    ui_logger.log(message["level"], message["message"])
+                elif message["type"] == MSG_EXIT:
+                    return message["code"]
+                elif message["type"] == MSG_UNSUPPORTED:
+                    LOGGER.debug("Daemon refused the job, running in process")
+                    return None
+        raise ConnectionError("Daemon closed connection before the job was completed")
+    finally:
+        s.close()
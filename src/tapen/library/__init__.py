@@ -16,22 +16,39 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.#
 
 import datetime
+import logging
 import os
 from pathlib import Path
-from typing import Any, Dict, List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
 
-from cli_rack.loader import DefaultLoaderRegistry, LoadedDataMeta, InvalidPackageStructure, LoaderRegistry
+from cli_rack.loader import (
+    DefaultLoaderRegistry,
+    GithubLoader,
+    LoadedDataMeta,
+    InvalidPackageStructure,
+    LoaderError,
+    LoaderRegistry,
+    LocalLocatorDef,
+)
 from cli_rack.utils import ensure_dir
 
 from tapen import config, const, validate
 from tapen.common.domain import Template
-from tapen.library.loader import LibraryLoader
-from tapen.utils import yaml_file_to_dict
+from tapen.library.cache import ManifestCache
+from tapen.library.index import IndexState, LibraryIndex
+from tapen.library.loader import LibraryLoader, LocalLibraryLoader
+from tapen.utils import yaml_to_dict
 from cli_rack_validation import crv
 
 MANIFEST_FILE_NAME = "manifest.yaml"
 STANDARD_LIB_NAME = "std"
 STANDARD_LIB_PATH = Path(__file__).parent.parent / "resources" / "std-lib"
+LIBRARY_INDEX_FILE = Path(config.app_dirs.user_cache_dir) / "library-index.json"
+MANIFEST_CACHE_DIR = Path(config.app_dirs.user_cache_dir) / "manifest-cache"
+DEFAULT_FETCH_WORKERS = 4
+
+LOGGER = logging.getLogger("library")
 
 MANIFEST_META_SCHEMA = crv.Schema(
     {
@@ -46,22 +63,39 @@ MANIFEST_LAYOUT_SCHEMA = crv.Schema(
     {
         crv.Required(const.MF_TEMPLATE): crv.string_strict,
         crv.Optional(const.MF_CSS): crv.string,
+        crv.Optional(const.MF_RENDERER): crv.one_of(const.RENDERER_WEASYPRINT, const.RENDERER_TEXT),
+        crv.Optional(const.MF_FONT): crv.string_strict,
+        crv.Optional(const.MF_SLOTS): {validate.valid_param_name: crv.string_strict},
+        # Fixed label length in mm, font is shrunk to fit the content
+        crv.Optional(const.MF_FIT_WIDTH): crv.positive_float,
     }
 )
 
 MANIFEST_SCHEMA = crv.Schema(
     {
         crv.Required(const.MF_META_SECTION, default={}): MANIFEST_META_SCHEMA,
-        crv.Required(const.MF_PARAMS, default={}): validate.valid_object_def,
+        # Validators are kept as definitions, so validated manifest could be cached. See Template.params_validator and validate.bind_validators
+        crv.Required(const.MF_PARAMS, default={}): validate.normalized_object_def,
         crv.Required(const.MF_LAYOUT): MANIFEST_LAYOUT_SCHEMA,
     }
 )
 
 
+def parse_manifest(content: bytes, manifest_file: str) -> Dict[str, Any]:
+    return MANIFEST_SCHEMA(yaml_to_dict(content))
+
+
 class TemplateLibrary(object):
-    def __init__(self, library_config: Dict[str, Any], always_reload_local_libs=False) -> None:
+    def __init__(
+        self, library_config: Dict[str, Any], always_reload_local_libs=False, fetch_workers=DEFAULT_FETCH_WORKERS
+    ) -> None:
         self.__lib_config: Dict[str, Any] = library_config
-        self.lib_loader = DefaultLoaderRegistry.clone()
+        self.fetch_workers = fetch_workers
+        self.fetch_errors: Dict[str, Exception] = {}
+        self.lib_loader = LoaderRegistry()
+        # Local libraries are synced incrementally instead of being copied over on every reload
+        self.lib_loader.register(LocalLibraryLoader)
+        self.lib_loader.register(GithubLoader)
         self.lib_loader.target_dir = Path(config.app_dirs.user_data_dir) / "lib-cache"
         self.lib_root_dirs: List[str] = [""]
         local_loader = self.lib_loader.get_for_locator("local:nothing")
@@ -72,6 +106,8 @@ class TemplateLibrary(object):
         ensure_dir(str(self.loader.target_dir))
         self.libraries: Dict[str, LoadedDataMeta] = {}
         self.loader.register(LibraryLoader(self.libraries, self.loader, target_dir=self.loader.target_dir))
+        self.index = LibraryIndex(LIBRARY_INDEX_FILE, self.lib_loader)
+        self.manifest_cache = ManifestCache(parse_manifest, MANIFEST_CACHE_DIR)
 
     def _lib_dir_resolver(self, meta: LoadedDataMeta) -> str:
         for x in self.lib_root_dirs:
@@ -82,26 +118,103 @@ class TemplateLibrary(object):
         )
 
     def fetch_libraries(self):
+        """
+        Loads all configured libraries. Outdated libraries are fetched concurrently, failure of one library doesn't
+        affect the others, errors are collected in fetch_errors.
+        """
         self.libraries.clear()
-        self.add_library(STANDARD_LIB_NAME, "local:" + str(STANDARD_LIB_PATH))
-        for name, url in self.__lib_config.items():
-            self.add_library(name, url)
+        self.fetch_errors.clear()
+        libraries = {STANDARD_LIB_NAME: "local:" + str(STANDARD_LIB_PATH)}
+        libraries.update(self.__lib_config)
+        outdated: Dict[str, Tuple[str, bool]] = {}
+        for name, url in libraries.items():
+            state = self.__validate_index(name, url)
+            if state == IndexState.UP_TO_DATE:
+                self.libraries[name] = self.index.get_meta(name)
+            else:
+                outdated[name] = (url, state == IndexState.SOURCE_CHANGED)
+        if len(outdated) > 0:
+            with ThreadPoolExecutor(min(self.fetch_workers, len(outdated)), "library-fetch") as executor:
+                futures = {
+                    name: executor.submit(self.__load_library, url, force_reload)
+                    for name, (url, force_reload) in outdated.items()
+                }
+            for name, future in futures.items():
+                try:
+                    self.libraries[name] = future.result()
+                except Exception as e:
+                    LOGGER.warning("Unable to load library {}: {}".format(name, e))
+                    self.fetch_errors[name] = e
+                    continue
+                self.index.update(name, outdated[name][0], self.libraries[name])
+        # Keep libraries in declaration order regardless of the order fetching completed in
+        loaded = {x: self.libraries[x] for x in libraries if x in self.libraries}
+        self.libraries.clear()
+        self.libraries.update(loaded)
+        self.index.retain(self.libraries.keys())
+        self.index.save()
+
+    def __validate_index(self, name: str, url: str) -> IndexState:
+        state = self.index.validate(name, url, self.lib_loader.get_for_locator(url))
+        if state == IndexState.SOURCE_CHANGED:
+            LOGGER.info("Library {} has been modified, reloading".format(name))
+        return state
+
+    def __load_library(self, url: str, force_reload=False) -> LoadedDataMeta:
+        return self.lib_loader.load(url, self._lib_dir_resolver, force_reload=force_reload)
 
     def add_library(self, name: str, url: str, force_reload=False):
         if name not in self.__lib_config:
             self.__lib_config[name] = url
-        if name not in self.libraries or force_reload:
-            self.libraries[name] = self.lib_loader.load(url, self._lib_dir_resolver)
+        if name in self.libraries and not force_reload:
+            return
+        state = IndexState.STALE if force_reload else self.__validate_index(name, url)
+        if state == IndexState.UP_TO_DATE:
+            self.libraries[name] = self.index.get_meta(name)
+            return
+        meta = self.__load_library(url, force_reload=force_reload or state == IndexState.SOURCE_CHANGED)
+        self.libraries[name] = meta
+        self.fetch_errors.pop(name, None)
+        self.index.update(name, url, meta)
+        self.index.save()
+
+    def list_templates(self, library_name: Optional[str] = None) -> List[str]:
+        """
+        Returns locators of all templates available in the given library or in all loaded libraries
+        """
+        names = [library_name] if library_name is not None else list(self.libraries.keys())
+        return ["{}:{}".format(x, template) for x in names for template in self.index.get_templates(x)]
 
     def load_template(self, locator: str) -> Template:
+        library_name = locator.partition(":")[0]
+        if library_name in self.fetch_errors:
+            raise LoaderError(
+                "Unable to load {}. Library {} failed to load: {}".format(
+                    locator, library_name, self.fetch_errors[library_name]
+                )
+            )
         meta = self.loader.load(locator)
         template_dir = Path(meta.path) / meta.target_path
-        manifest_file = template_dir / MANIFEST_FILE_NAME
-        if not manifest_file.is_file():
+        if not (template_dir / MANIFEST_FILE_NAME).is_file():
             raise ValueError(
                 "Missing manifest file for template {}. Check your template library and ensure it has valid structure."
                 "\n\tCache location: {}".format(locator, meta.path)
             )
-        manifest_dict = yaml_file_to_dict(manifest_file)
-        manifest_dict = MANIFEST_SCHEMA(manifest_dict)
-        return Template(meta.target_path, manifest_dict)
+        return self.load_template_from_dir(template_dir, meta.target_path)
+
+    def load_template_from_dir(self, template_dir: Path, name: str) -> Template:
+        manifest_file = template_dir / MANIFEST_FILE_NAME
+        if not manifest_file.is_file():
+            raise ValueError("Missing manifest file for template {} in {}".format(name, template_dir))
+        return Template(name, self.manifest_cache.get(str(manifest_file)), str(template_dir))
+
+    def get_template_source_dir(self, locator: str) -> Optional[Path]:
+        """
+        Returns original location of the template if it belongs to local library. Local libraries are copied into
+        cache on load, so this is the directory to be watched for changes.
+        """
+        repo_name, _, path = locator.partition(":")
+        lib_meta = self.libraries.get(repo_name)
+        if lib_meta is None or not isinstance(lib_meta.locator, LocalLocatorDef):
+            return None
+        return Path(lib_meta.locator.path) / (lib_meta.target_path or "") / path
@@ -0,0 +1,109 @@
+#
+# Tapen - software for managing label printers
+# Copyright (C) 2022 Dmitry Berezovsky
+#
+# Tapen is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tapen is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.#
+
+
+import hashlib
+import logging
+import os
+import pickle
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from cli_rack.utils import ensure_dir
+
+from tapen.__version__ import __version__ as VERSION
+from tapen.common.cache import LRUCache
+
+LOGGER = logging.getLogger("library.cache")
+
+MANIFEST_CACHE_FORMAT_VERSION = 1
+MANIFEST_CACHE_FILE_EXT = ".bin"
+
+
+class ManifestCache(object):
+    """
+    Cache of parsed and validated manifests. Entries are keyed by the manifest path and validated by mtime and size,
+    when they don't match the content hash is compared, so the manifest is parsed again only if its content changed.
+    Entries are kept in memory and (if cache_dir is set) on disk, so they survive between runs.
+    Parser must return picklable data.
+    """
+
+    def __init__(self, parser: Callable[[bytes, str], Dict[str, Any]], cache_dir: Optional[Path], max_size=256) -> None:
+        super().__init__()
+        self.parser = parser
+        self.cache_dir = cache_dir
+        self.__memory_cache: LRUCache[Tuple[str, int, int], Dict[str, Any]] = LRUCache(max_size)
+
+    def __entry_path(self, manifest_file: str) -> Path:
+        key = hashlib.sha256(manifest_file.encode("utf-8")).hexdigest()
+        return Path(self.cache_dir or "") / (key + MANIFEST_CACHE_FILE_EXT)
+
+    def __read_entry(self, manifest_file: str) -> Optional[Dict[str, Any]]:
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(self.__entry_path(manifest_file), "rb") as f:
+                entry = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            LOGGER.debug("Manifest cache entry for {} is corrupted: {}".format(manifest_file, e))
+            return None
+        if entry.get("format") != (MANIFEST_CACHE_FORMAT_VERSION, VERSION) or entry.get("path") != manifest_file:
+            return None
+        return entry
+
+    def __write_entry(self, manifest_file: str, entry: Dict[str, Any]):
+        if self.cache_dir is None:
+            return
+        path = self.__entry_path(manifest_file)
+        try:
+            ensure_dir(str(self.cache_dir))
+            tmp_path = path.with_suffix(".tmp{}-{}".format(os.getpid(), threading.get_ident()))
+            with open(tmp_path, "wb") as f:
+                pickle.dump(entry, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            LOGGER.warning("Unable to write manifest cache entry for {}: {}".format(manifest_file, e))
+
+    def get(self, manifest_file: str) -> Dict[str, Any]:
+        """
+        Returns parsed manifest. The result is shared between callers and must not be modified.
+        """
+        stat = os.stat(manifest_file)
+        memory_key = (manifest_file, stat.st_mtime_ns, stat.st_size)
+        manifest = self.__memory_cache.get(memory_key)
+        if manifest is not None:
+            return manifest
+        entry = self.__read_entry(manifest_file)
+        if entry is None or (entry["mtime_ns"], entry["size"]) != (stat.st_mtime_ns, stat.st_size):
+            with open(manifest_file, "rb") as f:
+                content = f.read()
+            content_hash = hashlib.sha256(content).hexdigest()
+            if entry is None or entry["content_hash"] != content_hash:
+                LOGGER.debug("Parsing manifest {}".format(manifest_file))
+                entry = dict(manifest=self.parser(content, manifest_file))
+            entry.update(
+                format=(MANIFEST_CACHE_FORMAT_VERSION, VERSION),
+                path=manifest_file,
+                mtime_ns=stat.st_mtime_ns,
+                size=stat.st_size,
+                content_hash=content_hash,
+            )
+            self.__write_entry(manifest_file, entry)
+        return self.__memory_cache.put(memory_key, entry["manifest"])
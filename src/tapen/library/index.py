@@ -0,0 +1,169 @@
+#
+# Tapen - software for managing label printers
+# Copyright (C) 2022 Dmitry Berezovsky
+#
+# Tapen is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tapen is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.#
+
+
+import enum
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+
+from cli_rack.loader import BaseLoader, LoadedDataMeta, LoaderRegistry, LocalLocatorDef
+from cli_rack.serialize import DateTimeDecoder, DateTimeEncoder
+from cli_rack.utils import ensure_dir
+
+LOGGER = logging.getLogger("library.index")
+
+INDEX_FORMAT_VERSION = 2
+MANIFEST_FILE_NAME = "manifest.yaml"
+
+
+class IndexState(enum.Enum):
+    UP_TO_DATE = "up-to-date"
+    # Library must be (re)loaded through the loader
+    STALE = "stale"
+    # Source of the local library has been modified since it was copied into cache
+    SOURCE_CHANGED = "source-changed"
+
+
+def _stat_mtime(path: str) -> Optional[int]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def scan_library(root: str) -> Dict[str, Dict[str, int]]:
+    """
+    Walks library directory and collects modification times of all sub directories, files and template manifests.
+    Directory mtime changes when entries are added or removed, file mtimes cover assets modified in place.
+    """
+    dirs: Dict[str, int] = {}
+    files: Dict[str, int] = {}
+    templates: Dict[str, int] = {}
+    for dir_path, dir_names, file_names in os.walk(root):
+        dir_names[:] = [x for x in dir_names if not x.startswith(".")]
+        dirs[dir_path] = os.stat(dir_path).st_mtime_ns
+        for x in file_names:
+            if not x.startswith("."):
+                files[os.path.join(dir_path, x)] = os.stat(os.path.join(dir_path, x)).st_mtime_ns
+        if MANIFEST_FILE_NAME in file_names and dir_path != root:
+            name = Path(os.path.relpath(dir_path, root)).as_posix()
+            templates[name] = files[os.path.join(dir_path, MANIFEST_FILE_NAME)]
+    return dict(dirs=dirs, files=files, templates=templates)
+
+
+class LibraryIndex(object):
+    """
+    Persistent index of loaded libraries. For every library it records locator, resolved path, template names and
+    modification times of the files which identify the library state. Entries are validated by stat calls only, so
+    libraries are re-fetched through the loaders only when their sources change.
+    """
+
+    def __init__(self, index_file: Path, loader_registry: LoaderRegistry) -> None:
+        super().__init__()
+        self.index_file = index_file
+        self.loader_registry = loader_registry
+        self.__entries: Optional[Dict[str, Dict[str, Any]]] = None
+        self.__dirty = False
+        self.__lock = threading.RLock()
+
+    @property
+    def entries(self) -> Dict[str, Dict[str, Any]]:
+        if self.__entries is None:
+            self.__entries = self.__read()
+        return self.__entries
+
+    def __read(self) -> Dict[str, Dict[str, Any]]:
+        try:
+            with open(self.index_file, "r") as f:
+                data = json.load(f, cls=DateTimeDecoder)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            LOGGER.warning("Library index {} is corrupted and will be rebuilt: {}".format(self.index_file, e))
+            return {}
+        if not isinstance(data, dict) or data.get("version") != INDEX_FORMAT_VERSION:
+            return {}
+        return data.get("libraries", {})
+
+    def save(self):
+        with self.__lock:
+            if not self.__dirty:
+                return
+            ensure_dir(str(self.index_file.parent))
+            tmp_file = self.index_file.with_suffix(".tmp{}".format(os.getpid()))
+            with open(tmp_file, "w") as f:
+                json.dump(dict(version=INDEX_FORMAT_VERSION, libraries=self.entries), f, cls=DateTimeEncoder)
+            os.replace(tmp_file, self.index_file)
+            self.__dirty = False
+
+    def validate(self, name: str, url: str, loader: Optional[BaseLoader]) -> IndexState:
+        entry = self.entries.get(name)
+        if entry is None or entry["url"] != url:
+            return IndexState.STALE
+        for path, mtime in entry["cache_stamps"].items():
+            if _stat_mtime(path) != mtime:
+                return IndexState.STALE
+        if loader is not None and loader.is_reload_required(self.get_meta(name)):
+            return IndexState.STALE
+        for path, mtime in entry["source_stamps"].items():
+            if _stat_mtime(path) != mtime:
+                return IndexState.SOURCE_CHANGED
+        return IndexState.UP_TO_DATE
+
+    def get_meta(self, name: str) -> LoadedDataMeta:
+        entry = self.entries[name]
+        return LoadedDataMeta.from_dict(entry["meta"], entry["path"], self.loader_registry)
+
+    def get_templates(self, name: str) -> List[str]:
+        entry = self.entries.get(name)
+        return sorted(entry["templates"].keys()) if entry is not None else []
+
+    def update(self, name: str, url: str, meta: LoadedDataMeta):
+        cache_stamps = {}
+        meta_file = os.path.join(meta.path, BaseLoader.META_FILE_NAME)
+        if os.path.isfile(meta_file):
+            cache_stamps[meta_file] = _stat_mtime(meta_file)
+        source_stamps: Dict[str, Optional[int]] = {}
+        if isinstance(meta.locator, LocalLocatorDef) and os.path.isdir(meta.locator.path):
+            # Local libraries are copied into cache, so changes are tracked in the original location
+            source_root = os.path.join(meta.locator.path, meta.target_path or "")
+            scan_result = scan_library(source_root)
+            source_stamps.update(scan_result["dirs"])
+            source_stamps.update(scan_result["files"])
+        else:
+            scan_result = scan_library(meta.resolved_path)
+        with self.__lock:
+            self.entries[name] = dict(
+                url=url,
+                path=meta.path,
+                meta=meta.to_dict(),
+                cache_stamps=cache_stamps,
+                source_stamps=source_stamps,
+                templates=scan_result["templates"],
+            )
+            self.__dirty = True
+
+    def retain(self, names: Iterable[str]):
+        names = set(names)
+        with self.__lock:
+            for x in [x for x in self.entries if x not in names]:
+                del self.entries[x]
+                self.__dirty = True
@@ -15,11 +15,18 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.#
 
+import hashlib
+import json
 import logging
 import os
-from typing import Optional, Dict, Union, Callable
+import shutil
+from typing import Optional, Dict, Union, Callable, List, Tuple
 
-from cli_rack.loader import BaseLoader, BaseLocatorDef, LoaderRegistry, LoadedDataMeta, LoaderError
+from cli_rack.exception import CLIRackError
+from cli_rack.loader import BaseLoader, BaseLocatorDef, LoaderRegistry, LoadedDataMeta, LoaderError, LocalLocatorDef
+from cli_rack.utils import ensure_dir
+
+SYNC_MANIFEST_FILE_NAME = ".sync-manifest.json"
 
 
 class LibraryLocatorDef(BaseLocatorDef):
@@ -117,3 +124,125 @@ class LibraryLoader(BaseLoader):
             )
         meta.is_file = os.path.isfile(full_path)
         return meta
+
+
+def file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class LocalLibraryLoader(BaseLoader):
+    """
+    Loader for local libraries, uses the same cache layout as the cli_rack local loader. Instead of copying the whole
+    directory on every reload it keeps manifest of synced files (size, mtime and content hash) and copies only
+    files which have changed. Files removed from the source are removed from the cache as well.
+    """
+
+    LOCATOR_CLS = LocalLocatorDef
+
+    def __init__(self, target_dir="tmp/external") -> None:
+        super().__init__(logging.getLogger("loader.local"), target_dir)
+
+    @classmethod
+    def locator_to_locator_def(cls, locator_str: Union[str, BaseLocatorDef]) -> LocalLocatorDef:
+        if isinstance(locator_str, str):
+            return cls.LOCATOR_CLS(path=cls._remove_locator_prefix(locator_str), original_locator=locator_str)
+        elif isinstance(locator_str, cls.LOCATOR_CLS):
+            return locator_str
+        else:
+            raise ValueError(
+                "Locator should be either locator string or LocalLocatorDef got {}".format(
+                    locator_str.__class__.__name__
+                )
+            )
+
+    def load(
+        self,
+        locator_: Union[str, BaseLocatorDef],
+        target_path_resolver: Optional[Callable[[LoadedDataMeta], str]] = None,
+        force_reload=False,
+    ) -> LoadedDataMeta:
+        self._logger.info("Loading " + str(locator_))
+        locator = self.locator_to_locator_def(locator_)
+        fs_target = os.path.join(self.target_dir, locator.name)
+        fs_source = locator.path
+        if not os.path.exists(fs_source):
+            raise CLIRackError('Invalid locator: path "{}" doesn\'t exist'.format(fs_source))
+        if not os.path.isdir(fs_source):
+            raise LoaderError("Locator {} points invalid location. Library must be a directory".format(locator_))
+        meta = self.verify_existing_package(fs_target)
+        if meta is not None and not force_reload and not self.is_reload_required(meta):
+            self._logger.info("Cached version is up do date")
+            return meta
+        ensure_dir(fs_target)
+        self._logger.debug("\tTarget path: " + fs_target)
+        self._logger.debug("\tSource path: " + fs_source)
+        updated, removed = self.sync(fs_source, fs_target)
+        self._logger.debug("\tSynced: {} file(s) updated, {} removed".format(updated, removed))
+        meta = LoadedDataMeta(locator, fs_target)
+        meta.is_file = False
+        meta.target_path = target_path_resolver(meta) if target_path_resolver is not None else ""
+        return self._write_meta(meta)
+
+    def sync(self, source: str, target: str) -> Tuple[int, int]:
+        """
+        Brings target directory in sync with source. Returns number of updated and removed files.
+        """
+        known_files = self.__read_sync_manifest(target)
+        synced_files: Dict[str, List] = {}
+        updated = 0
+        for dir_path, _, file_names in os.walk(source):
+            target_dir = os.path.join(target, os.path.relpath(dir_path, source))
+            ensure_dir(target_dir)
+            for name in file_names:
+                source_file = os.path.join(dir_path, name)
+                rel_path = os.path.relpath(source_file, source)
+                stat = os.stat(source_file)
+                known = known_files.get(rel_path)
+                if known is not None and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+                    synced_files[rel_path] = known
+                    continue
+                # Stat doesn't match (e.g. file was touched or saved without changes), compare content
+                content_hash = file_hash(source_file)
+                if known is None or known[2] != content_hash or not os.path.exists(os.path.join(target, rel_path)):
+                    shutil.copy2(source_file, os.path.join(target_dir, name))
+                    updated += 1
+                synced_files[rel_path] = [stat.st_size, stat.st_mtime_ns, content_hash]
+        removed = 0
+        for rel_path in known_files.keys() - synced_files.keys():
+            try:
+                os.remove(os.path.join(target, rel_path))
+                removed += 1
+            except FileNotFoundError:
+                pass
+        self.__remove_empty_dirs(source, target)
+        with open(os.path.join(target, SYNC_MANIFEST_FILE_NAME), "w") as f:
+            json.dump(synced_files, f)
+        return updated, removed
+
+    def __read_sync_manifest(self, target: str) -> Dict[str, Optional[List]]:
+        try:
+            with open(os.path.join(target, SYNC_MANIFEST_FILE_NAME), "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            self._logger.debug("Sync manifest is corrupted, all files will be synced")
+        # Unknown state (e.g. cache created by cli_rack local loader): every file in cache is subject to sync
+        result: Dict[str, Optional[List]] = {}
+        for dir_path, _, file_names in os.walk(target):
+            for name in file_names:
+                rel_path = os.path.relpath(os.path.join(dir_path, name), target)
+                if rel_path not in (self.META_FILE_NAME, SYNC_MANIFEST_FILE_NAME):
+                    result[rel_path] = None
+        return result
+
+    @classmethod
+    def __remove_empty_dirs(cls, source: str, target: str):
+        for dir_path, dir_names, file_names in os.walk(target, topdown=False):
+            rel_path = os.path.relpath(dir_path, target)
+            if rel_path != "." and not os.path.isdir(os.path.join(source, rel_path)) and len(os.listdir(dir_path)) == 0:
+                os.rmdir(dir_path)
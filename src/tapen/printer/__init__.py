@@ -15,24 +15,34 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.#
 
-from typing import List, Optional
+from typing import TYPE_CHECKING, List, Optional
 
-from tapen.printer.brother import PTouchFactory
 from tapen.printer.common import PrinterFactory, TapenPrinter, TapeInfo
 
+if TYPE_CHECKING:
+    from tapen.printer.brother import PTouchFactory
+
 __DEFAULT_PRINT_FACTORY: Optional["DefaultPrinterFactory"] = None
 
 
 class DefaultPrinterFactory(PrinterFactory):
     def get_cached_tape_info(self, printer_id: Optional[str] = None) -> Optional[TapeInfo]:
-        return self.__ptouch_fectory.get_cached_tape_info(printer_id)
+        return self.__ptouch_factory().get_cached_tape_info(printer_id)
 
     def __init__(self) -> None:
         super().__init__()
-        self.__ptouch_fectory = PTouchFactory()
+        self.__ptouch_factory_instance: Optional["PTouchFactory"] = None
+
+    def __ptouch_factory(self) -> "PTouchFactory":
+        # Printer driver pulls in pyusb, so it is loaded only when printer is actually accessed
+        if self.__ptouch_factory_instance is None:
+            from tapen.printer.brother import PTouchFactory
+
+            self.__ptouch_factory_instance = PTouchFactory()
+        return self.__ptouch_factory_instance
 
     def discover_printers(self) -> List[TapenPrinter]:
-        return self.__ptouch_fectory.discover_printers()
+        return self.__ptouch_factory().discover_printers()
 
 
 def get_print_factory() -> PrinterFactory:
@@ -17,7 +17,7 @@
 
 import pickle
 from pathlib import Path
-from typing import List, Optional
+from typing import Iterable, List, Optional
 
 from cli_rack.utils import ensure_dir
 
@@ -97,13 +97,29 @@ class PTouchPrinter(TapenPrinter):
         self._ptouch_printer = ptouch_printer
 
     def init(self):
-        self._ptouch_printer.init()
+        with self._profile("printer-init"):
+            self._ptouch_printer.init()
 
     def print_image(self, image: Image, cut_tape=True):
-        self._ptouch_printer.print_image(image, cut_tape)
+        # Covers raster lines encoding and USB transfer
+        with self._profile("usb-send", width_px=image.width):
+            self._ptouch_printer.print_image(image, cut_tape)
+
+    def print_image_strips(self, strips: Iterable[Image], cut_tape=True):
+        with self._profile("usb-send"):
+            self._ptouch_printer.print_image_strips(strips, cut_tape)
+
+    def encode_image(self, image: Image) -> List[bytes]:
+        with self._profile("raster-encode", width_px=image.width):
+            return list(self._ptouch_printer.encode_image_strips((image,)))
+
+    def send_encoded(self, encoded: List[bytes], cut_tape=True):
+        with self._profile("usb-send", raster_lines=len(encoded)):
+            self._ptouch_printer.send_raster(encoded, cut_tape)
 
     def get_status(self) -> PTouchPrinterStatus:
-        status = PTouchPrinterStatus(self._ptouch_printer.get_status())
+        with self._profile("printer-status"):
+            status = PTouchPrinterStatus(self._ptouch_printer.get_status())
         self.__persist_tape_info(status.tape_info)
         return status
 
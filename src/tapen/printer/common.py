@@ -17,9 +17,12 @@
 
 import abc
 from enum import Enum
-from typing import List, Optional
+from typing import TYPE_CHECKING, Any, Iterable, List, Optional
 
-from PIL.Image import Image
+from tapen.common.profiler import Profiler, profile_span
+
+if TYPE_CHECKING:
+    from PIL.Image import Image
 
 
 class Color:
@@ -80,14 +83,50 @@ class PrinterStatus(abc.ABC):
 
 
 class TapenPrinter(abc.ABC):
+    # Set to collect timings of printer operations
+    profiler: Optional[Profiler] = None
+
+    def _profile(self, name: str, **kwargs):
+        return profile_span(self.profiler, name, "printer", **kwargs)
+
     @abc.abstractmethod
     def init(self):
         raise NotImplementedError
 
     @abc.abstractmethod
-    def print_image(self, image: Image, cut_tape=True):
+    def print_image(self, image: "Image", cut_tape=True):
         raise NotImplementedError
 
+    def print_image_strips(self, strips: Iterable["Image"], cut_tape=True):
+        """
+        Prints label supplied as a sequence of strips following each other along the tape. Printers which support
+        streaming should override this method, the default implementation assembles the whole label first.
+        """
+        strips = list(strips)
+        if len(strips) == 0:
+            return
+        from PIL import Image as PILImage
+
+        image = PILImage.new("1", (sum(x.width for x in strips), max(x.height for x in strips)), 1)
+        offset = 0
+        for x in strips:
+            image.paste(x, (offset, 0))
+            offset += x.width
+        self.print_image(image, cut_tape)
+
+    def encode_image(self, image: "Image") -> Any:
+        """
+        Converts label into printer specific data to be sent with send_encoded. Must not access the device: it is called
+        from another thread while the previous label is being printed. Default implementation leaves image as is.
+        """
+        return image
+
+    def send_encoded(self, encoded: Any, cut_tape=True):
+        """
+        Prints label encoded with encode_image
+        """
+        self.print_image(encoded, cut_tape)
+
     @abc.abstractmethod
     def get_status(self) -> PrinterStatus:
         raise NotImplementedError
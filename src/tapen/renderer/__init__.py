@@ -15,25 +15,80 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.#
 
-from typing import Optional
+from pathlib import Path
+from typing import TYPE_CHECKING, Optional
 
-from .common import Renderer, TemplateProcessor
-from .processor import JinjaTemplateProcessor
-from .weasyprint import WeasyprintRenderer
+from tapen import config
+from tapen.common.domain import Template
 
-__DEFAULT_RENDERER: Optional[Renderer] = None
-__DEFAULT_PROCESSOR: Optional[TemplateProcessor] = None
+# Renderers pull in heavy dependencies (WeasyPrint, poppler, PIL), so they are imported by the factories on first use
+if TYPE_CHECKING:
+    from .cache import BitmapCache
+    from .common import Renderer, TemplateProcessor
 
+__DEFAULT_RENDERER: Optional["Renderer"] = None
+__TEXT_RENDERER: Optional["Renderer"] = None
+__COMPOSITING_RENDERER: Optional["Renderer"] = None
+__DEFAULT_PROCESSOR: Optional["TemplateProcessor"] = None
+__BITMAP_CACHE: Optional["BitmapCache"] = None
 
-def get_default_template_processor() -> TemplateProcessor:
+
+def get_default_template_processor() -> "TemplateProcessor":
     global __DEFAULT_PROCESSOR
     if __DEFAULT_PROCESSOR is None:
-        __DEFAULT_PROCESSOR = JinjaTemplateProcessor()
+        from .processor import JinjaTemplateProcessor
+
+        __DEFAULT_PROCESSOR = JinjaTemplateProcessor(bytecode_cache_dir=Path(config.app_dirs.user_cache_dir) / "jinja")
     return __DEFAULT_PROCESSOR
 
 
-def get_default_renderer() -> Renderer:
+def get_default_renderer() -> "Renderer":
     global __DEFAULT_RENDERER
     if __DEFAULT_RENDERER is None:
+        from .weasyprint import WeasyprintRenderer
+
         __DEFAULT_RENDERER = WeasyprintRenderer(get_default_template_processor())
     return __DEFAULT_RENDERER
+
+
+def get_text_renderer() -> "Renderer":
+    global __TEXT_RENDERER
+    if __TEXT_RENDERER is None:
+        from .text import TextRenderer
+
+        __TEXT_RENDERER = TextRenderer(get_default_template_processor())
+    return __TEXT_RENDERER
+
+
+def get_compositing_renderer() -> "Renderer":
+    global __COMPOSITING_RENDERER
+    if __COMPOSITING_RENDERER is None:
+        from .compositing import SlotCompositingRenderer
+
+        __COMPOSITING_RENDERER = SlotCompositingRenderer(get_default_template_processor())
+    return __COMPOSITING_RENDERER
+
+
+def get_renderer_for_template(template: Template) -> "Renderer":
+    """
+    Returns the most efficient renderer capable of rendering given template
+    """
+    from .text import TextRenderer
+
+    if TextRenderer.can_render(template):
+        return get_text_renderer()
+    from .compositing import SlotCompositingRenderer
+
+    if SlotCompositingRenderer.can_render(template):
+        return get_compositing_renderer()
+    return get_default_renderer()
+
+
+def get_bitmap_cache(max_size_mb: int) -> "BitmapCache":
+    global __BITMAP_CACHE
+    if __BITMAP_CACHE is None:
+        from .cache import BitmapCache, BITMAP_CACHE_DIR
+
+        __BITMAP_CACHE = BitmapCache(BITMAP_CACHE_DIR, max_size_mb * 1024 * 1024)
+    __BITMAP_CACHE.max_size_bytes = max_size_mb * 1024 * 1024
+    return __BITMAP_CACHE
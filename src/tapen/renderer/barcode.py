@@ -0,0 +1,799 @@
+#
+# Tapen - software for managing label printers
+# Copyright (C) 2022 Dmitry Berezovsky
+#
+# Tapen is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tapen is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.#
+
+import base64
+import logging
+from io import BytesIO
+from typing import List, Optional, Sequence, Tuple
+
+from PIL import Image
+from markupsafe import Markup, escape
+
+from tapen.common.cache import LRUCache
+from .common import DEFAULT_PRINTER_DPI, mm_to_px, px_to_css_px
+
+LOGGER = logging.getLogger("renderer.barcode")
+
+# Code 128
+
+# Bar/space widths of every symbol, index is the symbol value
+CODE128_PATTERNS = (
+    "212222 222122 222221 121223 121322 131222 122213 122312 132212 221213 221312 231212 112232 122132 122231 "
+    "113222 123122 123221 223211 221132 221231 213212 223112 312131 311222 321122 321221 312212 322112 322211 "
+    "212123 212321 232121 111323 131123 131321 112313 132113 132311 211313 231113 231311 112133 112331 132131 "
+    "113123 113321 133121 313121 211331 231131 213113 213311 213131 311123 311321 331121 312113 312311 332111 "
+    "314111 221411 431111 111224 111422 121124 121421 141122 141221 112214 112412 122114 122411 142112 142211 "
+    "241211 221114 413111 241112 134111 111242 121142 121241 114212 124112 124211 411212 421112 421211 212141 "
+    "214121 412121 111143 111341 131141 114113 114311 411113 411311 113141 114131 311141 411131 211412 211214 "
+    "211232 2331112"
+).split()
+CODE128_START_B = 104
+CODE128_START_C = 105
+CODE128_SWITCH_TO_B = 100
+CODE128_SWITCH_TO_C = 99
+CODE128_STOP = 106
+CODE128_QUIET_ZONE_MODULES = 10
+
+
+def _count_digits(data: str, start: int) -> int:
+    end = start
+    while end < len(data) and data[end].isdigit() and data[end].isascii():
+        end += 1
+    return end - start
+
+
+def encode_code128(data: str) -> List[int]:
+    """
+    Encodes data as a sequence of Code 128 symbols including start, checksum and stop symbols. Code set B is used for
+    text, digit runs are packed in pairs with code set C.
+    """
+    symbols: List[int] = []
+    current_set: Optional[int] = None
+    i = 0
+    while i < len(data):
+        digits = _count_digits(data, i)
+        digits -= digits % 2
+        # Switching to C pays off for 4 digits at the edges and 6 digits in the middle of the data
+        at_edge = i == 0 or i + digits == len(data)
+        if digits >= (4 if at_edge else 6) or (current_set == CODE128_START_C and digits >= 2):
+            if current_set != CODE128_START_C:
+                symbols.append(CODE128_START_C if current_set is None else CODE128_SWITCH_TO_C)
+                current_set = CODE128_START_C
+            for j in range(i, i + digits, 2):
+                symbols.append(int(data[j : j + 2]))
+            i += digits
+            continue
+        code = ord(data[i])
+        if code < 32 or code > 127:
+            raise ValueError("Character {!r} can't be encoded with Code 128".format(data[i]))
+        if current_set != CODE128_START_B:
+            symbols.append(CODE128_START_B if current_set is None else CODE128_SWITCH_TO_B)
+            current_set = CODE128_START_B
+        symbols.append(code - 32)
+        i += 1
+    if len(symbols) == 0:
+        symbols.append(CODE128_START_B)
+    checksum = (symbols[0] + sum(i * x for i, x in enumerate(symbols[1:], 1))) % 103
+    return symbols + [checksum, CODE128_STOP]
+
+
+def code128_modules(data: str) -> List[bool]:
+    """
+    Returns Code 128 symbol as a row of modules, True stands for bar
+    """
+    modules: List[bool] = []
+    for symbol in encode_code128(data):
+        for i, width in enumerate(CODE128_PATTERNS[symbol]):
+            modules.extend([i % 2 == 0] * int(width))
+    return modules
+
+
+# QR Code (byte mode, ISO/IEC 18004)
+
+QR_ERROR_LEVELS = ("L", "M", "Q", "H")
+# Format bits of each error correction level
+QR_ERROR_LEVEL_BITS = {"L": 1, "M": 0, "Q": 3, "H": 2}
+# Indexed by version, index 0 is unused
+QR_ECC_CODEWORDS_PER_BLOCK = {
+    "L": (
+        -1,
+        7,
+        10,
+        15,
+        20,
+        26,
+        18,
+        20,
+        24,
+        30,
+        18,
+        20,
+        24,
+        26,
+        30,
+        22,
+        24,
+        28,
+        30,
+        28,
+        28,
+        28,
+        28,
+        30,
+        30,
+        26,
+        28,
+        30,
+        30,
+        30,
+        30,
+        30,
+        30,
+        30,
+        30,
+        30,
+        30,
+        30,
+        30,
+        30,
+        30,
+    ),  # noqa: E501
+    "M": (
+        -1,
+        10,
+        16,
+        26,
+        18,
+        24,
+        16,
+        18,
+        22,
+        22,
+        26,
+        30,
+        22,
+        22,
+        24,
+        24,
+        28,
+        28,
+        26,
+        26,
+        26,
+        26,
+        28,
+        28,
+        28,
+        28,
+        28,
+        28,
+        28,
+        28,
+        28,
+        28,
+        28,
+        28,
+        28,
+        28,
+        28,
+        28,
+        28,
+        28,
+        28,
+    ),  # noqa: E501
+    "Q": (
+        -1,
+        13,
+        22,
+        18,
+        26,
+        18,
+        24,
+        18,
+        22,
+        20,
+        24,
+        28,
+        26,
+        24,
+        20,
+        30,
+        24,
+        28,
+        28,
+        26,
+        30,
+        28,
+        30,
+        30,
+        30,
+        30,
+        28,
+        30,
+        30,
+        30,
+        30,
+        30,
+        30,
+        30,
+        30,
+        30,
+        30,
+        30,
+        30,
+        30,
+        30,
+    ),  # noqa: E501
+    "H": (
+        -1,
+        17,
+        28,
+        22,
+        16,
+        22,
+        28,
+        26,
+        26,
+        24,
+        28,
+        24,
+        28,
+        22,
+        24,
+        24,
+        30,
+        28,
+        28,
+        26,
+        28,
+        30,
+        24,
+        30,
+        30,
+        30,
+        30,
+        30,
+        30,
+        30,
+        30,
+        30,
+        30,
+        30,
+        30,
+        30,
+        30,
+        30,
+        30,
+        30,
+        30,
+    ),  # noqa: E501
+}
+QR_ERROR_CORRECTION_BLOCKS = {
+    "L": (
+        -1,
+        1,
+        1,
+        1,
+        1,
+        1,
+        2,
+        2,
+        2,
+        2,
+        4,
+        4,
+        4,
+        4,
+        4,
+        6,
+        6,
+        6,
+        6,
+        7,
+        8,
+        8,
+        9,
+        9,
+        10,
+        12,
+        12,
+        12,
+        13,
+        14,
+        15,
+        16,
+        17,
+        18,
+        19,
+        19,
+        20,
+        21,
+        22,
+        24,
+        25,
+    ),  # noqa: E501
+    "M": (
+        -1,
+        1,
+        1,
+        1,
+        2,
+        2,
+        4,
+        4,
+        4,
+        5,
+        5,
+        5,
+        8,
+        9,
+        9,
+        10,
+        10,
+        11,
+        13,
+        14,
+        16,
+        17,
+        17,
+        18,
+        20,
+        21,
+        23,
+        25,
+        26,
+        28,
+        29,
+        31,
+        33,
+        35,
+        37,
+        38,
+        40,
+        43,
+        45,
+        47,
+        49,
+    ),  # noqa: E501
+    "Q": (
+        -1,
+        1,
+        1,
+        2,
+        2,
+        4,
+        4,
+        6,
+        6,
+        8,
+        8,
+        8,
+        10,
+        12,
+        16,
+        12,
+        17,
+        16,
+        18,
+        21,
+        20,
+        23,
+        23,
+        25,
+        27,
+        29,
+        34,
+        34,
+        35,
+        38,
+        40,
+        43,
+        45,
+        48,
+        51,
+        53,
+        56,
+        59,
+        62,
+        65,
+        68,
+    ),  # noqa: E501
+    "H": (
+        -1,
+        1,
+        1,
+        2,
+        4,
+        4,
+        4,
+        5,
+        6,
+        8,
+        8,
+        11,
+        11,
+        16,
+        16,
+        18,
+        16,
+        19,
+        21,
+        25,
+        25,
+        25,
+        34,
+        30,
+        32,
+        35,
+        37,
+        40,
+        42,
+        45,
+        48,
+        51,
+        54,
+        57,
+        60,
+        63,
+        66,
+        70,
+        74,
+        77,
+        81,
+    ),  # noqa: E501
+}
+QR_MIN_VERSION = 1
+QR_MAX_VERSION = 40
+QR_QUIET_ZONE_MODULES = 4
+
+QR_MASKS = (
+    lambda x, y: (x + y) % 2 == 0,
+    lambda x, y: y % 2 == 0,
+    lambda x, y: x % 3 == 0,
+    lambda x, y: (x + y) % 3 == 0,
+    lambda x, y: (x // 3 + y // 2) % 2 == 0,
+    lambda x, y: x * y % 2 + x * y % 3 == 0,
+    lambda x, y: (x * y % 2 + x * y % 3) % 2 == 0,
+    lambda x, y: ((x + y) % 2 + x * y % 3) % 2 == 0,
+)
+
+
+def _qr_raw_data_modules(version: int) -> int:
+    result = (16 * version + 128) * version + 64
+    if version >= 2:
+        num_align = version // 7 + 2
+        result -= (25 * num_align - 10) * num_align - 55
+        if version >= 7:
+            result -= 36
+    return result
+
+
+def _qr_data_codewords(version: int, error_level: str) -> int:
+    return (
+        _qr_raw_data_modules(version) // 8
+        - QR_ECC_CODEWORDS_PER_BLOCK[error_level][version] * QR_ERROR_CORRECTION_BLOCKS[error_level][version]
+    )
+
+
+def _gf_multiply(x: int, y: int) -> int:
+    # Multiplication in GF(2^8/0x11D)
+    z = 0
+    for i in reversed(range(8)):
+        z = (z << 1) ^ ((z >> 7) * 0x11D)
+        z ^= ((y >> i) & 1) * x
+    return z
+
+
+def _reed_solomon_divisor(degree: int) -> List[int]:
+    result = [0] * (degree - 1) + [1]
+    root = 1
+    for _ in range(degree):
+        for j in range(degree):
+            result[j] = _gf_multiply(result[j], root)
+            if j + 1 < degree:
+                result[j] ^= result[j + 1]
+        root = _gf_multiply(root, 0x02)
+    return result
+
+
+def _reed_solomon_remainder(data: Sequence[int], divisor: Sequence[int]) -> List[int]:
+    result = [0] * len(divisor)
+    for b in data:
+        factor = b ^ result.pop(0)
+        result.append(0)
+        for i, coef in enumerate(divisor):
+            result[i] ^= _gf_multiply(coef, factor)
+    return result
+
+
+class _QrMatrix(object):
+    def __init__(self, version: int) -> None:
+        self.version = version
+        self.size = version * 4 + 17
+        self.modules = [[False] * self.size for _ in range(self.size)]
+        self.is_function = [[False] * self.size for _ in range(self.size)]
+
+    def set_function(self, x: int, y: int, is_dark: bool):
+        self.modules[y][x] = is_dark
+        self.is_function[y][x] = True
+
+    def alignment_positions(self) -> List[int]:
+        if self.version == 1:
+            return []
+        num_align = self.version // 7 + 2
+        step = (self.version * 8 + num_align * 3 + 5) // (num_align * 4 - 4) * 2
+        return [6] + [self.size - 7 - i * step for i in reversed(range(num_align - 1))]
+
+    def draw_function_patterns(self):
+        for i in range(self.size):
+            self.set_function(6, i, i % 2 == 0)
+            self.set_function(i, 6, i % 2 == 0)
+        for x, y in ((3, 3), (self.size - 4, 3), (3, self.size - 4)):
+            for dy in range(-4, 5):
+                for dx in range(-4, 5):
+                    if 0 <= x + dx < self.size and 0 <= y + dy < self.size:
+                        self.set_function(x + dx, y + dy, max(abs(dx), abs(dy)) not in (2, 4))
+        positions = self.alignment_positions()
+        last = len(positions) - 1
+        for i, x in enumerate(positions):
+            for j, y in enumerate(positions):
+                if (i, j) in ((0, 0), (0, last), (last, 0)):
+                    continue  # Overlaps finder pattern
+                for dy in range(-2, 3):
+                    for dx in range(-2, 3):
+                        self.set_function(x + dx, y + dy, max(abs(dx), abs(dy)) != 1)
+        # Reserve format area, actual bits are drawn once the mask is chosen
+        self.draw_format_bits("L", 0)
+        self.draw_version()
+
+    def draw_format_bits(self, error_level: str, mask: int):
+        data = QR_ERROR_LEVEL_BITS[error_level] << 3 | mask
+        rem = data
+        for _ in range(10):
+            rem = (rem << 1) ^ ((rem >> 9) * 0x537)
+        bits = (data << 10 | rem) ^ 0x5412
+        size = self.size
+        for i in range(15):
+            bit = ((bits >> i) & 1) != 0
+            # Copy around the top left finder
+            if i < 6:
+                self.set_function(8, i, bit)
+            elif i < 8:
+                self.set_function(8, i + 1, bit)
+            elif i == 8:
+                self.set_function(7, 8, bit)
+            else:
+                self.set_function(14 - i, 8, bit)
+            # Copy split between the other two finders
+            if i < 8:
+                self.set_function(size - 1 - i, 8, bit)
+            else:
+                self.set_function(8, size - 15 + i, bit)
+        self.set_function(8, size - 8, True)
+
+    def draw_version(self):
+        if self.version < 7:
+            return
+        rem = self.version
+        for _ in range(12):
+            rem = (rem << 1) ^ ((rem >> 11) * 0x1F25)
+        bits = self.version << 12 | rem
+        for i in range(18):
+            bit = ((bits >> i) & 1) != 0
+            a, b = self.size - 11 + i % 3, i // 3
+            self.set_function(a, b, bit)
+            self.set_function(b, a, bit)
+
+    def draw_codewords(self, codewords: Sequence[int]):
+        i = 0
+        total_bits = len(codewords) * 8
+        for right in range(self.size - 1, 0, -2):
+            if right <= 6:
+                right -= 1  # Skip vertical timing pattern
+            upward = ((right + 1) & 2) == 0
+            for vertical in range(self.size):
+                y = self.size - 1 - vertical if upward else vertical
+                for x in (right, right - 1):
+                    if not self.is_function[y][x] and i < total_bits:
+                        self.modules[y][x] = ((codewords[i >> 3] >> (7 - (i & 7))) & 1) != 0
+                        i += 1
+
+    def apply_mask(self, mask: int):
+        predicate = QR_MASKS[mask]
+        for y in range(self.size):
+            row, is_function = self.modules[y], self.is_function[y]
+            for x in range(self.size):
+                if not is_function[x] and predicate(x, y):
+                    row[x] = not row[x]
+
+    def penalty(self) -> int:
+        result = 0
+        lines = self.modules + [list(col) for col in zip(*self.modules)]
+        finder_pattern = [True, False, True, True, True, False, True, False, False, False, False]
+        finder_like: Tuple[List[bool], List[bool]] = (finder_pattern, list(reversed(finder_pattern)))
+        for line in lines:
+            run_color, run_length = None, 0
+            for module in line + [None]:
+                if module == run_color:
+                    run_length += 1
+                    continue
+                if run_length >= 5:
+                    result += run_length - 2
+                run_color, run_length = module, 1
+            for i in range(len(line) - 10):
+                if line[i : i + 11] in finder_like:
+                    result += 40
+        for y in range(self.size - 1):
+            for x in range(self.size - 1):
+                color = self.modules[y][x]
+                if color == self.modules[y][x + 1] == self.modules[y + 1][x] == self.modules[y + 1][x + 1]:
+                    result += 3
+        dark = sum(sum(row) for row in self.modules)
+        total = self.size * self.size
+        result += ((abs(dark * 20 - total * 10) + total - 1) // total - 1) * 10
+        return result
+
+
+def _qr_choose_version(data: bytes, error_level: str) -> int:
+    for version in range(QR_MIN_VERSION, QR_MAX_VERSION + 1):
+        count_bits = 8 if version < 10 else 16
+        if (
+            len(data) < (1 << count_bits)
+            and 4 + count_bits + len(data) * 8 <= _qr_data_codewords(version, error_level) * 8
+        ):
+            return version
+    raise ValueError("Data is too long for QR code ({} bytes)".format(len(data)))
+
+
+def _qr_data_codeword_sequence(data: bytes, version: int, error_level: str) -> List[int]:
+    count_bits = 8 if version < 10 else 16
+    bits: List[int] = []
+
+    def append_bits(value: int, length: int):
+        bits.extend((value >> i) & 1 for i in reversed(range(length)))
+
+    append_bits(0b0100, 4)  # Byte mode
+    append_bits(len(data), count_bits)
+    for b in data:
+        append_bits(b, 8)
+    capacity_bits = _qr_data_codewords(version, error_level) * 8
+    append_bits(0, min(4, capacity_bits - len(bits)))
+    append_bits(0, -len(bits) % 8)
+    codewords = [int("".join(map(str, bits[i : i + 8])), 2) for i in range(0, len(bits), 8)]
+    pad = 0xEC
+    while len(codewords) < capacity_bits // 8:
+        codewords.append(pad)
+        pad ^= 0xEC ^ 0x11
+    return codewords
+
+
+def _qr_add_error_correction(codewords: List[int], version: int, error_level: str) -> List[int]:
+    num_blocks = QR_ERROR_CORRECTION_BLOCKS[error_level][version]
+    block_ecc_len = QR_ECC_CODEWORDS_PER_BLOCK[error_level][version]
+    raw_codewords = _qr_raw_data_modules(version) // 8
+    num_short_blocks = num_blocks - raw_codewords % num_blocks
+    short_block_len = raw_codewords // num_blocks
+    divisor = _reed_solomon_divisor(block_ecc_len)
+    blocks = []
+    k = 0
+    for i in range(num_blocks):
+        data = codewords[k : k + short_block_len - block_ecc_len + (0 if i < num_short_blocks else 1)]
+        k += len(data)
+        ecc = _reed_solomon_remainder(data, divisor)
+        if i < num_short_blocks:
+            data.append(0)  # Padding to interleave blocks of equal length, skipped below
+        blocks.append(data + ecc)
+    result = []
+    for i in range(len(blocks[0])):
+        for j, block in enumerate(blocks):
+            if i != short_block_len - block_ecc_len or j >= num_short_blocks:
+                result.append(block[i])
+    return result
+
+
+def qr_modules(data: str | bytes, error_level="M", mask: Optional[int] = None) -> List[List[bool]]:
+    """
+    Returns QR code as a matrix of modules (rows), True stands for dark module. Data is encoded in byte mode with the
+    smallest version fitting it. Mask is chosen by penalty score unless given explicitly.
+    """
+    if error_level not in QR_ERROR_LEVELS:
+        raise ValueError("Invalid error correction level {}. Expected one of {}".format(error_level, QR_ERROR_LEVELS))
+    payload = data.encode("utf-8") if isinstance(data, str) else data
+    version = _qr_choose_version(payload, error_level)
+    codewords = _qr_add_error_correction(
+        _qr_data_codeword_sequence(payload, version, error_level), version, error_level
+    )
+    matrix = _QrMatrix(version)
+    matrix.draw_function_patterns()
+    matrix.draw_codewords(codewords)
+    if mask is None:
+        penalties = []
+        for candidate in range(len(QR_MASKS)):
+            matrix.apply_mask(candidate)
+            matrix.draw_format_bits(error_level, candidate)
+            penalties.append(matrix.penalty())
+            matrix.apply_mask(candidate)  # Masks are XOR, applying it again reverts the change
+        mask = penalties.index(min(penalties))
+    matrix.apply_mask(mask)
+    matrix.draw_format_bits(error_level, mask)
+    return matrix.modules
+
+
+# Bitmaps
+
+
+def modules_to_bitmap(rows: Sequence[Sequence[bool]], module_px: int, quiet_zone: int, height_px=0) -> Image.Image:
+    """
+    Draws modules as 1-bit image where every module is module_px x module_px pixels. Single row symbols are stretched
+    to height_px.
+    """
+    width = (len(rows[0]) + 2 * quiet_zone) * module_px
+    height = height_px if len(rows) == 1 else (len(rows) + 2 * quiet_zone) * module_px
+    image = Image.new("1", (width, height), 1)
+    offset = quiet_zone * module_px
+    for y, row in enumerate(rows):
+        for x, is_dark in enumerate(row):
+            if is_dark:
+                left = offset + x * module_px
+                top = 0 if len(rows) == 1 else offset + y * module_px
+                bottom = height if len(rows) == 1 else top + module_px
+                image.paste(0, (left, top, left + module_px, bottom))
+    return image
+
+
+class BarcodeGenerator(object):
+    """
+    Generates barcodes for templates. Bitmaps are drawn module by module at printer resolution and embedded as images
+    sized so that every image pixel maps to exactly one printed dot. Generated markup is cached per payload.
+    """
+
+    def __init__(self, dpi=DEFAULT_PRINTER_DPI, max_cached=256) -> None:
+        self.dpi = dpi
+        self.__cache: LRUCache[Tuple, Markup] = LRUCache(max_cached)
+
+    def __to_markup(self, bitmap: Image.Image, kind: str, alt: str) -> Markup:
+        png = BytesIO()
+        bitmap.save(png, format="png", optimize=True)
+        return Markup(
+            '<img class="barcode barcode-{kind}" alt="{alt}" src="data:image/png;base64,{data}" '
+            'style="width: {width}px; height: {height}px; image-rendering: pixelated">'
+        ).format(
+            kind=kind,
+            alt=alt,
+            data=base64.b64encode(png.getvalue()).decode("ascii"),
+            width=px_to_css_px(bitmap.width, self.dpi),
+            height=px_to_css_px(bitmap.height, self.dpi),
+        )
+
+    def code128(self, data, height_mm=5.0, module_px=2, quiet_zone=CODE128_QUIET_ZONE_MODULES) -> Markup:
+        data = str(data)
+        height_px = max(1, int(round(mm_to_px(height_mm, self.dpi))))
+
+        def factory():
+            bitmap = modules_to_bitmap([code128_modules(data)], module_px, quiet_zone, height_px)
+            return self.__to_markup(bitmap, "code128", escape(data))
+
+        return self.__cache.get_or_create(("code128", data, height_px, module_px, quiet_zone), factory)
+
+    def qr(self, data, module_px=3, error_level="M", quiet_zone=QR_QUIET_ZONE_MODULES) -> Markup:
+        data = str(data)
+
+        def factory():
+            bitmap = modules_to_bitmap(qr_modules(data, error_level), module_px, quiet_zone)
+            return self.__to_markup(bitmap, "qr", escape(data))
+
+        return self.__cache.get_or_create(("qr", data, module_px, error_level, quiet_zone), factory)
@@ -0,0 +1,146 @@
+#
+# Tapen - software for managing label printers
+# Copyright (C) 2022 Dmitry Berezovsky
+#
+# Tapen is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tapen is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.#
+
+import hashlib
+import json
+import logging
+import os
+import struct
+import threading
+from pathlib import Path
+from typing import Any, List, Optional, Tuple
+
+from PIL import Image
+from cli_rack.utils import ensure_dir
+
+from tapen import config
+
+BITMAP_CACHE_DIR = Path(config.app_dirs.user_cache_dir) / "bitmap-cache"
+
+LOGGER = logging.getLogger("renderer.cache")
+
+# Header: magic, format version, width, height
+BITMAP_HEADER = struct.Struct("<4sBII")
+BITMAP_MAGIC = b"TPBM"
+BITMAP_FORMAT_VERSION = 1
+BITMAP_FILE_EXT = ".bin"
+
+
+def hash_key(*parts: Any) -> str:
+    """
+    Builds content address out of given parts. Parts must be JSON serializable, unknown objects are converted to str.
+    """
+    serialized = json.dumps(parts, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+class BitmapCache(object):
+    """
+    Content addressed persistent storage for rendered 1-bit bitmaps. Bitmaps are stored packed (8 pixels per byte).
+    When total size exceeds max_size_bytes the least recently used entries are evicted.
+    """
+
+    def __init__(self, cache_dir: Path, max_size_bytes: int) -> None:
+        super().__init__()
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        self.__lock = threading.Lock()
+        self.__total_size: Optional[int] = None
+
+    def __entry_path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / (key + BITMAP_FILE_EXT)
+
+    def __list_entries(self) -> List[Tuple[float, int, Path]]:
+        result: List[Tuple[float, int, Path]] = []
+        if not self.cache_dir.is_dir():
+            return result
+        for x in self.cache_dir.glob("*/*" + BITMAP_FILE_EXT):
+            try:
+                stat = x.stat()
+            except FileNotFoundError:
+                continue
+            result.append((stat.st_mtime, stat.st_size, x))
+        return result
+
+    def __get_total_size(self) -> int:
+        if self.__total_size is None:
+            self.__total_size = sum(x[1] for x in self.__list_entries())
+        return self.__total_size
+
+    def get(self, key: str) -> Optional[Image.Image]:
+        path = self.__entry_path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        try:
+            magic, version, width, height = BITMAP_HEADER.unpack_from(data)
+            if magic != BITMAP_MAGIC or version != BITMAP_FORMAT_VERSION:
+                raise ValueError("Unsupported bitmap format")
+            image = Image.frombytes("1", (width, height), data[BITMAP_HEADER.size :])
+        except (struct.error, ValueError) as e:
+            LOGGER.warning("Cache entry {} is corrupted and will be removed: {}".format(path, e))
+            self.invalidate(key)
+            return None
+        # Modification time is used as the last access marker for LRU eviction
+        os.utime(path)
+        return image
+
+    def put(self, key: str, image: Image.Image):
+        if image.mode != "1":
+            image = image.convert("1", dither=Image.Dither.NONE)
+        path = self.__entry_path(key)
+        ensure_dir(str(path.parent))
+        data = BITMAP_HEADER.pack(BITMAP_MAGIC, BITMAP_FORMAT_VERSION, image.width, image.height) + image.tobytes()
+        tmp_path = path.with_suffix(".tmp{}".format(threading.get_ident()))
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        with self.__lock:
+            previous_size = path.stat().st_size if path.exists() else 0
+            os.replace(tmp_path, path)
+            self.__total_size = self.__get_total_size() - previous_size + len(data)
+            if self.__total_size > self.max_size_bytes:
+                self.__evict()
+
+    def invalidate(self, key: str):
+        path = self.__entry_path(key)
+        with self.__lock:
+            try:
+                size = path.stat().st_size
+                path.unlink()
+            except FileNotFoundError:
+                return
+            if self.__total_size is not None:
+                self.__total_size -= size
+
+    def clear(self):
+        with self.__lock:
+            for _, _, path in self.__list_entries():
+                path.unlink(missing_ok=True)
+            self.__total_size = 0
+
+    def __evict(self):
+        entries = sorted(self.__list_entries())
+        total_size = sum(x[1] for x in entries)
+        for _, size, path in entries:
+            if total_size <= self.max_size_bytes:
+                break
+            LOGGER.debug("Evicting {} from bitmap cache".format(path.name))
+            path.unlink(missing_ok=True)
+            total_size -= size
+        self.__total_size = total_size
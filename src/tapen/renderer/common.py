@@ -16,38 +16,482 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.#
 
 import abc
-from typing import Any, Dict
+import contextlib
+import enum
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import pickle
+import signal
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Tuple
 
+from PIL.Image import Image
+from cli_rack.utils import none_throws
+
+from tapen import const
 from tapen.common.domain import PrintJob, Template
+from tapen.common.profiler import Profiler, profile_span
 from tapen.printer.common import TapeInfo
+from .cache import BitmapCache, hash_key
+
+LOGGER = logging.getLogger("renderer")
+
+DEFAULT_PRINTER_DPI = 180
+DEFAULT_RENDERER_DPI = 96
+PDF_POINTS_PER_INCH = 72
+MM_PER_INCH = 25.4
+
+
+def css_px_to_px(css_px: float, dpi=DEFAULT_PRINTER_DPI) -> float:
+    """
+    Converts CSS pixels into pixels of the rendered label. It mirrors the WeasyPrint pipeline where document is zoomed
+    by dpi/96 and then rasterized by poppler at 72dpi.
+    """
+    return css_px * (PDF_POINTS_PER_INCH / DEFAULT_RENDERER_DPI) * (dpi / DEFAULT_RENDERER_DPI)
+
+
+def px_to_css_px(px: float, dpi=DEFAULT_PRINTER_DPI) -> float:
+    return px / css_px_to_px(1, dpi)
+
+
+def mm_to_css_px(mm: float) -> float:
+    return mm / MM_PER_INCH * DEFAULT_RENDERER_DPI
+
+
+def mm_to_px(mm: float, dpi=DEFAULT_PRINTER_DPI) -> float:
+    return css_px_to_px(mm_to_css_px(mm), dpi)
+
+
+FIT_TOLERANCE = 0.02
+MIN_FIT_SCALE = 0.05
+MAX_FIT_PROBES = 8
+
+
+def find_fit_scale(
+    measure: Callable[[float], float],
+    target_width: float,
+    tolerance=FIT_TOLERANCE,
+    min_scale=MIN_FIT_SCALE,
+    max_probes=MAX_FIT_PROBES,
+) -> float:
+    """
+    Binary searches the largest font scale (<= 1) for which measured width fits target_width. Text width is almost
+    proportional to font size, so every probe is placed at the linear estimate when it falls within the search
+    interval. Usually the very first estimate is accepted.
+    """
+    natural_width = measure(1.0)
+    if natural_width <= target_width or natural_width <= 0:
+        return 1.0
+    low, high = min_scale, 1.0
+    # Aim slightly below the target so the estimate lands within tolerance instead of approaching it from above
+    aim = target_width * (1 - tolerance / 2)
+    scale = max(min_scale, aim / natural_width)
+    for _ in range(max_probes):
+        width = measure(scale)
+        if width <= target_width:
+            low = scale
+            if target_width - width <= target_width * tolerance:
+                break
+        else:
+            high = scale
+        if high - low <= high * tolerance:
+            break
+        estimate = scale * aim / width if width > 0 else 0
+        scale = estimate if low < estimate < high else (low + high) / 2
+    return low
+
+
+class TemplateDependency(enum.IntEnum):
+    """
+    Describes which part of the processing context affects template output. Ordered from the least to the most specific
+    """
+
+    STATIC = 0
+    TAPE = 1
+    LABEL = 2
+
+
+class RenderStage(enum.IntEnum):
+    IDLE = 0
+    TEMPLATE = 1
+    LAYOUT = 2
+    PDF = 3
+    RASTER = 4
+
+
+# Context variables which stay the same for every label in a batch
+TAPE_CONTEXT_VARS = frozenset(("tape", "is_preview"))
+
+
+# Label rendered to initialize rendering engine, covers text and digits
+WARM_UP_TEMPLATE = Template(
+    "warm-up", {const.MF_LAYOUT: {const.MF_TEMPLATE: "<p>Warm up: ABCXYZ abcxyz 0123456789</p>"}}
+)
 
 
 class TemplateProcessor(abc.ABC):
     def process(self, template: Template, context: Dict[str, Any]) -> str:
         return self.process_string(template.layout_template, template.name, context)
 
+    def prepare(self, template: Template):
+        """
+        Does all the template specific work which doesn't depend on processing context (e.g. compilation) in advance
+        """
+        pass
+
     @abc.abstractmethod
     def process_string(self, template_str: str, doc_name: str, context: Dict[str, Any]):
         pass
 
+    def get_dependency(self, template_str: str, doc_name: str) -> TemplateDependency:
+        """
+        Returns which part of the processing context given template depends on. Processors which are not able to
+        analyze templates should keep the default implementation which forces processing for every label.
+        """
+        return TemplateDependency.LABEL
+
+    def get_template_dependency(self, template: Template) -> TemplateDependency:
+        dependency = self.get_dependency(template.layout_template, template.name)
+        if template.layout_css is not None:
+            dependency = max(dependency, self.get_dependency(template.layout_css, template.name + "/css"))
+        return dependency
+
 
 class Renderer(abc.ABC):
     def __init__(self) -> None:
         super().__init__()
         self.persist_rendered_image_as_file = False
         self.job_num = 0
+        self.bitmap_cache: Optional[BitmapCache] = None
+        # Max time in seconds given to render a single label, None means no limit
+        self.render_timeout: Optional[float] = None
+        self.current_stage = RenderStage.IDLE
+        self.profiler: Optional[Profiler] = None
+        self.__warm_up_thread: Optional[threading.Thread] = None
+        # Shared memory cell the stage is reported to when rendering happens in subprocess
+        self.__stage_reporter: Optional[Any] = None
+        # Control connection, result receiver and stage reporter of the process forking timed renders
+        self.__render_worker: Optional[Tuple[Any, Any, Any]] = None
+
+    def create_processing_context(self, print_job: PrintJob, tape_params: TapeInfo, is_preview=False):
+        return dict(params=print_job.params, param=print_job.params, tape=tape_params, is_preview=is_preview)
 
     @abc.abstractmethod
     def render(self, print_job: PrintJob, tape_params: TapeInfo):
         pass
 
+    @contextlib.contextmanager
+    def _stage(self, stage: RenderStage):
+        """
+        Marks the code block as the given rendering stage so that the deadline overrun could be attributed
+        """
+        previous_stage = self.current_stage
+        self.__set_stage(stage)
+        try:
+            with self._profile(stage.name.lower()):
+                yield
+        finally:
+            self.__set_stage(previous_stage)
+
+    def _profile(self, name: str, **kwargs):
+        return profile_span(self.profiler, name, "render", **kwargs)
+
+    def __set_stage(self, stage: RenderStage):
+        self.current_stage = stage
+        if self.__stage_reporter is not None:
+            self.__stage_reporter.value = stage
+
+    def warm_up(self, tape_params: TapeInfo, templates: Iterable[Template] = ()):
+        """
+        Initializes rendering engine by rendering hidden label and prepares given templates (compilation, fonts
+        loading, etc.) so that the first real label is rendered with steady-state latency.
+        """
+        start_time = time.perf_counter()
+        job_num, persist_rendered_image_as_file = self.job_num, self.persist_rendered_image_as_file
+        self.persist_rendered_image_as_file = False
+        try:
+            for template in templates:
+                try:
+                    self._warm_up_template(template, tape_params)
+                except Exception as e:
+                    LOGGER.debug("Unable to prepare template {}: {}".format(template.name, e))
+            self._render_bitmap(PrintJob(WARM_UP_TEMPLATE, {}), tape_params)
+        finally:
+            self.job_num, self.persist_rendered_image_as_file = job_num, persist_rendered_image_as_file
+        LOGGER.debug(
+            "{} warmed up in {:.0f}ms".format(self.__class__.__name__, (time.perf_counter() - start_time) * 1000)
+        )
+
+    def _warm_up_template(self, template: Template, tape_params: TapeInfo):
+        pass
+
+    def start_warm_up(self, tape_params: TapeInfo, templates: Iterable[Template] = ()):
+        """
+        Runs warm up in background thread. Rendering methods wait for it to complete, so it is safe to start
+        rendering at any moment.
+        """
+        self.wait_for_warm_up()
+        self.__warm_up_thread = threading.Thread(
+            target=self.__warm_up_safely, args=(tape_params, list(templates)), name="renderer-warm-up", daemon=True
+        )
+        self.__warm_up_thread.start()
+
+    def __warm_up_safely(self, tape_params: TapeInfo, templates: Iterable[Template]):
+        try:
+            self.warm_up(tape_params, templates)
+        except Exception as e:
+            LOGGER.warning("Renderer warm up failed: {}".format(e))
+
+    def wait_for_warm_up(self):
+        thread = self.__warm_up_thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+            self.__warm_up_thread = None
+
+    def render_bitmap(
+        self, print_job: PrintJob, tape_params: TapeInfo, is_preview=False, dpi=DEFAULT_PRINTER_DPI
+    ) -> Image:
+        self.wait_for_warm_up()
+        if self.bitmap_cache is None:
+            return self.__render_bitmap_within_deadline(print_job, tape_params, is_preview, dpi)
+        cache_key = self.get_cache_key(print_job, tape_params, is_preview, dpi)
+        with self._profile("bitmap-cache-get"):
+            bitmap = self.bitmap_cache.get(cache_key)
+        if bitmap is not None:
+            LOGGER.debug("Bitmap for {} found in cache ({})".format(print_job.template.name, cache_key))
+            return bitmap
+        bitmap = self.__render_bitmap_within_deadline(print_job, tape_params, is_preview, dpi)
+        with self._profile("bitmap-cache-put"):
+            self.bitmap_cache.put(cache_key, bitmap)
+        return bitmap
+
+    def __render_bitmap_within_deadline(
+        self, print_job: PrintJob, tape_params: TapeInfo, is_preview=False, dpi=DEFAULT_PRINTER_DPI
+    ) -> Image:
+        """
+        Renders bitmap in a forked subprocess which is killed once render_timeout is exceeded. Forked process inherits
+        all the caches warmed up so far, so the overhead is limited to the fork itself and transferring the bitmap.
+        """
+        if self.render_timeout is None:
+            return self._render_bitmap(print_job, tape_params, is_preview, dpi)
+        if "fork" not in multiprocessing.get_all_start_methods():
+            LOGGER.warning("Render timeout is not supported on this platform and will be ignored")
+            return self._render_bitmap(print_job, tape_params, is_preview, dpi)
+        if self.__render_worker is not None:
+            return self.__render_bitmap_in_worker(print_job, tape_params, is_preview, dpi)
+        mp_context = multiprocessing.get_context("fork")
+        stage_reporter = mp_context.Value("i", RenderStage.IDLE, lock=False)
+        receiver, sender = mp_context.Pipe(duplex=False)
+        process = mp_context.Process(
+            target=self.__render_in_subprocess,
+            args=(sender, stage_reporter, print_job, tape_params, is_preview, dpi),
+            daemon=True,
+        )
+        process.start()
+        sender.close()
+        try:
+            if not receiver.poll(self.render_timeout):
+                process.kill()
+                raise RenderTimeoutError(
+                    print_job.template.name, self.render_timeout, RenderStage(stage_reporter.value)
+                )
+            is_success, result = receiver.recv()
+        except EOFError:
+            raise TemplateRenderingError(
+                "Unable to render template " + print_job.template.name,
+                RuntimeError("rendering process exited unexpectedly with code {}".format(process.exitcode)),
+            )
+        finally:
+            receiver.close()
+            process.join()
+        self.job_num += 1
+        if not is_success:
+            raise result
+        return result
+
+    @contextlib.contextmanager
+    def render_worker(self) -> Iterator[None]:
+        """
+        Forks the worker process which forks a child for every timed render from then on. Forking a process while other
+        threads are running (e.g. print pipeline stages) is unsafe: a lock held by another thread at that moment, like
+        logging handler or cache lock, stays locked in the child forever. So it must be entered while no other threads
+        are running, the worker inherits caches warmed up so far. Does nothing when render timeout isn't set.
+        """
+        if self.render_timeout is None or "fork" not in multiprocessing.get_all_start_methods():
+            yield
+            return
+        self.wait_for_warm_up()
+        mp_context = multiprocessing.get_context("fork")
+        stage_reporter = mp_context.Value("i", RenderStage.IDLE, lock=False)
+        control, worker_control = mp_context.Pipe()
+        result_receiver, result_sender = mp_context.Pipe(duplex=False)
+        process = mp_context.Process(
+            target=self.__serve_renders,
+            args=(worker_control, result_sender, stage_reporter),
+            name="render-worker",
+            daemon=True,
+        )
+        process.start()
+        worker_control.close()
+        result_sender.close()
+        self.__render_worker = (control, result_receiver, stage_reporter)
+        try:
+            yield
+        finally:
+            self.__render_worker = None
+            try:
+                control.send(None)
+            except OSError:
+                pass
+            control.close()
+            result_receiver.close()
+            process.join()
+
+    def __serve_renders(self, control, result_sender, stage_reporter):
+        while True:
+            try:
+                request = control.recv()
+            except EOFError:
+                return
+            if request is None:
+                return
+            pid = os.fork()
+            if pid == 0:
+                # Rendering child passes result directly to the parent
+                try:
+                    self.__render_in_subprocess(result_sender, stage_reporter, *request)
+                finally:
+                    os._exit(0)
+            control.send(pid)
+            control.send(os.waitpid(pid, 0)[1])
+
+    def __render_bitmap_in_worker(
+        self, print_job: PrintJob, tape_params: TapeInfo, is_preview: bool, dpi: int
+    ) -> Image:
+        control, result_receiver, stage_reporter = none_throws(self.__render_worker)
+        stage_reporter.value = RenderStage.IDLE
+        control.send((print_job, tape_params, is_preview, dpi))
+        pid = control.recv()
+        # Worker reports exit status once rendering child is finished, without result it means child crashed
+        if len(multiprocessing.connection.wait([result_receiver, control], self.render_timeout)) == 0:
+            os.kill(pid, signal.SIGKILL)
+            control.recv()
+            # Child could start sending result right before it was killed
+            self.__discard_pending(result_receiver)
+            raise RenderTimeoutError(
+                print_job.template.name, none_throws(self.render_timeout), RenderStage(stage_reporter.value)
+            )
+        result = result_receiver.recv() if result_receiver.poll() else None
+        exit_status = control.recv()
+        if result is None:
+            raise TemplateRenderingError(
+                "Unable to render template " + print_job.template.name,
+                RuntimeError("rendering process exited unexpectedly with status {}".format(exit_status)),
+            )
+        self.job_num += 1
+        is_success, bitmap = result
+        if not is_success:
+            raise bitmap
+        return bitmap
+
+    @staticmethod
+    def __discard_pending(connection):
+        fd = connection.fileno()
+        os.set_blocking(fd, False)
+        try:
+            while os.read(fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        finally:
+            os.set_blocking(fd, True)
+
+    def __render_in_subprocess(
+        self, sender, stage_reporter, print_job: PrintJob, tape_params: TapeInfo, is_preview: bool, dpi: int
+    ):
+        self.__stage_reporter = stage_reporter
+        try:
+            sender.send((True, self._render_bitmap(print_job, tape_params, is_preview, dpi)))
+        except Exception as e:
+            try:
+                pickle.loads(pickle.dumps(e))
+            except Exception:
+                # Not every exception survives pickling, in this case only the message is passed to the parent
+                e = TemplateRenderingError(
+                    "Unable to render template " + print_job.template.name, RuntimeError(repr(e))
+                )
+            sender.send((False, e))
+        finally:
+            sender.close()
+
+    def render_bitmap_strips(
+        self, print_job: PrintJob, tape_params: TapeInfo, is_preview=False, dpi=DEFAULT_PRINTER_DPI
+    ) -> Iterator[Image]:
+        """
+        Renders label as a sequence of strips following each other along the tape. Renderers capable of rasterizing
+        label partially should override it to keep memory footprint independent of the label length.
+        Everything which could fail must be done before returning, the returned iterator is consumed while printer
+        is in raster mode, so the error there leaves partially printed label on the tape.
+        """
+        return iter((self.render_bitmap(print_job, tape_params, is_preview, dpi),))
+
+    @classmethod
+    def tape_cache_key(cls, tape_params: TapeInfo) -> Tuple[float, float, str]:
+        return tape_params.width_mm, tape_params.padding_vertical_mm, str(tape_params)
+
+    def get_cache_key(self, print_job: PrintJob, tape_params: TapeInfo, is_preview=False, dpi=DEFAULT_PRINTER_DPI):
+        return hash_key(
+            self.__class__.__name__,
+            self.cache_key_salt(),
+            print_job.template.name,
+            print_job.template.raw,
+            # Assets are resolved relative to template directory, so changed logo or stylesheet invalidates the label
+            print_job.template.assets_stamp,
+            print_job.params,
+            self.tape_cache_key(tape_params),
+            is_preview,
+            dpi,
+        )
+
+    def cache_key_salt(self) -> str:
+        """
+        Returns a string identifying everything besides the print job which affects rendering result
+        (e.g. renderer version, built-in stylesheets).
+        """
+        return ""
+
     @abc.abstractmethod
-    def render_bitmap(self, print_job: PrintJob, tape_params: TapeInfo, is_preview=False):
+    def _render_bitmap(self, print_job: PrintJob, tape_params: TapeInfo, is_preview=False, dpi=DEFAULT_PRINTER_DPI):
         pass
 
 
 class TemplateRenderingError(Exception):
     def __init__(self, msg: str, original_error: Exception) -> None:
+        self.__msg = msg
         msg += ": " + str(original_error)
         super().__init__(msg)
         self.original_error = original_error
+
+    def __reduce__(self):
+        return TemplateRenderingError, (self.__msg, self.original_error)
+
+
+class RenderTimeoutError(TemplateRenderingError):
+    """
+    Stage is None when it is unknown (rendered by export worker pool)
+    """
+
+    def __init__(self, template_name: str, timeout: float, stage: Optional[RenderStage]) -> None:
+        super().__init__(
+            "Template {} was not rendered within {}s".format(template_name, timeout),
+            TimeoutError("{} stage overran".format(stage.name.lower()) if stage is not None else "rendering overran"),
+        )
+        self.template_name = template_name
+        self.timeout = timeout
+        self.stage = stage
+
+    def __reduce__(self):
+        return RenderTimeoutError, (self.template_name, self.timeout, self.stage)
@@ -0,0 +1,184 @@
+#
+# Tapen - software for managing label printers
+# Copyright (C) 2022 Dmitry Berezovsky
+#
+# Tapen is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tapen is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.#
+
+import logging
+from io import BytesIO
+from typing import Dict, NamedTuple, Tuple
+
+import weasyprint as wp
+from PIL import Image
+
+from tapen.common.cache import LRUCache
+from tapen.common.domain import PrintJob, Template
+from tapen.printer.common import TapeInfo
+from .cache import hash_key
+from .common import (
+    TemplateProcessor,
+    TemplateDependency,
+    TemplateRenderingError,
+    RenderStage,
+    DEFAULT_PRINTER_DPI,
+    css_px_to_px,
+)
+from .weasyprint import WeasyprintRenderer, PAGE_SIZE_CONFIG_TEMPLATE
+
+LOGGER = logging.getLogger("renderer.compositing")
+
+SLOT_ATTRIBUTE = "data-slot"
+
+SLOT_TEMPLATE = """
+<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+</head>
+<body>
+    <div class="label slot slot-{name}">{content}</div>
+</body>
+</html>
+"""
+
+SLOT_PAGE_CSS = """
+body {
+    padding: 0;
+    width: 100%;
+}
+"""
+
+
+class SlotBox(NamedTuple):
+    x: int
+    y: int
+    width: int
+    height: int
+    width_css_px: float
+    height_css_px: float
+
+
+class SlotCompositingRenderer(WeasyprintRenderer):
+    """
+    Renderer for templates which declare variable regions (slots). The static part of the label is rendered once per
+    template and tape, then for every label only the slots are rendered and composited into the background.
+
+    Layout template marks slot placeholders with data-slot attribute, e.g. <div data-slot="serial"></div>. Placeholders
+    must have fixed size set in css. Content of each slot is defined in manifest under layout.slots.
+    Layout template itself is rendered without params, so everything depending on params must live in slots.
+    """
+
+    def __init__(self, template_processor: TemplateProcessor, max_cached_backgrounds=16) -> None:
+        super().__init__(template_processor)
+        self.__backgrounds: LRUCache[str, Tuple[Image.Image, Dict[str, SlotBox]]] = LRUCache(max_cached_backgrounds)
+
+    @classmethod
+    def can_render(cls, template: Template) -> bool:
+        return len(template.slots) > 0
+
+    def __find_slot_boxes(self, page: wp.Page, dpi: int) -> Dict[str, SlotBox]:
+        result: Dict[str, SlotBox] = {}
+        for box in page._page_box.descendants():
+            element = getattr(box, "element", None)
+            if element is None or not hasattr(element, "get"):
+                continue
+            name = element.get(SLOT_ATTRIBUTE)
+            if name is None or name in result:
+                continue
+            result[name] = SlotBox(
+                x=int(round(css_px_to_px(box.content_box_x(), dpi))),
+                y=int(round(css_px_to_px(box.content_box_y(), dpi))),
+                width=int(round(css_px_to_px(box.width, dpi))),
+                height=int(round(css_px_to_px(box.height, dpi))),
+                width_css_px=box.width,
+                height_css_px=box.height,
+            )
+        return result
+
+    def __render_background(
+        self, template: Template, tape_params: TapeInfo, is_preview: bool, dpi: int
+    ) -> Tuple[Image.Image, Dict[str, SlotBox]]:
+        LOGGER.debug("Rendering static background for template {}".format(template.name))
+        if self.template_processor.get_template_dependency(template) == TemplateDependency.LABEL:
+            LOGGER.warning(
+                "Layout of template {} depends on params. Params are not available for the static part of "
+                "the label, move everything which depends on them into slots.".format(template.name)
+            )
+        with self._stage(RenderStage.TEMPLATE):
+            processing_context = self.create_processing_context(PrintJob(template, {}), tape_params, is_preview)
+            label_html = self.template_processor.process(template, processing_context)
+            html = self._create_html(label_html, template, is_preview)
+            stylesheets = self._create_stylesheets(template, tape_params, processing_context)
+        with self._stage(RenderStage.LAYOUT):
+            document = self._layout(html, stylesheets, tape_params)
+        slot_boxes = self.__find_slot_boxes(document.pages[0], dpi)
+        missing_slots = set(template.slots.keys()) - set(slot_boxes.keys())
+        if len(missing_slots) > 0:
+            raise TemplateRenderingError(
+                "Unable to render template " + template.name,
+                ValueError(
+                    'declared slots are missing in layout: {}. Mark placeholders with {}="slot-name"'.format(
+                        ", ".join(sorted(missing_slots)), SLOT_ATTRIBUTE
+                    )
+                ),
+            )
+        background = self._rasterize(document, dpi).convert("1", dither=Image.Dither.NONE)
+        return background, slot_boxes
+
+    def __get_background(
+        self, template: Template, tape_params: TapeInfo, is_preview: bool, dpi: int
+    ) -> Tuple[Image.Image, Dict[str, SlotBox]]:
+        key = hash_key(template.name, template.raw, self.tape_cache_key(tape_params), is_preview, dpi)
+        return self.__backgrounds.get_or_create(
+            key, lambda: self.__render_background(template, tape_params, is_preview, dpi)
+        )
+
+    def __render_slot(
+        self, name: str, box: SlotBox, print_job: PrintJob, tape_params: TapeInfo, processing_context, is_preview, dpi
+    ) -> Image.Image:
+        template = print_job.template
+        with self._stage(RenderStage.TEMPLATE):
+            slot_html = self.template_processor.process_string(
+                template.slots[name], "{}/slots/{}".format(template.name, name), processing_context
+            )
+            html = self._create_document(SLOT_TEMPLATE.format(name=name, content=slot_html), template, is_preview)
+            page_config = PAGE_SIZE_CONFIG_TEMPLATE.format(
+                height="{}px".format(box.width_css_px), width="{}px".format(box.height_css_px)
+            )
+            stylesheets = self._create_stylesheets(template, tape_params, processing_context) + [
+                self._create_css(SLOT_PAGE_CSS),
+                self._create_css(page_config),
+            ]
+        with self._stage(RenderStage.LAYOUT):
+            document = self._render_document(html, stylesheets)
+        slot_image = self._rasterize(document, dpi).convert("1", dither=Image.Dither.NONE)
+        return slot_image.crop((0, 0, box.width, box.height))
+
+    def render(self, print_job: PrintJob, tape_params: TapeInfo, is_preview=False, dpi=DEFAULT_PRINTER_DPI):
+        result_png = BytesIO()
+        self._render_bitmap(print_job, tape_params, is_preview, dpi).save(result_png, format="png")
+        result_png.seek(0)
+        return result_png
+
+    def _render_bitmap(self, print_job: PrintJob, tape_params: TapeInfo, is_preview=False, dpi=DEFAULT_PRINTER_DPI):
+        background, slot_boxes = self.__get_background(print_job.template, tape_params, is_preview, dpi)
+        bitmap = background.copy()
+        processing_context = self.create_processing_context(print_job, tape_params, is_preview)
+        for name in print_job.template.slots:
+            box = slot_boxes[name]
+            slot_image = self.__render_slot(name, box, print_job, tape_params, processing_context, is_preview, dpi)
+            bitmap.paste(slot_image, (box.x, box.y))
+        self.job_num += 1
+        self._persist_debug_bitmap(bitmap)
+        return bitmap
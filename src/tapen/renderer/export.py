@@ -0,0 +1,301 @@
+#
+# Tapen - software for managing label printers
+# Copyright (C) 2022 Dmitry Berezovsky
+#
+# Tapen is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tapen is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.#
+
+import abc
+import collections
+import logging
+import multiprocessing
+import zipfile
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from io import BytesIO
+from pathlib import Path
+from typing import Any, BinaryIO, Deque, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from PIL import Image
+from cli_rack.utils import none_throws
+
+from tapen.common.domain import PrintJob
+from tapen.printer.common import TapeInfo
+from .common import Renderer, RenderTimeoutError, DEFAULT_PRINTER_DPI
+from .options import DEFAULT_SHEET_COLUMNS, ExportFormat
+
+LOGGER = logging.getLogger("renderer.export")
+
+DEFAULT_ENCODING_THREADS = 4
+SHEET_GAP_PX = 8
+
+
+class LabelExportWriter(abc.ABC):
+    """
+    Writes rendered labels into a single file. Encoding of every label happens in encode() which is called from worker
+    threads, write() receives encoded labels in the original order. close() finalizes the output, abort() is called
+    instead when export fails and must not leave partially written output behind.
+    """
+
+    def __init__(self, path: Path, dpi=DEFAULT_PRINTER_DPI) -> None:
+        self.path = path
+        self.dpi = dpi
+
+    def encode(self, bitmap: Image.Image) -> Any:
+        return bitmap
+
+    @abc.abstractmethod
+    def write(self, encoded: Any):
+        pass
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
+
+
+class PdfExportWriter(LabelExportWriter):
+    """
+    Multi-page PDF, one label per page. Labels are embedded as 1-bit images at printer resolution, so the page size
+    matches the physical label size.
+    """
+
+    def __init__(self, path: Path, dpi=DEFAULT_PRINTER_DPI) -> None:
+        super().__init__(path, dpi)
+        self.__file: BinaryIO = open(path, "wb")
+        self.__offsets: List[int] = []
+        self.__page_ids: List[int] = []
+        self.__file.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        # Catalog and page tree are written at the end, but their ids are reserved upfront
+        self.__offsets.extend([0, 0])
+
+    def __add_object(self, body: bytes, stream: Optional[bytes] = None) -> int:
+        self.__offsets.append(self.__file.tell())
+        obj_id = len(self.__offsets)
+        self.__write_object(obj_id, body, stream)
+        return obj_id
+
+    def __write_object(self, obj_id: int, body: bytes, stream: Optional[bytes] = None):
+        self.__file.write(b"%d 0 obj\n" % obj_id + body)
+        if stream is not None:
+            self.__file.write(b"\nstream\n" + stream + b"\nendstream")
+        self.__file.write(b"\nendobj\n")
+
+    def encode(self, bitmap: Image.Image) -> Tuple[int, int, bytes]:
+        # zlib releases GIL so pages are compressed in parallel
+        return bitmap.width, bitmap.height, zlib.compress(bitmap.convert("1").tobytes())
+
+    def write(self, encoded: Tuple[int, int, bytes]):
+        width, height, data = encoded
+        width_pt, height_pt = width * 72 / self.dpi, height * 72 / self.dpi
+        image_id = self.__add_object(
+            b"<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace /DeviceGray /BitsPerComponent 1 "
+            b"/Filter /FlateDecode /Length %d >>" % (width, height, len(data)),
+            data,
+        )
+        content = b"q %.4f 0 0 %.4f 0 0 cm /Im0 Do Q" % (width_pt, height_pt)
+        content_id = self.__add_object(b"<< /Length %d >>" % len(content), content)
+        page_id = self.__add_object(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.4f %.4f] /Resources << /XObject << /Im0 %d 0 R >> >> "
+            b"/Contents %d 0 R >>" % (width_pt, height_pt, image_id, content_id)
+        )
+        self.__page_ids.append(page_id)
+
+    def close(self):
+        self.__offsets[0] = self.__file.tell()
+        self.__write_object(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+        self.__offsets[1] = self.__file.tell()
+        kids = b" ".join(b"%d 0 R" % x for x in self.__page_ids)
+        self.__write_object(2, b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(self.__page_ids)))
+        xref_offset = self.__file.tell()
+        self.__file.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(self.__offsets) + 1))
+        for offset in self.__offsets:
+            self.__file.write(b"%010d 00000 n \n" % offset)
+        self.__file.write(
+            b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(self.__offsets) + 1, xref_offset)
+        )
+        self.__file.close()
+
+    def abort(self):
+        self.__file.close()
+        self.path.unlink(missing_ok=True)
+
+
+class ContactSheetWriter(LabelExportWriter):
+    """
+    Single PNG with all labels arranged in rows of the given number of columns. Every label is pasted into the sheet
+    as soon as it is written, so only the sheet itself is kept in memory. Sheet grows when it runs out of space.
+    """
+
+    def __init__(self, path: Path, dpi=DEFAULT_PRINTER_DPI, columns=DEFAULT_SHEET_COLUMNS) -> None:
+        super().__init__(path, dpi)
+        self.columns = columns
+        self.__sheet: Optional[Image.Image] = None
+        self.__count = 0
+        self.__x = self.__y = SHEET_GAP_PX
+        self.__row_height = 0
+        self.__used_size = (0, 0)
+
+    def encode(self, bitmap: Image.Image) -> Image.Image:
+        # Label bounds, labels themselves are white
+        framed = Image.new("1", (bitmap.width + 2, bitmap.height + 2), 0)
+        framed.paste(bitmap.convert("1"), (1, 1))
+        return framed
+
+    def write(self, encoded: Image.Image):
+        if self.__count > 0 and self.__count % self.columns == 0:
+            self.__x, self.__y = SHEET_GAP_PX, self.__y + self.__row_height + SHEET_GAP_PX
+            self.__row_height = 0
+        self.__ensure_size(self.__x + encoded.width + SHEET_GAP_PX, self.__y + encoded.height + SHEET_GAP_PX)
+        none_throws(self.__sheet).paste(encoded, (self.__x, self.__y))
+        self.__x += encoded.width + SHEET_GAP_PX
+        self.__row_height = max(self.__row_height, encoded.height)
+        self.__count += 1
+
+    def __ensure_size(self, width: int, height: int):
+        self.__used_size = (max(self.__used_size[0], width), max(self.__used_size[1], height))
+        if self.__sheet is None:
+            self.__sheet = Image.new("1", (width * min(self.columns, 4), height * 2), 1)
+        elif width > self.__sheet.width or height > self.__sheet.height:
+            # Capacity is doubled, so the sheet is copied only a few times
+            sheet = Image.new("1", (max(width, self.__sheet.width * 2), max(height, self.__sheet.height * 2)), 1)
+            sheet.paste(self.__sheet, (0, 0))
+            self.__sheet = sheet
+
+    def close(self):
+        if self.__sheet is None:
+            raise ValueError("Nothing to export")
+        self.__sheet.crop((0, 0) + self.__used_size).save(self.path, format="png", dpi=(self.dpi, self.dpi))
+        self.__sheet = None
+
+    def abort(self):
+        # Sheet is written on close only, so there is no partial output
+        self.__sheet = None
+
+
+class ArchiveExportWriter(LabelExportWriter):
+    """
+    Zip archive of 1-bit PNG files, one per label
+    """
+
+    def __init__(self, path: Path, dpi=DEFAULT_PRINTER_DPI) -> None:
+        super().__init__(path, dpi)
+        self.__archive = zipfile.ZipFile(path, "w", compression=zipfile.ZIP_STORED)
+        self.__count = 0
+
+    def encode(self, bitmap: Image.Image) -> bytes:
+        png = BytesIO()
+        bitmap.convert("1").save(png, format="png", dpi=(self.dpi, self.dpi))
+        return png.getvalue()
+
+    def write(self, encoded: bytes):
+        self.__count += 1
+        # PNG is already compressed
+        self.__archive.writestr("label-{:05d}.png".format(self.__count), encoded)
+
+    def close(self):
+        self.__archive.close()
+
+    def abort(self):
+        self.__archive.close()
+        self.path.unlink(missing_ok=True)
+
+
+def create_export_writer(path: Path, export_format: ExportFormat, dpi=DEFAULT_PRINTER_DPI, **kwargs):
+    if export_format == ExportFormat.PDF:
+        return PdfExportWriter(path, dpi)
+    if export_format == ExportFormat.SHEET:
+        return ContactSheetWriter(path, dpi, **kwargs)
+    return ArchiveExportWriter(path, dpi)
+
+
+def export_bitmaps(
+    bitmaps: Iterable[Image.Image], writer: LabelExportWriter, encoding_threads=DEFAULT_ENCODING_THREADS
+) -> int:
+    """
+    Encodes bitmaps in a thread pool and passes them to the writer preserving order. Number of bitmaps being encoded
+    at the same time is limited, so the whole batch is never held in memory. When rendering or encoding fails the
+    writer is aborted, so no partial output is left, and the original error is propagated.
+    """
+    count = 0
+    pending: Deque[Future] = collections.deque()
+    try:
+        with ThreadPoolExecutor(max_workers=encoding_threads, thread_name_prefix="export") as executor:
+            try:
+                for bitmap in bitmaps:
+                    pending.append(executor.submit(writer.encode, bitmap))
+                    while len(pending) > encoding_threads * 2:
+                        writer.write(pending.popleft().result())
+                        count += 1
+                while len(pending) > 0:
+                    writer.write(pending.popleft().result())
+                    count += 1
+            finally:
+                for future in pending:
+                    future.cancel()
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+    return count
+
+
+__WORKER_STATE: Dict[str, Any] = {}
+
+
+def __init_worker():
+    # Pool workers are daemonic processes which can't fork rendering subprocess, deadline is applied by the parent
+    __WORKER_STATE["renderer"].render_timeout = None
+
+
+def __render_in_worker(print_job: PrintJob) -> Image.Image:
+    return __WORKER_STATE["renderer"].render_bitmap(print_job, __WORKER_STATE["tape"], dpi=__WORKER_STATE["dpi"])
+
+
+def render_bitmaps(
+    renderer: Renderer, print_jobs: Iterable[PrintJob], tape_params: TapeInfo, workers=1, dpi=DEFAULT_PRINTER_DPI
+) -> Iterator[Image.Image]:
+    """
+    Renders print jobs preserving order. When workers > 1 labels are rendered by the pool of forked processes, every
+    worker inherits the renderer along with its warmed up caches. Render timeout is then counted from the moment the
+    label is awaited, and the pool is terminated once it is exceeded.
+    """
+    if workers <= 1 or "fork" not in multiprocessing.get_all_start_methods():
+        for print_job in print_jobs:
+            yield renderer.render_bitmap(print_job, tape_params, dpi=dpi)
+        return
+    timeout = renderer.render_timeout
+    # Jobs are consumed by the pool in order, so the head of the queue is the job whose result is awaited
+    submitted: Deque[PrintJob] = collections.deque()
+
+    def submit(jobs: Iterable[PrintJob]) -> Iterator[PrintJob]:
+        for x in jobs:
+            submitted.append(x)
+            yield x
+
+    __WORKER_STATE.update(renderer=renderer, tape=tape_params, dpi=dpi)
+    try:
+        with multiprocessing.get_context("fork").Pool(workers, initializer=__init_worker) as pool:
+            results = pool.imap(__render_in_worker, submit(print_jobs), chunksize=4 if timeout is None else 1)
+            while True:
+                try:
+                    bitmap = results.next(timeout)
+                except StopIteration:
+                    return
+                except multiprocessing.TimeoutError:
+                    raise RenderTimeoutError(submitted[0].template.name, none_throws(timeout), None)
+                submitted.popleft()
+                yield bitmap
+    finally:
+        __WORKER_STATE.clear()
@@ -0,0 +1,96 @@
+#
+# Tapen - software for managing label printers
+# Copyright (C) 2022 Dmitry Berezovsky
+#
+# Tapen is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tapen is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.#
+
+import logging
+import os
+import threading
+from typing import Any, Dict, Tuple
+from urllib.parse import urlparse
+from urllib.request import url2pathname
+
+import weasyprint as wp
+
+from tapen.common.cache import LRUCache
+
+LOGGER = logging.getLogger("renderer.fetcher")
+
+DEFAULT_MAX_CACHED_ASSETS = 64
+DEFAULT_MAX_CACHED_IMAGES = 256
+
+FileKey = Tuple[str, int, int]
+
+
+class CachingUrlFetcher(object):
+    """
+    WeasyPrint url fetcher which keeps local assets (images, fonts, svgs) in memory. Entries are keyed by file path,
+    modification time and size so changed files are picked up on the next render.
+
+    Decoded images are kept in image_cache which should be passed to WeasyPrint as "cache" option.
+    """
+
+    def __init__(self, max_assets=DEFAULT_MAX_CACHED_ASSETS, max_images=DEFAULT_MAX_CACHED_IMAGES) -> None:
+        super().__init__()
+        self.max_images = max_images
+        self.__assets: LRUCache[FileKey, Dict[str, Any]] = LRUCache(max_assets)
+        # Must be a plain dict: WeasyPrint treats anything else as a path to disk cache
+        self.image_cache: Dict[str, Any] = {}
+        self.__fetched_files: Dict[str, FileKey] = {}
+        self.__lock = threading.Lock()
+
+    def __stat(self, path: str) -> FileKey:
+        stat = os.stat(path)
+        return path, stat.st_mtime_ns, stat.st_size
+
+    def __fetch_file(self, url: str) -> Dict[str, Any]:
+        LOGGER.debug("Fetching {}".format(url))
+        result = wp.default_url_fetcher(url)
+        if "file_obj" in result:
+            with result.pop("file_obj") as f:
+                result["string"] = f.read()
+        return result
+
+    def __call__(self, url: str, timeout=10, ssl_context=None) -> Dict[str, Any]:
+        parsed_url = urlparse(url)
+        if parsed_url.scheme != "file":
+            return wp.default_url_fetcher(url, timeout=timeout, ssl_context=ssl_context)
+        try:
+            key = self.__stat(url2pathname(parsed_url.path))
+        except OSError:
+            # Let WeasyPrint report the error
+            return wp.default_url_fetcher(url, timeout=timeout, ssl_context=ssl_context)
+        with self.__lock:
+            self.__fetched_files[url] = key
+        return dict(self.__assets.get_or_create(key, lambda: self.__fetch_file(url)))
+
+    def prepare_for_render(self):
+        """
+        Must be invoked before each render. Drops decoded images of files modified since they were fetched and keeps
+        image cache bounded. Cache can't be trimmed during rendering as WeasyPrint relies on it until pdf is written.
+        """
+        with self.__lock:
+            for url, key in list(self.__fetched_files.items()):
+                try:
+                    is_modified = self.__stat(key[0]) != key
+                except OSError:
+                    is_modified = True
+                if is_modified:
+                    LOGGER.debug("{} has been modified".format(url))
+                    self.image_cache.pop(url, None)
+                    self.__assets.invalidate(key)
+                    del self.__fetched_files[url]
+            if len(self.image_cache) > self.max_images:
+                self.image_cache.clear()
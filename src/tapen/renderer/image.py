@@ -0,0 +1,101 @@
+#
+# Tapen - software for managing label printers
+# Copyright (C) 2022 Dmitry Berezovsky
+#
+# Tapen is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tapen is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.#
+
+import logging
+from pathlib import Path
+from typing import Union
+
+from PIL import Image, ImageChops
+
+from tapen.printer.common import TapeInfo
+from .common import DEFAULT_PRINTER_DPI, mm_to_px
+from .options import DEFAULT_THRESHOLD, DitherMode
+
+LOGGER = logging.getLogger("renderer.image")
+
+# Normalized 8x8 Bayer matrix
+BAYER_MATRIX_8X8 = (
+    (0, 32, 8, 40, 2, 34, 10, 42),
+    (48, 16, 56, 24, 50, 18, 58, 26),
+    (12, 44, 4, 36, 14, 46, 6, 38),
+    (60, 28, 52, 20, 62, 30, 54, 22),
+    (3, 35, 11, 43, 1, 33, 9, 41),
+    (51, 19, 59, 27, 49, 17, 57, 25),
+    (15, 47, 7, 39, 13, 45, 5, 37),
+    (63, 31, 55, 23, 61, 29, 53, 21),
+)
+
+
+ImageSource = Union[str, Path, Image.Image]
+
+
+def _threshold_map(width: int, height: int) -> Image.Image:
+    size = len(BAYER_MATRIX_8X8)
+    tile = Image.new("L", (size, size))
+    tile.putdata([int((x + 0.5) * 256 / (size * size)) for row in BAYER_MATRIX_8X8 for x in row])
+    result = Image.new("L", (width, height))
+    for y in range(0, height, size):
+        for x in range(0, width, size):
+            result.paste(tile, (x, y))
+    return result
+
+
+def _to_grayscale(image: Image.Image) -> Image.Image:
+    if image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info):
+        # Transparent areas are not printed
+        image = image.convert("RGBA")
+        background = Image.new("RGBA", image.size, (255, 255, 255, 255))
+        image = Image.alpha_composite(background, image)
+    return image.convert("L")
+
+
+def to_monochrome(image: Image.Image, dither=DitherMode.FLOYD_STEINBERG, threshold=DEFAULT_THRESHOLD) -> Image.Image:
+    """
+    Converts image to 1-bit. Every mode is implemented with whole-image PIL operations (lookup tables, channel
+    operations and the native dithering) so there is no per-pixel python code involved.
+    """
+    gray = _to_grayscale(image)
+    if dither == DitherMode.THRESHOLD:
+        return gray.point(lambda x: 255 if x >= threshold else 0, "1")
+    if dither == DitherMode.ORDERED:
+        # Pixel stays white when it is brighter than the threshold map at its position
+        difference = ImageChops.subtract(gray, _threshold_map(*gray.size))
+        return difference.point(lambda x: 255 if x > 0 else 0, "1")
+    return gray.convert("1", dither=Image.Dither.FLOYDSTEINBERG)
+
+
+def image_to_bitmap(
+    source: ImageSource,
+    tape_params: TapeInfo,
+    dither=DitherMode.FLOYD_STEINBERG,
+    threshold=DEFAULT_THRESHOLD,
+    dpi=DEFAULT_PRINTER_DPI,
+) -> Image.Image:
+    """
+    Prepares arbitrary image for printing: scales it to the printable height of the tape preserving aspect ratio,
+    places it between tape paddings and converts to 1-bit.
+    """
+    image = Image.open(source) if isinstance(source, (str, Path)) else source
+    height = int(round(mm_to_px(tape_params.width_mm, dpi)))
+    padding = int(round(mm_to_px(tape_params.padding_vertical_mm, dpi)))
+    printable_height = height - 2 * padding
+    width = max(1, int(round(image.width * printable_height / image.height)))
+    LOGGER.debug("Scaling image {}x{} to {}x{}".format(image.width, image.height, width, printable_height))
+    gray = _to_grayscale(image).resize((width, printable_height), Image.Resampling.LANCZOS)
+    result = Image.new("L", (width, height), 255)
+    result.paste(gray, (0, padding))
+    return to_monochrome(result, dither, threshold)
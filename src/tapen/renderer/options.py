@@ -0,0 +1,51 @@
+#
+# Tapen - software for managing label printers
+# Copyright (C) 2022 Dmitry Berezovsky
+#
+# Tapen is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tapen is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.#
+
+
+"""
+Rendering options referenced by CLI arguments. This module must stay free of heavy dependencies (PIL, WeasyPrint),
+as it is imported on every CLI start.
+"""
+
+from enum import Enum
+from pathlib import Path
+
+DEFAULT_THRESHOLD = 128
+DEFAULT_SHEET_COLUMNS = 4
+
+
+class DitherMode(Enum):
+    THRESHOLD = "threshold"
+    ORDERED = "ordered"
+    FLOYD_STEINBERG = "floyd-steinberg"
+
+
+class ExportFormat(Enum):
+    PDF = "pdf"
+    SHEET = "sheet"
+    ARCHIVE = "zip"
+
+    @classmethod
+    def from_path(cls, path: Path) -> "ExportFormat":
+        suffix = path.suffix.lower()
+        if suffix == ".pdf":
+            return cls.PDF
+        if suffix == ".png":
+            return cls.SHEET
+        if suffix == ".zip":
+            return cls.ARCHIVE
+        raise ValueError("Unable to guess export format from file name {}. Specify it explicitly".format(path.name))
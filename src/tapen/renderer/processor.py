@@ -15,21 +15,96 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.#
 
-from typing import Dict, Any
+import hashlib
+import logging
+from pathlib import Path
+from typing import Dict, Any, Optional, Tuple
 
 import jinja2
+from jinja2 import meta
+from cli_rack.utils import ensure_dir
 
-from .common import TemplateProcessor, TemplateRenderingError
+from tapen.common.cache import LRUCache
+from tapen.common.domain import Template
+from .barcode import BarcodeGenerator
+from .common import TemplateProcessor, TemplateRenderingError, TemplateDependency, TAPE_CONTEXT_VARS
+
+LOGGER = logging.getLogger("renderer.jinja")
+
+DEFAULT_MAX_CACHED_TEMPLATES = 128
 
 
 class JinjaTemplateProcessor(TemplateProcessor):
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        bytecode_cache_dir: Optional[Path] = None,
+        max_cached_templates=DEFAULT_MAX_CACHED_TEMPLATES,
+        barcode_generator: Optional[BarcodeGenerator] = None,
+    ) -> None:
         super().__init__()
-        self.jinja_environment = jinja2.Environment()
+        bytecode_cache: Optional[jinja2.BytecodeCache] = None
+        if bytecode_cache_dir is not None:
+            ensure_dir(str(bytecode_cache_dir))
+            bytecode_cache = jinja2.FileSystemBytecodeCache(str(bytecode_cache_dir))
+        self.jinja_environment = jinja2.Environment(bytecode_cache=bytecode_cache)
+        self.barcode_generator = barcode_generator or BarcodeGenerator()
+        self.jinja_environment.globals.update(
+            code128=self.barcode_generator.code128,
+            qrcode=self.barcode_generator.qr,
+        )
+        self.__compiled_templates: LRUCache[Tuple[str, str], jinja2.Template] = LRUCache(max_cached_templates)
+        self.__dependencies: LRUCache[Tuple[str, str], TemplateDependency] = LRUCache(max_cached_templates)
+
+    def __compile(self, template_str: str, doc_name: str) -> jinja2.Template:
+        env = self.jinja_environment
+        bytecode_cache = env.bytecode_cache
+        if bytecode_cache is None:
+            return env.from_string(template_str, template_class=jinja2.Template)
+        # Environment.from_string never consults bytecode cache, so we do the same as jinja2.BaseLoader.load does
+        bucket = bytecode_cache.get_bucket(env, doc_name, None, template_str)
+        if bucket.code is None:
+            LOGGER.debug("Compiling template {}".format(doc_name))
+            bucket.code = env.compile(template_str, doc_name)
+            bytecode_cache.set_bucket(bucket)
+        return jinja2.Template.from_code(env, bucket.code, env.make_globals(None))
+
+    def __cache_key(self, template_str: str, doc_name: str) -> Tuple[str, str]:
+        return doc_name, hashlib.sha1(template_str.encode("utf-8")).hexdigest()
+
+    def get_template(self, template_str: str, doc_name: str) -> jinja2.Template:
+        return self.__compiled_templates.get_or_create(
+            self.__cache_key(template_str, doc_name), lambda: self.__compile(template_str, doc_name)
+        )
+
+    def __analyze(self, template_str: str, doc_name: str) -> TemplateDependency:
+        try:
+            variables = meta.find_undeclared_variables(self.jinja_environment.parse(template_str, doc_name))
+            # Globals (barcode helpers, range, etc.) are the same for every label
+            variables -= self.jinja_environment.globals.keys()
+        except jinja2.TemplateSyntaxError:
+            # Let processing report the error
+            return TemplateDependency.LABEL
+        if len(variables) == 0:
+            return TemplateDependency.STATIC
+        if variables.issubset(TAPE_CONTEXT_VARS):
+            return TemplateDependency.TAPE
+        return TemplateDependency.LABEL
+
+    def prepare(self, template: Template):
+        self.get_template(template.layout_template, template.name)
+        if template.layout_css is not None:
+            self.get_template(template.layout_css, template.name + "/css")
+        for name, slot in template.slots.items():
+            self.get_template(slot, "{}/slots/{}".format(template.name, name))
+        self.get_template_dependency(template)
+
+    def get_dependency(self, template_str: str, doc_name: str) -> TemplateDependency:
+        return self.__dependencies.get_or_create(
+            self.__cache_key(template_str, doc_name), lambda: self.__analyze(template_str, doc_name)
+        )
 
     def process_string(self, template_str: str, doc_name: str, context: Dict[str, Any]):
-        jinja_template = self.jinja_environment.from_string(template_str, template_class=jinja2.Template)
         try:
-            return jinja_template.render(context)
+            return self.get_template(template_str, doc_name).render(context)
         except jinja2.TemplateError as e:
             raise TemplateRenderingError('Error in template "{}": {}'.format(doc_name, str(e)), e) from e
@@ -0,0 +1,197 @@
+#
+# Tapen - software for managing label printers
+# Copyright (C) 2022 Dmitry Berezovsky
+#
+# Tapen is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tapen is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.#
+
+import functools
+import logging
+import math
+import os
+import shutil
+import subprocess
+from html.parser import HTMLParser
+from io import BytesIO
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import PIL
+from PIL import Image, ImageDraw, ImageFont
+from cli_rack.utils import ensure_dir
+
+from tapen import config, const
+from tapen.common.cache import LRUCache
+from tapen.common.domain import PrintJob, Template
+from tapen.printer.common import TapeInfo
+from .common import Renderer, RenderStage, TemplateProcessor, DEFAULT_PRINTER_DPI, find_fit_scale, mm_to_px
+
+LOGGER = logging.getLogger("renderer.text")
+
+# Same font stack as in default.css
+DEFAULT_FONT = "Helvetica Neue,Verdana,sans-serif"
+FALLBACK_FONT_FILE = "DejaVuSans.ttf"
+
+FontType = ImageFont.FreeTypeFont | ImageFont.ImageFont
+
+
+class _TextExtractor(HTMLParser):
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        self.chunks: List[str] = []
+
+    def handle_data(self, data: str) -> None:
+        self.chunks.append(data)
+
+
+def html_to_text(html: str) -> str:
+    """
+    Extracts text content from html fragment collapsing whitespaces the same way browser does for inline content
+    """
+    parser = _TextExtractor()
+    parser.feed(html)
+    parser.close()
+    return " ".join(" ".join(parser.chunks).split())
+
+
+@functools.lru_cache(maxsize=32)
+def resolve_font_file(font: str) -> Optional[str]:
+    """
+    Resolves font file path for the given font. Font could be either path to the font file or fontconfig pattern.
+    """
+    if os.path.isfile(font):
+        return font
+    fc_match = shutil.which("fc-match")
+    if fc_match is not None:
+        try:
+            result = subprocess.run([fc_match, "-f", "%{file}", font], capture_output=True, text=True, timeout=5)
+            if result.returncode == 0 and os.path.isfile(result.stdout):
+                return result.stdout
+        except (OSError, subprocess.SubprocessError) as e:
+            LOGGER.debug("Unable to resolve font {} with fontconfig: {}".format(font, e))
+    return None
+
+
+class TextRenderer(Renderer):
+    """
+    Lightweight renderer for templates producing a single line of text. It draws text directly with PIL which is
+    order of magnitude faster than going through html layout and pdf rasterization.
+    """
+
+    def __init__(self, template_processor: TemplateProcessor) -> None:
+        super().__init__()
+        self.template_processor = template_processor
+        self.__fonts: LRUCache[Tuple[str, int], Tuple[FontType, Tuple[int, int]]] = LRUCache(32)
+        self.__text_widths: LRUCache[Tuple[str, int, str], int] = LRUCache(1024)
+
+    @classmethod
+    def can_render(cls, template: Template) -> bool:
+        return template.renderer == const.RENDERER_TEXT and template.layout_css is None
+
+    def cache_key_salt(self) -> str:
+        return "text/pillow-{}".format(PIL.__version__)
+
+    def __generate_temp_file(self, file_name: str) -> Path:
+        path = Path(config.app_dirs.user_cache_dir) / "debug"
+        ensure_dir(str(path))
+        return path / file_name
+
+    def __load_font(self, font: str, size: int) -> FontType:
+        font_file = resolve_font_file(font) or FALLBACK_FONT_FILE
+        try:
+            return ImageFont.truetype(font_file, size)
+        except OSError:
+            LOGGER.warning("Font {} is not available, falling back to default font".format(font))
+        try:
+            return ImageFont.load_default(size)
+        except TypeError:
+            # Pillow < 10.1 doesn't support scalable default font
+            return ImageFont.load_default()
+
+    def get_font(self, font: str, size: int) -> Tuple[FontType, Tuple[int, int]]:
+        """
+        Returns font object along with its (ascent, descent) metrics
+        """
+
+        def factory():
+            font_obj = self.__load_font(font, size)
+            return font_obj, font_obj.getmetrics()
+
+        return self.__fonts.get_or_create((font, size), factory)
+
+    def measure_text(self, font: str, size: int, text: str) -> int:
+        def factory():
+            font_obj, _ = self.get_font(font, size)
+            return int(math.ceil(font_obj.getlength(text)))
+
+        return self.__text_widths.get_or_create((font, size, text), factory)
+
+    def fit_font_size(self, font: str, size: int, text: str, target_width: int) -> int:
+        """
+        Returns the largest font size (up to size) for which text fits target_width pixels
+        """
+
+        def scaled_size(scale: float) -> int:
+            return max(1, int(size * scale))
+
+        scale = find_fit_scale(lambda x: self.measure_text(font, scaled_size(x), text), target_width)
+        return scaled_size(scale)
+
+    def __draw(self, print_job: PrintJob, tape_params: TapeInfo, is_preview=False, dpi=DEFAULT_PRINTER_DPI):
+        with self._stage(RenderStage.TEMPLATE):
+            processing_context = self.create_processing_context(print_job, tape_params, is_preview)
+            text = html_to_text(self.template_processor.process(print_job.template, processing_context))
+        with self._stage(RenderStage.RASTER):
+            return self.__draw_text(text, print_job, tape_params, dpi)
+
+    def __draw_text(self, text: str, print_job: PrintJob, tape_params: TapeInfo, dpi=DEFAULT_PRINTER_DPI):
+        font_name = print_job.template.font or DEFAULT_FONT
+        padding_px = mm_to_px(tape_params.padding_vertical_mm, dpi)
+        # Font size and line height are set to the printable height, the same as BASELINE_FONT does for html templates
+        line_height = int(round(mm_to_px(tape_params.width_mm - 2 * tape_params.padding_vertical_mm, dpi)))
+        height = int(round(mm_to_px(tape_params.width_mm, dpi)))
+        font_size = line_height
+        fit_width_mm = print_job.template.fit_width_mm
+        if fit_width_mm is not None:
+            width = max(int(round(mm_to_px(fit_width_mm, dpi))), 1)
+            font_size = self.fit_font_size(font_name, line_height, text, width)
+        else:
+            width = max(self.measure_text(font_name, font_size, text), 1)
+        font, (ascent, descent) = self.get_font(font_name, font_size)
+        image = Image.new("L", (width, height), 255)
+        if text:
+            half_leading = (line_height - (ascent + descent)) / 2
+            ImageDraw.Draw(image).text((0, padding_px + half_leading), text, font=font, fill=0)
+        self.job_num += 1
+        return image
+
+    def _warm_up_template(self, template: Template, tape_params: TapeInfo):
+        self.template_processor.prepare(template)
+        line_height = int(round(mm_to_px(tape_params.width_mm - 2 * tape_params.padding_vertical_mm)))
+        self.get_font(template.font or DEFAULT_FONT, line_height)
+
+    def render(self, print_job: PrintJob, tape_params: TapeInfo, is_preview=False, dpi=DEFAULT_PRINTER_DPI):
+        result_png = BytesIO()
+        self.__draw(print_job, tape_params, is_preview, dpi).save(result_png, format="png")
+        result_png.seek(0)
+        return result_png
+
+    def _render_bitmap(self, print_job: PrintJob, tape_params: TapeInfo, is_preview=False, dpi=DEFAULT_PRINTER_DPI):
+        image = self.__draw(print_job, tape_params, is_preview, dpi)
+        with self._profile("convert-1bit"):
+            bitmap = image.convert("1", dither=0)
+        if self.persist_rendered_image_as_file:
+            path = self.__generate_temp_file("rendered-label-{}.bmp".format(self.job_num))
+            LOGGER.debug("Persisting rendered bitmap at {}".format(path))
+            bitmap.save(path)
+        return bitmap
@@ -15,18 +15,35 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.#
 
+import hashlib
 import logging
+import math
+import os
 from io import BytesIO
 from pathlib import Path
-from typing import Optional
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, TypeVar
 
 import poppler
 import weasyprint as wp
+from weasyprint.text.fonts import FontConfiguration
 from PIL import Image
-from cli_rack.utils import ensure_dir
+from cli_rack.utils import ensure_dir, none_throws
 
-from tapen.common.domain import PrintJob
-from .common import Renderer, TemplateProcessor
+from tapen.common.domain import PrintJob, Template
+from tapen.common.cache import LRUCache
+from .cache import hash_key
+from .fetcher import CachingUrlFetcher
+from .common import (
+    Renderer,
+    TemplateProcessor,
+    TemplateDependency,
+    DEFAULT_PRINTER_DPI,
+    DEFAULT_RENDERER_DPI,
+    PDF_POINTS_PER_INCH,
+    RenderStage,
+    find_fit_scale,
+    mm_to_css_px,
+)
 from .. import config
 from ..printer.common import TapeInfo
 
@@ -64,7 +81,14 @@ body {{
 
 LOGGER = logging.getLogger("renderer.weasyprint")
 
-DEFAULT_RENDERER_DPI = 96
+T = TypeVar("T")
+
+DEFAULT_MAX_PAGE_WIDTH_PX = 9000
+# Upper bound for the label length in tiled mode (~130m)
+MAX_TILED_PAGE_WIDTH_PX = 500000
+DEFAULT_STRIP_WIDTH_PX = 256
+# Precision of the font scale used as a part of measurement cache key
+FIT_SCALE_PRECISION = 4
 
 
 class WeasyprintRenderer(Renderer):
@@ -72,6 +96,21 @@ class WeasyprintRenderer(Renderer):
         super().__init__()
         self.template_processor = template_processor
         self.pdf_page_renderer = poppler.PageRenderer()
+        self.url_fetcher = CachingUrlFetcher()
+        # Shared between renders so fonts are discovered and loaded only once
+        self.font_config = FontConfiguration()
+        self.__cache_key_salt: Optional[str] = None
+        # Processed templates and parsed stylesheets which do not depend on label params
+        self.__reusable_parts: LRUCache[Tuple, Any] = LRUCache(64)
+        # Label widths measured while searching for the font scale in fit_width mode
+        self.__fit_measurements: LRUCache[str, float] = LRUCache(1024)
+
+    def cache_key_salt(self) -> str:
+        if self.__cache_key_salt is None:
+            with open(self.__get_resource_path("default.css"), "rb") as f:
+                css_hash = hashlib.sha1(f.read()).hexdigest()
+            self.__cache_key_salt = "weasyprint-{}/{}".format(wp.__version__, css_hash)
+        return self.__cache_key_salt
 
     def __get_resource_path(self, name: str):
         path = RESOURCES_DIR / name
@@ -84,15 +123,18 @@ class WeasyprintRenderer(Renderer):
         ensure_dir(str(path))
         return path / file_name
 
-    def __page_config_css(self, tape_params: TapeInfo, width_px: float | None = None) -> str:
+    def __page_config_css(
+        self, tape_params: TapeInfo, width_px: float | None = None, max_width_px=DEFAULT_MAX_PAGE_WIDTH_PX
+    ) -> str:
         return PAGE_SIZE_CONFIG_TEMPLATE.format(
-            width="{}mm".format(tape_params.width_mm), height="9000px" if width_px is None else str(width_px) + "px"
+            width="{}mm".format(tape_params.width_mm),
+            height="{}px".format(max_width_px) if width_px is None else str(width_px) + "px",
         )
 
-    def __page_set_baseline_font(self, tape_params: TapeInfo) -> str:
+    def __page_set_baseline_font(self, tape_params: TapeInfo, font_scale=1.0) -> str:
         printable_height = tape_params.width_mm - 2 * tape_params.padding_vertical_mm
         return BASELINE_FONT.format(
-            size="{}mm".format(printable_height),
+            size="{}mm".format(printable_height * font_scale),
             line_height="{}mm".format(printable_height),
             padding_top="{}mm".format(tape_params.padding_vertical_mm),
             padding_bottom="{}mm".format(tape_params.padding_vertical_mm),
@@ -107,60 +149,285 @@ class WeasyprintRenderer(Renderer):
         except Exception:
             return None
 
-    def __create_processing_context(self, print_job: PrintJob, tape_params: TapeInfo, is_preview=False):
-        return dict(params=print_job.params, param=print_job.params, tape=tape_params, is_preview=is_preview)
+    def __reuse_across_labels(
+        self,
+        kind: Tuple,
+        template_str: str,
+        doc_name: str,
+        processing_context: Dict[str, Any],
+        factory: Callable[[], T],
+    ) -> T:
+        """
+        Invokes factory only when result could differ from the previous invocations according to the template
+        dependencies. Results of static and tape-only templates are shared between labels.
+        """
+        dependency = self.template_processor.get_dependency(template_str, doc_name)
+        if dependency == TemplateDependency.LABEL:
+            return factory()
+        key: Tuple = kind + (doc_name, hashlib.sha1(template_str.encode("utf-8")).hexdigest())
+        if dependency == TemplateDependency.TAPE:
+            key += (self.tape_cache_key(processing_context["tape"]), processing_context["is_preview"])
+        return self.__reusable_parts.get_or_create(key, factory)
+
+    def _process_layout(self, template: Template, processing_context: Dict[str, Any]) -> str:
+        return self.__reuse_across_labels(
+            ("html",),
+            template.layout_template,
+            template.name,
+            processing_context,
+            lambda: self.template_processor.process(template, processing_context),
+        )
+
+    def _get_base_url(self, template: Template) -> Optional[str]:
+        return os.path.join(template.path, "") if template.path is not None else None
+
+    def _create_document(self, html_str: str, template: Template, is_preview=False) -> wp.HTML:
+        # Every render starts with the document creation, so this is the right moment to refresh assets cache
+        self.url_fetcher.prepare_for_render()
+        return wp.HTML(
+            string=html_str,
+            media_type="screen" if is_preview else "print",
+            base_url=self._get_base_url(template),
+            url_fetcher=self.url_fetcher,
+        )
+
+    def _create_html(self, label_html: str, template: Template, is_preview=False) -> wp.HTML:
+        return self._create_document(BASE_TEMPLATE.format(content=label_html), template, is_preview)
+
+    def _create_css(self, css: str, template: Optional[Template] = None) -> wp.CSS:
+        return wp.CSS(
+            string=css,
+            base_url=self._get_base_url(template) if template is not None else None,
+            url_fetcher=self.url_fetcher,
+            font_config=self.font_config,
+        )
 
-    def render(self, print_job: PrintJob, tape_params: TapeInfo, is_preview=False, dpi=180):
-        processing_context = self.__create_processing_context(print_job, tape_params, is_preview)
-        label_html = self.template_processor.process(print_job.template, processing_context)
+    def _render_document(self, html: wp.HTML, stylesheets: List[wp.CSS]) -> wp.Document:
+        return html.render(stylesheets=stylesheets, font_config=self.font_config, cache=self.url_fetcher.image_cache)
 
-        html = wp.HTML(string=BASE_TEMPLATE.format(content=label_html), media_type="screen" if is_preview else "print")
-        # Page Size config
-        page_config = self.__page_config_css(tape_params)
-        auto_width_mode = True
+    def _create_stylesheets(
+        self, template: Template, tape_params: TapeInfo, processing_context: Dict[str, Any], font_scale=1.0
+    ) -> List[wp.CSS]:
         stylesheets = [
-            wp.CSS(filename=self.__get_resource_path("default.css")),
-            wp.CSS(string=self.__page_set_baseline_font(tape_params)),
+            self.__reusable_parts.get_or_create(
+                ("default.css",),
+                lambda: wp.CSS(filename=self.__get_resource_path("default.css"), font_config=self.font_config),
+            ),
+            self.__reusable_parts.get_or_create(
+                ("baseline", self.tape_cache_key(tape_params), font_scale),
+                lambda: self._create_css(self.__page_set_baseline_font(tape_params, font_scale)),
+            ),
         ]
-        if print_job.template.layout_css is not None:
-            label_css = self.template_processor.process_string(
-                print_job.template.layout_css, print_job.template.name + "/css", processing_context
+        layout_css = template.layout_css
+        if layout_css is not None:
+            doc_name = template.name + "/css"
+            stylesheets.append(
+                self.__reuse_across_labels(
+                    # Parsed stylesheet holds base url, so it can't be shared between templates from different dirs
+                    ("css", template.path),
+                    layout_css,
+                    doc_name,
+                    processing_context,
+                    lambda: self._create_css(
+                        self.template_processor.process_string(layout_css, doc_name, processing_context), template
+                    ),
+                )
             )
-            stylesheets.append(wp.CSS(string=label_css))
-        if auto_width_mode:
-            rendered_label = html.render(stylesheets=stylesheets + [wp.CSS(string=page_config)])
-            calculated_width_px = self.__find_body_width(rendered_label.pages[0])
-            page_config = self.__page_config_css(tape_params, calculated_width_px)
-        rendered_label = html.render(stylesheets=stylesheets + [wp.CSS(string=page_config)])
-        result_pdf, result_png = BytesIO(), BytesIO()
-        rendered_label.write_pdf(result_pdf, zoom=dpi / DEFAULT_RENDERER_DPI, dpi=dpi)
-        result_pdf.seek(0)
-        pdf = poppler.load(result_pdf)
-        rendered_image = self.pdf_page_renderer.render_page(pdf.create_page(0))
-        pil_image = Image.frombytes(
+        return stylesheets
+
+    def __measure_body_width(
+        self, html: wp.HTML, stylesheets: List[wp.CSS], tape_params: TapeInfo, max_width_px=DEFAULT_MAX_PAGE_WIDTH_PX
+    ) -> Optional[float]:
+        page_config = self.__page_config_css(tape_params, max_width_px=max_width_px)
+        rendered_label = self._render_document(html, stylesheets + [self._create_css(page_config)])
+        return self.__find_body_width(rendered_label.pages[0])
+
+    def _layout(
+        self,
+        html: wp.HTML,
+        stylesheets: List[wp.CSS],
+        tape_params: TapeInfo,
+        max_width_px=DEFAULT_MAX_PAGE_WIDTH_PX,
+        width_px: Optional[float] = None,
+    ) -> wp.Document:
+        """
+        Lays out the label on a page of width_px css pixels. When width isn't given the label is laid out twice: first
+        pass measures the content width on a page of max_width_px.
+        """
+        if width_px is None:
+            with self._profile("layout-pass-1"):
+                width_px = self.__measure_body_width(html, stylesheets, tape_params, max_width_px)
+        with self._profile("layout-pass-2"):
+            page_config = self.__page_config_css(tape_params, width_px, max_width_px)
+            return self._render_document(html, stylesheets + [self._create_css(page_config)])
+
+    def _layout_to_fit(
+        self,
+        print_job: PrintJob,
+        label_html: str,
+        html: wp.HTML,
+        tape_params: TapeInfo,
+        processing_context: Dict[str, Any],
+        max_width_px=DEFAULT_MAX_PAGE_WIDTH_PX,
+    ) -> wp.Document:
+        """
+        Lays out the label on a page of template.fit_width_mm shrinking the font until content fits. Every probe of the
+        search is a complete layout pass: styles are computed before layout starts, so WeasyPrint can't re-measure the
+        box with another font size within the same layout. Measured widths are memoized so repeated labels skip the
+        search entirely.
+        """
+        template = print_job.template
+        fit_width_mm = none_throws(template.fit_width_mm)
+        target_width_px = mm_to_css_px(fit_width_mm)
+        label_key = (
+            template.name,
+            template.path,
+            label_html,
+            template.layout_css,
+            print_job.params,
+            self.tape_cache_key(tape_params),
+            processing_context["is_preview"],
+        )
+
+        def measure(font_scale: float) -> float:
+            font_scale = round(font_scale, FIT_SCALE_PRECISION)
+            return self.__fit_measurements.get_or_create(
+                hash_key(*label_key, font_scale),
+                lambda: self.__measure_body_width(
+                    html,
+                    self._create_stylesheets(template, tape_params, processing_context, font_scale),
+                    tape_params,
+                    max_width_px,
+                )
+                or 0,
+            )
+
+        font_scale = round(find_fit_scale(measure, target_width_px), FIT_SCALE_PRECISION)
+        if font_scale < 1.0:
+            LOGGER.debug("Font scaled down to {:.3f} to fit {}mm".format(font_scale, fit_width_mm))
+        stylesheets = self._create_stylesheets(template, tape_params, processing_context, font_scale)
+        return self._layout(html, stylesheets, tape_params, max_width_px, width_px=target_width_px)
+
+    def _layout_label(
+        self,
+        print_job: PrintJob,
+        tape_params: TapeInfo,
+        is_preview=False,
+        max_width_px=DEFAULT_MAX_PAGE_WIDTH_PX,
+    ) -> wp.Document:
+        with self._stage(RenderStage.TEMPLATE):
+            processing_context = self.create_processing_context(print_job, tape_params, is_preview)
+            label_html = self._process_layout(print_job.template, processing_context)
+            html = self._create_html(label_html, print_job.template, is_preview)
+        if print_job.template.fit_width_mm is not None:
+            with self._stage(RenderStage.LAYOUT):
+                return self._layout_to_fit(print_job, label_html, html, tape_params, processing_context, max_width_px)
+        with self._stage(RenderStage.TEMPLATE):
+            stylesheets = self._create_stylesheets(print_job.template, tape_params, processing_context)
+        with self._stage(RenderStage.LAYOUT):
+            return self._layout(html, stylesheets, tape_params, max_width_px)
+
+    def _write_pdf(self, document: wp.Document, dpi=DEFAULT_PRINTER_DPI) -> BytesIO:
+        with self._stage(RenderStage.PDF):
+            result_pdf = BytesIO()
+            document.write_pdf(result_pdf, zoom=dpi / DEFAULT_RENDERER_DPI, dpi=dpi)
+            result_pdf.seek(0)
+            return result_pdf
+
+    def _rasterize(self, document: wp.Document, dpi=DEFAULT_PRINTER_DPI) -> Image.Image:
+        pdf_file = self._write_pdf(document, dpi)
+        with self._stage(RenderStage.RASTER):
+            with self._profile("poppler-render"):
+                pdf = poppler.load(pdf_file)
+                rendered_image = self.pdf_page_renderer.render_page(pdf.create_page(0))
+            return self.__poppler_image_to_pil(rendered_image)
+
+    def __poppler_image_to_pil(self, rendered_image) -> Image.Image:
+        return Image.frombytes(
             "RGBA",
             (rendered_image.width, rendered_image.height),
             rendered_image.data,
             "raw",
             str(rendered_image.format),
         )
-        pil_image.save(result_png, format="png")
-        result_png.flush()
-        result_png.seek(0)
+
+    def _persist_debug_bitmap(self, bitmap: Image.Image):
+        if self.persist_rendered_image_as_file:
+            path = self.__generate_temp_file("rendered-label-{}.bmp".format(self.job_num))
+            LOGGER.debug("Persisting rendered bitmap at {}".format(path))
+            bitmap.save(path)
+
+    def render(self, print_job: PrintJob, tape_params: TapeInfo, is_preview=False, dpi=DEFAULT_PRINTER_DPI):
+        rendered_label = self._layout_label(print_job, tape_params, is_preview)
+        pil_image = self._rasterize(rendered_label, dpi)
+        with self._profile("png-encode"):
+            result_png = BytesIO()
+            pil_image.save(result_png, format="png")
+            result_png.flush()
+            result_png.seek(0)
         self.job_num += 1
         if self.persist_rendered_image_as_file:
             path = self.__generate_temp_file("rendered-label-{}.png".format(self.job_num))
             with open(path, "wb") as f:
                 LOGGER.debug("Persisting generated image at {}".format(path))
                 f.write(result_png.read())
+            result_png.seek(0)
         return result_png
 
-    def render_bitmap(self, print_job: PrintJob, tape_params: TapeInfo, is_preview=False, dpi=180):
-        png = self.render(print_job, tape_params, is_preview, dpi)
-        bitmap = Image.open(png, "r", ("png",)).convert("1", dither=0)
-        if self.persist_rendered_image_as_file:
-            path = self.__generate_temp_file("rendered-label-{}.bmp".format(self.job_num))
-            LOGGER.debug("Persisting rendered bitmap at {}".format(path))
-            bitmap.save(path)
+    def render_bitmap_strips(
+        self,
+        print_job: PrintJob,
+        tape_params: TapeInfo,
+        is_preview=False,
+        dpi=DEFAULT_PRINTER_DPI,
+        strip_width_px=DEFAULT_STRIP_WIDTH_PX,
+    ) -> Iterator[Image.Image]:
+        """
+        Tiled rendering mode. Label is laid out once and converted to (vector) pdf, then the pdf page is rasterized by
+        strips of strip_width_px pixels. Peak memory doesn't depend on the label length.
+        Layout and pdf are produced before returning, only strips are rasterized while the result is consumed.
+        """
+        self.wait_for_warm_up()
+        document = self._layout_label(print_job, tape_params, is_preview, max_width_px=MAX_TILED_PAGE_WIDTH_PX)
+        pdf_file = self._write_pdf(document, dpi)
+        del document
+        pdf = poppler.load(pdf_file)
+        page = pdf.create_page(0)
+        self.job_num += 1
+        return self.__rasterize_strips(pdf, page, strip_width_px)
+
+    def __rasterize_strips(self, pdf, page, strip_width_px: int) -> Iterator[Image.Image]:
+        # Document is passed along with the page to keep it alive while strips are rasterized
+        page_rect = page.page_rect()
+        # pdf is rasterized at 72dpi, so pdf points are equal to pixels
+        total_width, total_height = int(math.ceil(page_rect.width)), int(math.ceil(page_rect.height))
+        LOGGER.debug("Rendering label of {}px in strips of {}px".format(total_width, strip_width_px))
+        for x in range(0, total_width, strip_width_px):
+            with self._stage(RenderStage.RASTER):
+                rendered_image = self.pdf_page_renderer.render_page(
+                    page,
+                    PDF_POINTS_PER_INCH,
+                    PDF_POINTS_PER_INCH,
+                    x,
+                    0,
+                    min(strip_width_px, total_width - x),
+                    total_height,
+                )
+                strip = self.__poppler_image_to_pil(rendered_image).convert("1", dither=Image.Dither.NONE)
+            yield strip
 
+    def _warm_up_template(self, template: Template, tape_params: TapeInfo):
+        self.template_processor.prepare(template)
+        # Parsing stylesheets registers @font-face rules and loads fonts. It works for templates with static css only
+        processing_context = self.create_processing_context(PrintJob(template, {}), tape_params)
+        self._create_stylesheets(template, tape_params, processing_context)
+
+    def _render_bitmap(self, print_job: PrintJob, tape_params: TapeInfo, is_preview=False, dpi=DEFAULT_PRINTER_DPI):
+        png = self.render(print_job, tape_params, is_preview, dpi)
+        with self._profile("png-decode"):
+            image = Image.open(png, "r", ("png",))
+            image.load()
+        with self._profile("convert-1bit"):
+            bitmap = image.convert("1", dither=Image.Dither.NONE)
+        self._persist_debug_bitmap(bitmap)
         return bitmap
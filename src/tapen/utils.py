@@ -15,6 +15,8 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.#
 
+from typing import Union
+
 import yaml
 
 
@@ -23,6 +25,10 @@ def yaml_file_to_dict(yaml_file: str) -> dict:
         return yaml.load(f, Loader=yaml.FullLoader)
 
 
+def yaml_to_dict(yaml_str: Union[str, bytes]) -> dict:
+    return yaml.load(yaml_str, Loader=yaml.FullLoader)
+
+
 def dict_to_yaml_file(yaml_dict: dict, yaml_file: str):
     with open(yaml_file, "w") as f:
         return yaml.dump(yaml_dict, f)
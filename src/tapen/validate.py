@@ -16,7 +16,9 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.#
 
 import re
-from typing import Dict, Callable, Any
+import time
+from types import MappingProxyType
+from typing import Dict, Callable, Any, Iterable, List, Mapping, Optional, Tuple
 
 from cli_rack_validation import crv
 from string import ascii_letters, digits
@@ -81,21 +83,25 @@ class _ObjectValidators:
     def __init__(self) -> None:
         super().__init__()
         self.__cache_initialized = False
-        self.__cache: Dict[str, Any] = {}
+        self.__cache: Mapping[str, Any] = MappingProxyType({})
 
     def build_cache(self):
+        cache: Dict[str, Any] = {}
         for x in dir(crv):
             if x.startswith("_") or x.isupper():
                 continue
-            self.__cache[x] = getattr(crv, x)
-        self.__cache["int"] = self.__cache["int_"]
-        self.__cache["float"] = self.__cache["float_"]
-        self.__cache["string"] = self.__cache["string"]
-        self.__cache["object"] = object
-        self.__cache["object_list"] = object_list
+            cache[x] = getattr(crv, x)
+        cache["int"] = cache["int_"]
+        cache["float"] = cache["float_"]
+        cache["string"] = cache["string"]
+        cache["object"] = object
+        cache["object_list"] = object_list
+        # Registry is immutable once built
+        self.__cache = MappingProxyType(cache)
+        self.__cache_initialized = True
 
     @property
-    def validators(self):
+    def validators(self) -> Mapping[str, Any]:
         if not self.__cache_initialized:
             self.build_cache()
         return self.__cache
@@ -178,9 +184,145 @@ valid_object_def = crv.ensure_schema(
 )
 
 
+# Same as valid_object_def, but keeps validators as (serializable) definitions. Use bind_validators to get functions
+normalized_object_def = crv.ensure_schema(
+    {
+        valid_param_name: {
+            crv.Optional(const.C_DESCRIPTION): crv.string_strict,
+            crv.Optional(const.C_DEFAULT): crv.anything,
+            crv.Optional(const.C_REQUIRED, default=True): crv.boolean,
+            crv.Optional(const.C_VALIDATOR): ensure_validator_def,
+        }
+    }
+)
+
+
+def bind_validators(object_def: Dict[str, Dict]) -> Dict[str, Dict]:
+    """Converts validator definitions of normalized object definition into validation functions"""
+    result = {}
+    for name, cfg in object_def.items():
+        if const.C_VALIDATOR in cfg:
+            cfg = dict(cfg)
+            cfg[const.C_VALIDATOR] = ObjectValidators.validator_def_to_fn(cfg[const.C_VALIDATOR])
+        result[name] = cfg
+    return result
+
+
+class RowError(object):
+    def __init__(self, row_num: int, param: Optional[str], message: str) -> None:
+        self.row_num = row_num
+        self.param = param
+        self.message = message
+
+    def __str__(self) -> str:
+        if self.param is None:
+            return "Row {}: {}".format(self.row_num, self.message)
+        return "Row {}, {}: {}".format(self.row_num, self.param, self.message)
+
+
+class BulkValidationResult(object):
+    def __init__(self, rows: List[Dict[str, Any]], errors: List[RowError], elapsed_sec: float) -> None:
+        self.rows = rows
+        self.errors = errors
+        self.elapsed_sec = elapsed_sec
+
+    @property
+    def is_valid(self) -> bool:
+        return len(self.errors) == 0
+
+    @property
+    def rows_per_sec(self) -> float:
+        return len(self.rows) / self.elapsed_sec if self.elapsed_sec > 0 else float("inf")
+
+
+class _ParamColumn(object):
+    def __init__(self, name: str, cfg: Dict[str, Any]) -> None:
+        self.name = name
+        self.required = cfg.get(const.C_REQUIRED, True)
+        self.default = cfg.get(const.C_DEFAULT, crv.UNDEFINED)
+        self.validator: Callable[[Any], Any] = cfg.get(const.C_VALIDATOR, crv.anything)
+
+
+class BulkParamsValidator(object):
+    """
+    Validates the whole dataset against params definition. Follows the semantics of the schema built by
+    create_schema_for_param_def, but works column by column: defaults are applied and validator is resolved once per
+    column, validation results are reused for repeated values. All errors are collected in a single pass.
+    Params definition must have validators bound (see bind_validators). Templates without params definition accept
+    any params as is, so manifests which don't declare params keep working.
+    """
+
+    def __init__(self, params_def: Dict[str, Dict[str, Any]]) -> None:
+        self.columns = [_ParamColumn(name, cfg) for name, cfg in params_def.items()]
+        self.is_defined = len(self.columns) > 0
+
+    def validate(self, rows: Iterable[Dict[str, Any]], first_row_num=1) -> BulkValidationResult:
+        """
+        Validates given rows. first_row_num is used for error reporting when dataset is validated in chunks.
+        """
+        start_time = time.perf_counter()
+        rows = list(rows)
+        if not self.is_defined:
+            return BulkValidationResult([dict(x) for x in rows], [], time.perf_counter() - start_time)
+        result: List[Dict[str, Any]] = [{} for _ in rows]
+        errors: List[Tuple[int, int, RowError]] = []
+        known_params = set(x.name for x in self.columns)
+        for i, row in enumerate(rows):
+            for key in row:
+                if key not in known_params:
+                    errors.append((i, -1, RowError(i + first_row_num, key, "extra keys not allowed")))
+        for col_num, column in enumerate(self.columns):
+            for i, message in self.__validate_column(column, rows, result):
+                errors.append((i, col_num, RowError(i + first_row_num, column.name, message)))
+        errors.sort(key=lambda x: x[:2])
+        return BulkValidationResult(result, [x[2] for x in errors], time.perf_counter() - start_time)
+
+    @classmethod
+    def __validate_column(
+        cls, column: _ParamColumn, rows: List[Dict[str, Any]], result: List[Dict[str, Any]]
+    ) -> Iterable[Tuple[int, str]]:
+        name, validator = column.name, column.validator
+        # Validators are pure functions, so results (and errors) are reused for repeated hashable values
+        known_values: Dict[Tuple[type, Any], Tuple[bool, Any]] = {}
+        for i, row in enumerate(rows):
+            if name in row:
+                value = row[name]
+            elif column.default is not crv.UNDEFINED:
+                # Like the schema, default goes through the validator
+                value = column.default
+            else:
+                if column.required:
+                    yield i, "required key not provided"
+                continue
+            try:
+                memo_key: Optional[Tuple[type, Any]] = (type(value), value)
+                is_valid, output = known_values[memo_key]  # type: ignore
+            except TypeError:
+                memo_key = None
+                is_valid, output = cls.__apply(validator, value)
+            except KeyError:
+                is_valid, output = known_values.setdefault(memo_key, cls.__apply(validator, value))  # type: ignore
+            if is_valid:
+                result[i][name] = output
+            else:
+                yield i, output
+
+    @staticmethod
+    def __apply(validator: Callable[[Any], Any], value: Any) -> Tuple[bool, Any]:
+        try:
+            return True, validator(value)
+        except crv.Invalid as e:
+            return False, e.msg
+        except ValueError:
+            return False, "not a valid value"
+
+
 def object(**kwargs):
     return valid_object_def(kwargs)
 
 
 def object_list(**kwargs):
     return crv.ensure_list(object(**kwargs))
+
+
+ObjectValidators.build_cache()
@@ -0,0 +1,39 @@
+#
+# Tapen - software for managing label printers
+# Copyright (C) 2022 Dmitry Berezovsky
+#
+# Tapen is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tapen is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.#
+
+
+import os
+import subprocess
+import sys
+import unittest
+
+# Heavy dependencies which must be imported only by commands which render or print labels
+LAZY_MODULES = ("PIL", "weasyprint", "poppler", "jinja2", "usb", "ptouch_py")
+
+
+class ImportTimeTest(unittest.TestCase):
+    def test_cli_import_does_not_load_rendering_and_printer_dependencies(self):
+        script = "import sys, tapen.cli; print(','.join(x for x in {!r} if x in sys.modules))".format(LAZY_MODULES)
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        result = subprocess.run(
+            [sys.executable, "-c", script], env=env, capture_output=True, text=True, check=True, timeout=60
+        )
+        self.assertEqual("", result.stdout.strip(), "Modules imported eagerly: " + result.stdout.strip())
+
+
+if __name__ == "__main__":
+    unittest.main()